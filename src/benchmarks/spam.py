@@ -0,0 +1,80 @@
+"""
+Measures the throughput of the spam detector.
+
+    python -m benchmarks.spam [--messages N] [--chats N] [--users N] [--bursts P]
+
+A fraction `P` of the messages starts a burst of a single user (identical or different texts),
+detected spammers are reset like the bot does before muting them.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from telegram_bot.spam import SpamDetector, SpamThresholds, SpamType
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--bursts", type=float, default=0.001)
+    parser.add_argument("--burst-length", type=int, default=20)
+    args = parser.parse_args()
+
+    texts = [f"message {index}" for index in range(50)]
+    messages: list[tuple[int, int, str]] = []
+    while len(messages) < args.messages:
+        chat_id = random.randrange(args.chats)
+        user_id = random.randrange(args.users)
+        if random.random() >= args.bursts:
+            messages.append((chat_id, user_id, random.choice(texts)))
+            continue
+
+        same = random.random() < 0.5
+        text = random.choice(texts)
+        messages.extend(
+            (chat_id, user_id, text if same else random.choice(texts))
+            for _ in range(args.burst_length)
+        )
+    del messages[args.messages :]
+
+    thresholds = SpamThresholds()
+
+    def _feed(detector: SpamDetector) -> dict[SpamType, int]:
+        detected = dict.fromkeys(SpamType, 0)
+        # a simulated clock at 1000 messages per second
+        for index, (chat_id, user_id, text) in enumerate(messages):
+            spam_type = detector.feed(
+                chat_id, user_id, text, thresholds, now=index / 1000
+            )
+            detected[spam_type] += 1
+            if spam_type != SpamType.NONE:
+                detector.reset(chat_id, user_id)
+        return detected
+
+    start = time.perf_counter()
+    detected = _feed(SpamDetector())
+    seconds = time.perf_counter() - start
+
+    # tracing slows it down, measured separately
+    tracemalloc.start()
+    detector = SpamDetector()
+    _feed(detector)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{args.messages} messages in {seconds:.2f}s"
+        f" ({args.messages / seconds:,.0f} messages/s),"
+        f" detector memory {size / 2**20:.1f} MiB"
+    )
+    print(
+        ", ".join(f"{spam_type.name}={count}" for spam_type, count in detected.items())
+    )
+
+
+if __name__ == "__main__":
+    main()
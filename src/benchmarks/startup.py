@@ -0,0 +1,114 @@
+"""
+Measures the time from process start until the bot could handle updates, with a generated state.
+
+    python -m benchmarks.startup [--chats N] [--users N] [--format json|snapshot] [--max-seconds S]
+
+Exits with 1 if the startup took longer than `--max-seconds`.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from telegram.ext import ApplicationBuilder
+
+from telegram_bot import Bot
+from telegram_bot.main import migrate_state
+from telegram_bot.state import dump_state, load_state
+
+
+def generate_state(chat_count: int, users_per_chat: int) -> dict:
+    now = datetime.now()
+    chats = []
+    for index in range(chat_count):
+        last_event = now - timedelta(days=random.randint(0, 30))
+        chats.append(
+            {
+                "id": -1000000000000 - index,
+                "pinned_message_id": None,
+                "users": [
+                    {"name": f"user {user}", "muted": False, "id": user}
+                    for user in random.sample(
+                        range(10 * users_per_chat), users_per_chat
+                    )
+                ],
+                "title": f"{random.choice('abcdefghijklmnopqrstuvwxyz')} chat {index}",
+                "invite_link": f"https://t.me/+{index:016d}",
+                "description": None,
+                "type": "supergroup",
+                "last_chat_event_isotime": last_event.isoformat(),
+                "created_message_id": None,
+                "premium_users_only": False,
+            }
+        )
+
+    return {
+        "group_message_id": [],
+        "recent_changes": [],
+        "hhh_id": -1,
+        "pinned_message_id": None,
+        "chats": chats,
+    }
+
+
+def measure(state_filepath: str) -> dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+
+    state = load_state(state_filepath)
+    timings["load"] = time.perf_counter() - start
+
+    step = time.perf_counter()
+    if migrate_state(state):
+        dump_state(state_filepath, state)
+    timings["migrate"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    bot = Bot(ApplicationBuilder().token("1:benchmark").build(), state_filepath)
+    bot.set_state(state)
+    timings["set_state"] = time.perf_counter() - step
+
+    # done in `post_init`
+    step = time.perf_counter()
+    bot.build_hhh_group_list_text()
+    timings["render"] = time.perf_counter() - step
+
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--format", choices=("json", "snapshot"), default="json")
+    parser.add_argument("--max-seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        state_filepath = os.path.join(directory, "state.json")
+        dump_state(
+            state_filepath, generate_state(args.chats, args.users), fmt=args.format
+        )
+
+        # the first start applies the migrations, the second one is a warm restart
+        for run in ("cold", "warm"):
+            timings = measure(state_filepath)
+            print(
+                f"{run}: "
+                + " ".join(
+                    f"{name}={seconds:.3f}s" for name, seconds in timings.items()
+                )
+            )
+
+    if timings["total"] > args.max_seconds:
+        print(f"Startup took longer than {args.max_seconds}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
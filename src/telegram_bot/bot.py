@@ -1,21 +1,46 @@
-import json
+import asyncio
+import copy
+import io
 import os
-import tempfile
-from collections.abc import Iterable
+from collections.abc import Coroutine, Iterable
 from datetime import datetime, timedelta
-from enum import Enum
 from itertools import groupby, zip_longest
-from threading import Timer
 from typing import Any
 
-from telegram import ChatPermissions, Message, Update
+from telegram import (
+    CallbackQuery,
+    ChatMember,
+    ChatPermissions,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    Message,
+    Update,
+)
 from telegram.constants import ParseMode
 from telegram.error import BadRequest, TelegramError
-from telegram.ext import Application, CallbackContext
+from telegram.ext import Application, ApplicationHandlerStop, CallbackContext
 
+from . import export, journal, search
 from .chat import Chat, User
+from .chat_cache import ChatCache, ChatSummary
+from .config import LiveConfig, Settings
 from .decorators import Command
+from .dedup import RecentKeys
+from .gatekeeping import Gatekeeper
+from .journal import Journal
 from .logger import create_logger
+from .memory import MemoryProfiler
+from .metadata import ChatMetadataCache
+from .metrics import Metrics
+from .provisioning import InviteLinkProvisioner
+from .reaper import ChatReaper, ReapResult
+from .scheduling import PriorityUpdateProcessor
+from .search import SearchStore
+from .sharding import ShardLink
+from .spam import SpamDetector, SpamThresholds, SpamType
+from .state import FsyncPolicy, StateWriter, load_state
+from .tenants import SharedResources, Tenant
+from .user import Activity
 
 
 def grouper(iterable, n, fillvalue=None) -> Iterable[tuple[Any, Any]]:
@@ -24,63 +49,352 @@ def grouper(iterable, n, fillvalue=None) -> Iterable[tuple[Any, Any]]:
     return zip_longest(*args, fillvalue=fillvalue)
 
 
-class SpamType(Enum):
-    NONE = 0
-    CONSECUTIVE = 1
-    DIFFERENT = 2
-    SAME = 3
-
-
 class Bot:
-    def __init__(self, application: Application, state_filepath: str):
+    def __init__(
+        self,
+        application: Application,
+        state_filepath: str,
+        tenant: Tenant | None = None,
+        shared: SharedResources | None = None,
+        shard_link: ShardLink | None = None,
+    ):
         self.logger = create_logger("hhh_diff_bot")
-        self.chats: dict[int, Chat] = {}
         self.application = application
-        self.main_admin_ids: set[int] = self._load_main_admin_ids()
+        self.tenant = tenant or Tenant("default", "", state_filepath)
+        self.metrics = shared.metrics if shared else Metrics()
+        self.config = shared.config if shared else LiveConfig.from_env()
+        self.memory = shared.memory if shared else MemoryProfiler.from_env()
+        # set in workers, the coordinator owns the HHH list
+        self.shard_link = shard_link
+        # the limits are set by `apply_settings`
+        self.chats = ChatCache(application.bot, on_evict=self._drop_chat_data)
+        # `0` disables the eviction of idle chats
+        self.eviction_interval = 600.0
+        self.main_admin_ids: set[int] = self.tenant.main_admin_ids or set()
+        if (
+            self.tenant.main_admin_ids is None
+            and not self.config.settings.main_admin_ids
+        ):
+            self.logger.warning("MAIN_ADMIN_IDS is not set!")
+        self.hhh_id = (
+            self.tenant.hhh_id
+            if self.tenant.hhh_id is not None
+            else self.config.settings.hhh_id
+        )
         self.state: dict[str, Any] = {
             "group_message_id": [],
             "recent_changes": [],
-            "hhh_id": -1001473841450,
+            "hhh_id": self.hhh_id,
             "pinned_message_id": None,
         }
         self.state_filepath = state_filepath
+        # changed in place by `apply_settings`
+        self.fsync_policy = FsyncPolicy()
+        self.state_writer = StateWriter(
+            state_filepath,
+            fsync_policy=self.fsync_policy,
+            encoder=shared.encoder if shared else None,
+        )
+        self.journal: Journal | None = None
+        if os.getenv("STATE_JOURNAL", "").lower() in ("1", "true"):
+            self.journal = Journal(
+                journal.journal_filepath(state_filepath),
+                # a crash loses at most the records of the last interval
+                fsync_policy=FsyncPolicy(FsyncPolicy.INTERVAL),
+            )
+        self.compaction_interval = 300.0
+        self.compaction_threshold = 1000
+        # names have at most 64 characters, so a page stays below the message length limit
+        self.users_page_size = 40
+        self.mute_minutes = 15
+        self.message_length = 4096
+        self._compaction_requested = asyncio.Event()
+        self._background_tasks: set[asyncio.Task] = set()
+        self._dead_chats_check: asyncio.Task | None = None
+        # updates up to this one have been handled before the restart
+        self._restored_update_id: int | None = None
+        self._journaled_update_id: int | None = None
+        # ids of handled updates, redelivered ones are dropped
+        self.recent_update_ids = RecentKeys(10000)
+        # updates are handled concurrently, so older ones may still be pending when a newer one
+        # has been handled, only the ids within this distance of the last one are persisted
+        self.update_redelivery_window = 100
+        self._handling_update_ids: set[int] = set()
+        self._unjournaled_update_ids: list[int] = []
+        # side effects which have been applied, see `claim_effect`
+        self.effect_keys = RecentKeys(1000)
+        self._group_list_cache: tuple[tuple, list[tuple[str, int]]] | None = None
+        # chat id -> (`Chat.sorted_users`, pages of them), replaced once users join or leave
+        self._users_pages: dict[int, tuple[list[User], list[list[User]]]] = {}
+        # (chat id, user id) -> (timestamp, handle)
+        self._scheduled_unmutes: dict[
+            tuple[int, int], tuple[float, asyncio.TimerHandle | None]
+        ] = {}
+        self.invite_links = InviteLinkProvisioner(self)
+        self.chat_metadata = ChatMetadataCache.from_env(self)
+        self.reaper = ChatReaper(self)
+        self.spam_detector = SpamDetector()
+        # `0` disables the search
+        self.search = SearchStore()
+        # the indexes are written separately, they change with every message
+        self.search_writer = StateWriter(
+            search.search_filepath(state_filepath),
+            # only the recent messages, they are indexed again
+            fsync_policy=FsyncPolicy(FsyncPolicy.NEVER),
+            backups=0,
+        )
+        self.search_save_interval = 300.0
+        # used for chats without their own thresholds, `None` disables the spam detection
+        self.default_spam_thresholds: SpamThresholds | None = None
+        self.gatekeeper = Gatekeeper.from_env(
+            self, verdicts=shared.verdicts if shared else None
+        )
+        self.metrics.gauge(
+            "hhh_chats", lambda: len(self.chats), tenant=self.tenant.name
+        )
+        self.metrics.gauge(
+            "hhh_chats_resident",
+            lambda: self.chats.resident_count,
+            tenant=self.tenant.name,
+        )
+        self.metrics.gauge(
+            "hhh_chat_metadata_cached",
+            lambda: len(self.chat_metadata),
+            tenant=self.tenant.name,
+        )
+        self.config.subscribe(self.apply_settings)
 
-    def _load_main_admin_ids(self) -> set[int]:
-        raw_value = os.getenv("MAIN_ADMIN_IDS")
-        if not raw_value:
-            self.logger.warning("MAIN_ADMIN_IDS is not set!")
-            return set()
+    def apply_settings(self, settings: Settings) -> None:
+        """
+        Called on startup and whenever the settings changed
+        """
+        if self.tenant.main_admin_ids is None:
+            self.main_admin_ids = settings.main_admin_ids
+        self.mute_minutes = settings.mute_minutes
+        self.message_length = settings.message_length
+        if self.users_page_size != settings.users_page_size:
+            self.users_page_size = settings.users_page_size
+            self._users_pages.clear()
+        self.search.max_messages = settings.search_messages_per_chat
+        self.recent_update_ids.max_size = settings.recent_update_ids
+        self.update_redelivery_window = settings.update_redelivery_window
+        self.effect_keys.max_size = settings.effect_keys
+        self.default_spam_thresholds = (
+            settings.spam_thresholds if settings.spam_detection else None
+        )
+        self.spam_detector.max_users = settings.spam_max_users_per_chat
+        self.gatekeeper.verdict_ttl = settings.gatekeeping_verdict_ttl
+        self.chats.max_resident = settings.chat_cache_size
+        self.chats.idle_timeout = (
+            timedelta(seconds=settings.chat_idle_eviction)
+            if settings.chat_idle_eviction
+            else None
+        )
+        self.eviction_interval = settings.chat_eviction_interval
+        self.chat_metadata.ttl = settings.chat_metadata_ttl
+        self.chat_metadata.refresh_interval = settings.chat_metadata_refresh_interval
+        self.chat_metadata.batch_size = settings.chat_metadata_batch_size
+        self.invite_links.refresh_interval = settings.invite_link_refresh_interval
+        self.invite_links.max_attempts = settings.invite_link_max_attempts
+        self.invite_links.backoff = settings.invite_link_backoff
+        self.invite_links.batch_delay = settings.hhh_update_batch_delay
+        self.fsync_policy.mode = settings.state_fsync
+        self.fsync_policy.interval = settings.state_fsync_interval
+        if self.journal:
+            self.journal.fsync_policy.mode = settings.state_journal_fsync
+            self.journal.fsync_policy.interval = settings.state_fsync_interval
+        self.compaction_interval = settings.state_compaction_interval
+        self.compaction_threshold = settings.state_compaction_threshold
+        self.reaper.interval = settings.chat_reaper_interval
+        self.reaper.concurrency = settings.chat_reaper_concurrency
+        self.reaper.grace_period = timedelta(seconds=settings.chat_reaper_grace_period)
+        processor = self.application.update_processor
+        if isinstance(processor, PriorityUpdateProcessor):
+            processor.shed_threshold = settings.update_shed_threshold
+            processor.sample_rate = settings.update_shed_sample_rate
+
+    def record_change(self, op: str, **fields) -> None:
+        if self.journal:
+            self.journal.append(op, **fields)
 
-        try:
-            id_list = json.loads(raw_value)
-        except ValueError as e:
-            self.logger.error("Could not load main admins", exc_info=e)
-            return set()
+    def save_state(self) -> None:
+        if self.journal:
+            update_id = self.state.get("last_update_id")
+            if update_id != self._journaled_update_id:
+                self.record_change(
+                    journal.UPDATE_PROCESSED,
+                    update_id=update_id,
+                    update_ids=self._unjournaled_update_ids,
+                )
+                self._journaled_update_id = update_id
+                self._unjournaled_update_ids = []
+            # appending to the file blocks, it's written by the thread writing the snapshots
+            self.state_writer.call(self.journal.flush)
+            if self.journal.size >= self.compaction_threshold:
+                self._compaction_requested.set()
+            return
+
+        self.state_writer.submit(self._state_snapshot())
 
-        if not isinstance(id_list, list):
-            self.logger.error("MAIN_ADMIN_IDS is not a JSON list")
-            return set()
+    def _state_snapshot(self) -> dict[str, Any]:
+        """
+        A copy of the state which isn't changed by handlers, encoded and written in the background
+        """
+        self.state["scheduled_unmutes"] = self._serialize_scheduled_unmutes()
+        self.state["recent_update_ids"] = self._redelivery_update_ids()
+        self.state["effect_keys"] = self.effect_keys.serialize()
+        # evicted chats aren't decoded, the writer splices them into the snapshot
+        return {
+            **copy.deepcopy(self.state),
+            "chats": self.chats.serialize_encoded(),
+        }
 
-        result = set()
-        for main_admin_id in id_list:
+    def compact_state(self) -> None:
+        """
+        Writes the whole state and drops all journal records which are included in it
+        """
+        if not self.journal:
+            self.save_state()
+            return
+
+        current_journal = self.journal
+        sequence = current_journal.sequence
+        self.state[journal.SEQUENCE_KEY] = sequence
+        # written before the snapshot, the truncation keeps every record after `sequence`
+        self.state_writer.call(current_journal.flush)
+
+        def _truncate() -> None:
+            current_journal.truncate(sequence)
+            self.logger.info("Compacted state journal up to record %s", sequence)
+
+        self.state_writer.submit(self._state_snapshot(), after=_truncate)
+
+    async def run_compactor(self) -> None:
+        while True:
             try:
-                result.add(int(main_admin_id))
-            except ValueError:
-                self.logger.error("Not a valid user ID: %s", main_admin_id)
-        return result
+                await asyncio.wait_for(
+                    self._compaction_requested.wait(), self.compaction_interval
+                )
+            except TimeoutError:
+                pass
+            self._compaction_requested.clear()
 
-    def save_state(self) -> None:
-        self.state["chats"] = [chat.serialize() for chat in self.chats.values()]
-        with open(self.state_filepath, "w+") as f:
-            json.dump(self.state, f)
+            if self.journal and self.journal.size:
+                try:
+                    self.compact_state()
+                except OSError:
+                    self.logger.error("Failed to compact state", exc_info=True)
+
+    def save_search(self) -> None:
+        """
+        Writes the search indexes in the background if they changed
+        """
+        if not self.search.dirty:
+            return
+
+        # e.g. deleted chats
+        self.search.retain(self.chats)
+        self.search.dirty = False
+        self.search_writer.submit(self.search.serialize())
+
+    async def run_search_writer(self) -> None:
+        while True:
+            await asyncio.sleep(self.search_save_interval)
+            self.save_search()
+
+    def _load_search(self) -> None:
+        try:
+            self.search.load(
+                load_state(search.search_filepath(self.state_filepath), backups=0)
+            )
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            self.logger.warning("Unable to load the search indexes: %s", e)
+
+    def _drop_chat_data(self, chat_id: int) -> None:
+        # the chat is cached in `chat_data` by `Command`, which would keep it in memory
+        chat_data = self.application.chat_data.get(chat_id)
+        if chat_data:
+            chat_data.pop("chat", None)
+        self._users_pages.pop(chat_id, None)
+
+    async def run_chat_eviction(self) -> None:
+        while True:
+            # checked again later if disabled, it can be enabled by reloading the settings
+            await asyncio.sleep(self.eviction_interval or 60)
+            if not self.eviction_interval:
+                continue
+            evicted = self.chats.evict_idle()
+            if evicted:
+                self.logger.info(
+                    "Evicted %s idle chats (%s/%s in memory)",
+                    evicted,
+                    self.chats.resident_count,
+                    len(self.chats),
+                )
+
+    def _start_background_task(
+        self, coroutine: Coroutine[Any, Any, None]
+    ) -> asyncio.Task:
+        # `Application.create_task` would make `Application.stop` wait for them
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def post_init(self, application: Application) -> None:
+        if self.shard_link:
+            await self.shard_link.connect(application)
+        if self.journal:
+            self._start_background_task(self.run_compactor())
+        self._start_background_task(self.run_chat_eviction())
+        self._start_background_task(self.invite_links.run())
+        self._start_background_task(self.invite_links.run_refresh())
+        self._start_background_task(self.chat_metadata.run())
+        self._start_background_task(self.reaper.run())
+        self._start_background_task(self.run_search_writer())
+        for (chat_id, user_id), (timestamp, _) in list(self._scheduled_unmutes.items()):
+            self._schedule_unmute(chat_id, user_id, timestamp)
+        # the chats are known from the state already, the first update shouldn't wait for this
+        self._group_list_lines()
+
+    async def post_init_coordinator(self, application: Application) -> None:
+        """
+        `post_init` of a shard coordinator, which only keeps the HHH list (see `sharding`)
+        """
+        if self.journal:
+            self._start_background_task(self.run_compactor())
+
+    async def post_stop(self, application: Application) -> None:
+        """
+        Called after all pending updates have been handled, finishes pending HHH message edits
+        """
+        for task in self._background_tasks:
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self.invite_links.flush()
+        if self.shard_link:
+            await self.shard_link.close()
+
+    async def post_shutdown(self, application: Application) -> None:
+        for _, handle in self._scheduled_unmutes.values():
+            if handle:
+                handle.cancel()
+        # also persists the pending mute resets
+        self.compact_state()
+        self.state_writer.close()
+        self.save_search()
+        self.search_writer.close()
 
     @Command(chat_admin=True)
     async def delete_chat(self, update: Update, context: CallbackContext) -> None:
         chat: Chat = context.chat_data["chat"]  # type: ignore[index]
 
         if chat.id in self.chats:
-            self.logger.info(f"Deleting chat ({chat}) from state.")
+            self.logger.info("Deleting chat (%s) from state.", chat)
             del self.chats[chat.id]
+            self.record_change(journal.CHAT_DELETED, chat_id=chat.id)
             del context.chat_data["chat"]  # type: ignore[index,union-attr]
 
     @Command(main_admin=True)
@@ -104,6 +418,7 @@ class Bot:
             self.chats.pop(chat_id)
         except KeyError:
             return await message.reply_text(text="Not a valid chat_id.")
+        self.record_change(journal.CHAT_DELETED, chat_id=chat_id)
 
         return None
 
@@ -136,7 +451,7 @@ class Bot:
                 and not permissions.can_send_messages
             ):
                 message = f"Sadly, user {user.name} couldn't be restricted due to: `{e.message}`. Shame on {user.name}"
-                self.logger.debug(f"{message}")
+                self.logger.debug("%s", message)
                 await self.send_message(
                     chat_id=chat_id, text=message, parse_mode=ParseMode.MARKDOWN
                 )
@@ -147,7 +462,8 @@ class Bot:
 
     async def unmute_user(self, chat_id: int, user: User) -> bool:
         result = False
-        permissions = ChatPermissions(
+        # the default permissions of the chat
+        permissions = await self.chat_metadata.permissions(chat_id) or ChatPermissions(
             can_send_messages=True,
             can_send_photos=True,
             can_send_videos=True,
@@ -162,6 +478,9 @@ class Bot:
                 chat_id, user, timedelta(minutes=0), permissions
             ):
                 user.muted = False
+                self.record_change(
+                    journal.USER_MUTED, chat_id=chat_id, user_id=user.id, muted=False
+                )
                 result = True
             else:
                 self.logger.error("Failed to unmute user")
@@ -182,30 +501,111 @@ class Bot:
 
         permissions = ChatPermissions(can_send_messages=False)
         result = False
-        self.logger.info(f"Reason for muting: {reason}")
+        self.logger.info("Reason for muting: %s", reason)
         if await self.set_user_restriction(
             chat_id, user, until_date=until_date, reason=reason, permissions=permissions
         ):
             user.muted = True
+            self.record_change(
+                journal.USER_MUTED, chat_id=chat_id, user_id=user.id, muted=True
+            )
             result = True
 
             # We'd need to parse the exception before assigning user.muted differently
-            def _set_user_unmute():
-                user.muted = False
-
             self.logger.info(
-                f"Set timer for {until_date.total_seconds()}s to set user mute state to `False`"
+                "Set timer for %ss to set user mute state to `False`",
+                until_date.total_seconds(),
+            )
+            timestamp = (datetime.now() + until_date).timestamp()
+            self._schedule_unmute(chat_id, user.id, timestamp)
+            self.record_change(
+                journal.UNMUTE_SCHEDULED,
+                chat_id=chat_id,
+                user_id=user.id,
+                timestamp=timestamp,
             )
-            Timer(until_date.total_seconds(), _set_user_unmute).start()
 
         return result
 
+    def _schedule_unmute(self, chat_id: int, user_id: int, timestamp: float) -> None:
+        """
+        Resets the mute state of the user at `timestamp`, pending resets are part of the state
+        """
+        key = (chat_id, user_id)
+        if previous := self._scheduled_unmutes.get(key):
+            if previous[1]:
+                previous[1].cancel()
+
+        delay = max(timestamp - datetime.now().timestamp(), 0)
+        handle = asyncio.get_running_loop().call_later(
+            delay, self._reset_mute, chat_id, user_id
+        )
+        self._scheduled_unmutes[key] = (timestamp, handle)
+
+    def _reset_mute(self, chat_id: int, user_id: int) -> None:
+        self._scheduled_unmutes.pop((chat_id, user_id), None)
+        chat = self.chats.get(chat_id)
+        user = chat.get_user_by_id(user_id) if chat else None
+        if user:
+            user.muted = False
+            self.record_change(
+                journal.USER_MUTED, chat_id=chat_id, user_id=user_id, muted=False
+            )
+            self.save_state()
+
+    def _serialize_scheduled_unmutes(self) -> list[dict[str, Any]]:
+        return [
+            {"chat_id": chat_id, "user_id": user_id, "timestamp": timestamp}
+            for (chat_id, user_id), (timestamp, _) in self._scheduled_unmutes.items()
+        ]
+
+    def index_message(self, chat: Chat, user: User, message: Message) -> None:
+        """
+        Adds the text of `message` to the search index of the chat (commands aren't indexed)
+        """
+        text = message.text or message.caption
+        if not text or not self.search.max_messages or text.startswith("/"):
+            return
+
+        self.search.add(chat.id, message.message_id, user.id, text)
+
+    async def check_spam(self, chat: Chat, user: User, message: Message) -> None:
+        """
+        Feeds `message` to the spam detector and mutes `user` if they are spamming
+        """
+        thresholds = chat.spam_thresholds or self.default_spam_thresholds
+        if thresholds is None or user.muted or not chat.is_group():
+            return
+
+        spam_type = self.spam_detector.feed(
+            chat.id, user.id, _message_content(message), thresholds
+        )
+        if spam_type == SpamType.NONE:
+            return
+
+        self.spam_detector.reset(chat.id, user.id)
+        self.metrics.inc(
+            "hhh_spam_detected_total",
+            tenant=self.tenant.name,
+            type=spam_type.name.lower(),
+        )
+        await self.mute_user(
+            chat.id,
+            user,
+            until_date=timedelta(minutes=thresholds.mute_minutes),
+            reason=f"Spam detected ({spam_type.name.lower()})",
+        )
+
     def update_recent_changes(self, update: str):
         rc: list[str] = self.state.get("recent_changes", [])
         if len(rc) > 2:
             rc.pop()
 
         self.state["recent_changes"] = [update] + rc
+        self.record_change(
+            journal.HHH_MESSAGES_CHANGED,
+            fields={"recent_changes": self.state["recent_changes"]},
+        )
 
     @staticmethod
     def create_latest_change_text(
@@ -238,21 +638,17 @@ class Bot:
         """
         deductable_per_chat = 0
 
-        for _, g in groupby(
-            sorted(
-                [chat for _, chat in self.chats.items() if chat and chat.title],
-                key=lambda c: c.title.lower(),  # type: ignore[index, union-attr]
-            ),
-            key=lambda c: c.title[0].lower(),  # type: ignore[index]
-        ):
-            line = " | ".join([chat.to_message_entry() for chat in g]) + "\n"
-            if len(message) + len(line) - deductable_per_chat * len(list(g)) >= 4096:
+        for line, chat_count in self._group_list_lines():
+            if (
+                len(message) + len(line) - deductable_per_chat * chat_count
+                >= self.message_length
+            ):
                 messages.append(message)
                 message = ""
 
             message += line
 
-        if len(message) + len(suffix) >= 4096:
+        if len(message) + len(suffix) >= self.message_length:
             messages.append(message)
             message = ""
 
@@ -261,6 +657,106 @@ class Bot:
 
         return messages
 
+    def _group_list_lines(self) -> list[tuple[str, int]]:
+        """
+        One line per first letter of the chat titles with the number of chats in it,
+        cached until a title or invite link changes
+        :return: list[tuple[str, int]]
+        """
+        summaries = sorted(
+            [chat for chat in self.chats.summaries() if chat.title],
+            key=lambda c: c.title.lower(),  # type: ignore[index, union-attr]
+        )
+        key = tuple((chat.id, chat.title, chat.invite_link) for chat in summaries)
+        if self._group_list_cache and self._group_list_cache[0] == key:
+            return self._group_list_cache[1]
+
+        lines = []
+        for _, g in groupby(summaries, key=lambda c: c.title[0].lower()):  # type: ignore[index]
+            group = list(g)
+            lines.append(
+                (
+                    " | ".join([chat.to_message_entry() for chat in group]) + "\n",
+                    len(group),
+                )
+            )
+        self._group_list_cache = (key, lines)
+
+        return lines
+
+    async def skip_processed_update(
+        self, update: Update, context: CallbackContext
+    ) -> None:
+        """
+        Runs before all other handlers. Stops updates which were handled before a restart
+        (and are delivered again since the offset wasn't confirmed) or which have been delivered
+        before (webhook retries) or are being handled right now.
+        """
+        update_id = update.update_id
+        if self._is_handled(update_id) or update_id in self._handling_update_ids:
+            self.logger.debug("Skip already handled update %s", update_id)
+            self.metrics.inc("hhh_duplicate_updates_total", tenant=self.tenant.name)
+            raise ApplicationHandlerStop()
+
+        self._handling_update_ids.add(update_id)
+
+    async def complete_update(
+        self, update: Update, context: CallbackContext | None = None
+    ) -> None:
+        """
+        Runs after all other handlers (and by `Command` before saving the state). Remembers the
+        update id which is persisted with the next state change.
+        Updates which fail are completed as well, they would fail again.
+        """
+        update_id = update.update_id
+        self._handling_update_ids.discard(update_id)
+        if not self.recent_update_ids.add(update_id):
+            return
+
+        self.state["last_update_id"] = max(
+            self.state.get("last_update_id", update_id), update_id
+        )
+        if self.journal:
+            self._unjournaled_update_ids.append(update_id)
+
+    def _is_handled(self, update_id: int) -> bool:
+        if update_id in self.recent_update_ids:
+            return True
+        # older updates may have been pending, their ids have been persisted if they were handled
+        return (
+            self._restored_update_id is not None
+            and update_id <= self._restored_update_id - self.update_redelivery_window
+        )
+
+    def _redelivery_update_ids(self) -> list[int]:
+        """
+        The ids of the handled updates within `update_redelivery_window` of the last one
+        """
+        last_update_id = self.state.get("last_update_id")
+        if last_update_id is None:
+            return []
+
+        oldest = last_update_id - self.update_redelivery_window
+        return [
+            update_id
+            for update_id in self.recent_update_ids.newest(
+                self.update_redelivery_window
+            )
+            if isinstance(update_id, int) and update_id > oldest
+        ]
+
+    def claim_effect(self, key: str) -> bool:
+        """
+        Marks the side effect identified by `key` as applied
+        :return: bool `False` if it has been applied before and must not be repeated
+        """
+        if not self.effect_keys.add(key):
+            self.logger.info("Skip repeated effect %s", key)
+            return False
+
+        self.record_change(journal.EFFECT_APPLIED, key=key)
+        return True
+
     @property
     def group_message_ids(self) -> list:
         """
@@ -279,6 +775,9 @@ class Bot:
     @group_message_ids.setter
     def group_message_ids(self, value: list[str]):
         self.state["group_message_id"] = value
+        self.record_change(
+            journal.HHH_MESSAGES_CHANGED, fields={"group_message_id": value}
+        )
 
     async def delete_message(self, chat_id: str, message_id: str, *args, **kwargs):
         return await self.application.bot.delete_message(
@@ -292,21 +791,39 @@ class Bot:
         delete: bool = False,
         create_changelog: bool = False,
     ):
-        if create_changelog:
+        if new_title and new_title == chat.title:
+            # e.g. a chat which is new to the coordinator already has the new title
+            new_title = ""
+            create_changelog = create_changelog and chat.id not in self.chats
+        if create_changelog and not self.shard_link:
             latest_change = self.create_latest_change_text(chat, new_title, delete)
-            self.logger.debug(f"Add latest change {latest_change} to recent_changes")
+            self.logger.debug("Add latest change %s to recent_changes", latest_change)
             self.update_recent_changes(latest_change)
 
         if new_title:
-            self.logger.debug(f"Update chat.title ({chat.title}) to {new_title}.")
+            self.logger.debug("Update chat.title (%s) to %s.", chat.title, new_title)
             chat.title = new_title
+            self.record_change(journal.CHAT_RENAMED, chat_id=chat.id, title=new_title)
+        if chat.id not in self.chats:
+            self.record_change(journal.CHAT_ADDED, chat=chat.serialize())
         self.chats.update({chat.id: chat})
         if delete and chat.id in self.chats.keys():
             self.chats.pop(chat.id)
+            self.record_change(journal.CHAT_DELETED, chat_id=chat.id)
+
+        if self.shard_link:
+            await self.shard_link.publish(
+                chat,
+                new_title=new_title,
+                delete=delete,
+                create_changelog=create_changelog,
+            )
+            return None
+
         self.logger.debug("Build new group list.")
 
         total_group_count_text = (
-            f"{len([c for c in self.chats.values() if c.title])} groups in total"
+            f"{len([c for c in self.chats.summaries() if c.title])} groups in total"
         )
         changes = "\n".join(["========", "\n".join(self.state["recent_changes"])])
         messages = self.build_hhh_group_list_text(
@@ -330,7 +847,7 @@ class Bot:
         pinned = False
         for index, message_text in enumerate(messages):
             if not self.group_message_ids or index >= len(self.group_message_ids):
-                self.logger.debug(f"Send {len(messages)} new messages.")
+                self.logger.debug("Send %s new messages.", len(messages))
                 message: Message = await self.send_message(
                     chat_id=self.state["hhh_id"],
                     text=message_text,
@@ -358,6 +875,10 @@ class Bot:
                         )
 
                         self.state["pinned_message_id"] = self.group_message_ids[0]
+                        self.record_change(
+                            journal.HHH_MESSAGES_CHANGED,
+                            fields={"pinned_message_id": self.group_message_ids[0]},
+                        )
                         pinned = True
                     except BadRequest:
                         self.logger.error("Couldn't pin the message", exc_info=True)
@@ -365,7 +886,7 @@ class Bot:
             else:
                 try:
                     self.logger.debug(
-                        f"Edit an old message with the new text ({message_text})"
+                        "Edit an old message with the new text (%s)", message_text
                     )
                     await self.application.bot.edit_message_text(
                         message_text,
@@ -402,17 +923,41 @@ class Bot:
             except IndexError:
                 self.logger.error("Couldn't find user in chat")
             else:
-                chat.users.remove(user)
+                chat.remove_user(user)
+                self.record_change(journal.USER_LEFT, chat_id=chat.id, user_id=user.id)
         else:
             await self.update_hhh_message(chat, delete=True, create_changelog=True)
             context.chat_data.clear()  # type: ignore[union-attr]
 
     def set_state(self, state: dict[str, Any]) -> None:
+        if self.journal:
+            sequence = state.get(journal.SEQUENCE_KEY, 0)
+            records = self.journal.read(after=sequence)
+            self.logger.info("Replaying %s journal records", len(records))
+            state = journal.replay(state, records)
+            self.journal.sequence = max(
+                self.journal.sequence, state[journal.SEQUENCE_KEY]
+            )
+
         self.state = state
-        self.chats = {
-            schat["id"]: Chat.deserialize(schat, self.application.bot)  # type: ignore[misc]
-            for schat in state.get("chats", [])
+        self._restored_update_id = self._journaled_update_id = state.get(
+            "last_update_id"
+        )
+        self.recent_update_ids = RecentKeys(
+            self.recent_update_ids.max_size, state.get("recent_update_ids", [])
+        )
+        self.effect_keys = RecentKeys(
+            self.effect_keys.max_size, state.get("effect_keys", [])
+        )
+        # scheduled in `post_init`, the event loop isn't running yet
+        self._scheduled_unmutes = {
+            (entry["chat_id"], entry["user_id"]): (entry["timestamp"], None)
+            for entry in state.get("scheduled_unmutes", [])
         }
+        self.state.setdefault("hhh_id", self.hhh_id)
+        # the chats are only kept by `self.chats`
+        self.chats.load(self.state.pop("chats", []))
+        self._load_search()
 
     async def send_message(self, *, chat_id: int, text: str, **kwargs) -> Message:
         return await self.application.bot.send_message(
@@ -420,9 +965,9 @@ class Bot:
         )
 
     def _get_chat_by_title(self, title: str) -> Chat | None:
-        for chat in self.chats.values():
-            if title == chat.title:
-                return chat
+        for summary in self.chats.summaries():
+            if title == summary.title:
+                return self.chats[summary.id]
 
         return None
 
@@ -441,13 +986,152 @@ class Bot:
         else:
             chat = from_chat
 
-        sorted_users: list[User] = sorted(chat.users, key=lambda _user: _user.name)
-        if sorted_users:
-            message = "\n".join([user.name for user in sorted_users])
-        else:
+        if not chat.users:
             message = "No active users. Users need to write a message in the chat to be recognized (not just a command)"
+            return await self.send_message(chat_id=from_chat.id, text=message)
+
+        text, reply_markup = self._users_page(chat, 0)
+        return await self.send_message(
+            chat_id=from_chat.id, text=text, reply_markup=reply_markup
+        )
 
-        return await self.send_message(chat_id=from_chat.id, text=message)
+    async def show_users_page(self, update: Update, context: CallbackContext) -> None:
+        """
+        Handles the navigation buttons of `show_users` (callback data `users:<chat id>:<page>`).
+        Like the command, the buttons may only be used by known users of the chat the list has
+        been sent to (the callback data can be forged).
+        """
+        query: CallbackQuery = update.callback_query  # type: ignore[assignment]
+        _, chat_id, page = query.data.split(":")  # type: ignore[union-attr]
+        message = query.message
+        from_chat = self.chats.get(message.chat.id) if message else None
+        if from_chat is None or not from_chat.get_user_by_id(query.from_user.id):
+            self.logger.warning(
+                "%s isn't allowed to show the users of %s",
+                query.from_user.name,
+                chat_id,
+            )
+            await query.answer("You are not allowed to perform this action")
+            return
+
+        chat = self.chats.get(int(chat_id))
+        if chat is None or not chat.users:
+            await query.answer("This chat doesn't exist anymore")
+            return
+
+        text, reply_markup = self._users_page(chat, int(page))
+        await query.answer()
+        try:
+            await query.edit_message_text(
+                text, reply_markup=reply_markup, disable_web_page_preview=True
+            )
+        except BadRequest as e:
+            # pressing a button of an outdated message can result in the same page
+            self.logger.debug("Didn't change the users page: %s", e)
+
+    def _users_page(
+        self, chat: Chat, page: int
+    ) -> tuple[str, InlineKeyboardMarkup | None]:
+        """
+        Renders a page of the users of `chat` sorted by name.
+        The pages are cached until users join or leave, the counts are always the current ones.
+        """
+        # only sorted again after users joined or left
+        sorted_users = chat.sorted_users()
+        cached = self._users_pages.get(chat.id)
+        if cached is None or cached[0] is not sorted_users:
+            cached = self._users_pages[chat.id] = (
+                sorted_users,
+                [
+                    sorted_users[start : start + self.users_page_size]
+                    for start in range(0, len(sorted_users), self.users_page_size)
+                ],
+            )
+
+        pages = cached[1]
+        page_count = len(pages)
+        page = min(max(page, 0), page_count - 1)
+        text = "\n".join(
+            f"{user.name} ({user.activity.total}/{chat.activity.total})"
+            for user in pages[page]
+        )
+
+        if page_count == 1:
+            return text, None
+
+        buttons = []
+        if page > 0:
+            buttons.append(
+                InlineKeyboardButton("<", callback_data=f"users:{chat.id}:{page - 1}")
+            )
+        buttons.append(
+            InlineKeyboardButton(
+                f"{page + 1}/{page_count}", callback_data=f"users:{chat.id}:{page}"
+            )
+        )
+        if page < page_count - 1:
+            buttons.append(
+                InlineKeyboardButton(">", callback_data=f"users:{chat.id}:{page + 1}")
+            )
+
+        return text, InlineKeyboardMarkup([buttons])
+
+    @Command()
+    async def search_messages(self, update: Update, context: CallbackContext):
+        chat: Chat = context.chat_data["chat"]  # type: ignore[index]
+        message = update.effective_message
+        if not message:
+            raise ValueError("No message")
+        if not context.args:
+            return await message.reply_text("Usage: /search <terms>")
+
+        index = self.search.get(chat.id)
+        results = index.search(" ".join(context.args)) if index else []
+        if not results:
+            return await message.reply_text("Nothing found")
+
+        # links only work in supergroups
+        link_prefix = (
+            f"https://t.me/c/{str(chat.id)[4:]}/"
+            if str(chat.id).startswith("-100")
+            else None
+        )
+        lines = []
+        for message_id, user_id, text in results:
+            user = chat.get_user_by_id(user_id)
+            snippet = text if len(text) <= 100 else f"{text[:99]}…"
+            line = f"{user.name if user else user_id}: {snippet}"
+            if link_prefix:
+                line += f" ({link_prefix}{message_id})"
+            lines.append(line)
+
+        return await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+    @Command()
+    async def show_activity(self, update: Update, context: CallbackContext):
+        chat: Chat = context.chat_data["chat"]  # type: ignore[index]
+        period = context.args[0].lower() if context.args else Activity.WEEK
+        if period not in Activity.PERIODS:
+            return await self.send_message(
+                chat_id=chat.id, text=f"Use one of {', '.join(Activity.PERIODS)}"
+            )
+
+        now = datetime.now()
+        counts = [(user.activity.count(period, now), user.name) for user in chat.users]
+        ranking = sorted(
+            [entry for entry in counts if entry[0]], key=lambda entry: -entry[0]
+        )
+        if not ranking:
+            return await self.send_message(
+                chat_id=chat.id, text=f"Nobody wrote anything ({period})"
+            )
+
+        total = chat.activity.count(period, now)
+        lines = [
+            f"{index}. {name} ({count}/{total})"
+            for index, (count, name) in enumerate(ranking[:20], start=1)
+        ]
+        return await self.send_message(chat_id=chat.id, text="\n".join(lines))
 
     async def send_created_message(
         self, update: Update, context: CallbackContext
@@ -459,6 +1143,11 @@ class Bot:
             text=f"Created {update.effective_chat.title}",  # type: ignore[union-attr]
         )
         chat.created_message_id = message.message_id
+        self.record_change(
+            journal.CHAT_UPDATED,
+            chat_id=chat.id,
+            fields={"created_message_id": message.message_id},
+        )
 
         return message
 
@@ -470,17 +1159,56 @@ class Bot:
 
         for member in update.effective_message.new_chat_members:  # type: ignore[union-attr]
             if member.id != self.application.bot.id:
-                chat.users.add(User.from_tuser(member))
+                if not await self.gatekeeper.enforce(chat, member):
+                    continue
+
+                new_user = User.from_tuser(member)
+                chat.add_user(new_user)
+                self.record_change(
+                    journal.USER_JOINED, chat_id=chat.id, user=new_user.serialize()
+                )
             else:
-                try:
-                    await self.update_hhh_message(
-                        context.chat_data["chat"],  # type: ignore[index]
-                        create_changelog=True,
-                    )
-                except BadRequest:
-                    self.logger.exception("Failed to update message", exc_info=True)
+                await self._announce_chat(update, context)
 
-                await self.send_created_message(update, context)
+    async def chat_member_update(
+        self, update: Update, context: CallbackContext
+    ) -> None:
+        """
+        Checks users joining a chat which only allows premium users.
+        Unlike `new_member` this also covers groups which hide join messages.
+        """
+        member_update = update.chat_member
+        if member_update is None:
+            return
+
+        chat = self.chats.get(member_update.chat.id)
+        if chat is None or not chat.premium_users_only:
+            return
+
+        joined = member_update.old_chat_member.status in (
+            ChatMember.LEFT,
+            ChatMember.BANNED,
+        ) and member_update.new_chat_member.status in (
+            ChatMember.MEMBER,
+            ChatMember.RESTRICTED,
+        )
+        if joined:
+            await self.gatekeeper.enforce(chat, member_update.new_chat_member.user)
+            self.save_state()
+
+    async def my_chat_member_update(
+        self, update: Update, context: CallbackContext
+    ) -> None:
+        """
+        The rights of the bot changed, the cached metadata may be incomplete now and invite links
+        may be created (again)
+        """
+        if update.my_chat_member:
+            chat_id = update.my_chat_member.chat.id
+            self.chat_metadata.invalidate(chat_id)
+            self.invite_links.rights_changed(
+                chat_id, update.my_chat_member.new_chat_member
+            )
 
     @Command()
     async def status(self, update: Update, context: CallbackContext):
@@ -499,25 +1227,128 @@ class Bot:
             datetime.now().strftime("%d-%m-%Y %H-%M-%S")
         )
 
+    @Command(main_admin=True)
+    async def show_dead_chats(self, update: Update, context: CallbackContext):
+        """
+        Dry run of the chat reaper, reports the unreachable chats without changing anything.
+        Checking every chat takes a while, the report is sent once it's done.
+        """
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message")
+
+        if self._dead_chats_check and not self._dead_chats_check.done():
+            return await message.reply_text("Already checking the chats")
+
+        self._dead_chats_check = self._start_background_task(
+            self._report_dead_chats(message)
+        )
+        return await message.reply_text("Checking the chats, the report follows")
+
+    async def _report_dead_chats(self, message: Message) -> None:
+        try:
+            results = await self.reaper.reap(dry_run=True)
+            if not results:
+                await message.reply_text("All chats are reachable")
+                return
+
+            await self._send_dead_chats(message, results)
+        except TelegramError:
+            self.logger.error("Failed reporting the dead chats", exc_info=True)
+
+    async def _send_dead_chats(
+        self, message: Message, results: list[ReapResult]
+    ) -> Message:
+        text = "\n".join(
+            [f"{len(results)} unreachable chats (id | title | reason)"]
+            + [str(result) for result in results]
+        )
+        if len(text) <= self.message_length:
+            return await message.reply_text(text, disable_web_page_preview=True)
+
+        return await message.reply_document(
+            io.BytesIO(text.encode("utf-8")), filename="dead_chats.txt"
+        )
+
+    @Command(main_admin=True)
+    async def trace_memory(self, update: Update, context: CallbackContext):
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message")
+
+        action = context.args[0].lower() if context.args else "status"
+        if action == "start":
+            started = self.memory.start()
+            return await message.reply_text(
+                "Started tracing" if started else "Already tracing"
+            )
+        elif action == "stop":
+            self.memory.stop()
+            return await message.reply_text("Stopped tracing")
+        elif action in ("snapshot", "diff"):
+            try:
+                report = await self.memory.report(
+                    self.chats.resident_chats(), self.search, diff=action == "diff"
+                )
+            except RuntimeError as e:
+                return await message.reply_text(f"{e}, use `/memory start`")
+
+            return await message.reply_document(
+                io.BytesIO(report.encode("utf-8")), filename=f"memory-{action}.txt"
+            )
+        elif action == "status":
+            return await message.reply_text(self.memory.status())
+
+        return await message.reply_text(
+            "Usage: /memory [start|snapshot|diff|stop|status]"
+        )
+
+    @Command(main_admin=True)
+    async def show_metrics(self, update: Update, context: CallbackContext):
+        text = self.metrics.render()
+        return await update.effective_message.reply_text(  # type: ignore[union-attr]
+            text[: self.message_length]
+        )
+
     @Command()
     async def get_data(self, update: Update, context: CallbackContext) -> Message:
         chat: Chat = context.chat_data["chat"]  # type: ignore[index]
-        data = [
-            _chat for _chat in self.state.get("chats", []) if _chat.get("id") == chat.id
-        ]
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message to reply to")
 
-        if data:
-            with tempfile.TemporaryFile() as temp:
-                temp.write(json.dumps(data[0]).encode("utf-8"))
-                temp.seek(0)
-                return await self.application.bot.send_document(
-                    chat_id=chat.id, document=temp, filename=f"{chat.title}.json"
-                )
-        else:
-            message = update.effective_message
-            if message is None:
-                raise ValueError("No message to reply to")
-            return await message.reply_text("Couldn't find any data for this chat.")
+        fmt = context.args[0].lower() if context.args else export.JSON
+        # taken on the event loop, so the export is consistent with the live chat
+        serialized_chat = chat.serialize()
+        try:
+            document = await asyncio.to_thread(export.export_chat, serialized_chat, fmt)
+        except export.ExportFormatError as e:
+            return await message.reply_text(str(e))
+
+        return await message.reply_document(
+            document=document, filename=export.export_filename(serialized_chat, fmt)
+        )
+
+    @Command(main_admin=True)
+    async def export_all(self, update: Update, context: CallbackContext) -> Message:
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message to reply to")
+
+        fmt = context.args[0].lower() if context.args else export.JSON
+        serialized_chats = self.chats.serialize()
+        try:
+            document = await asyncio.to_thread(
+                export.export_chats, serialized_chats, fmt
+            )
+        except export.ExportFormatError as e:
+            return await message.reply_text(str(e))
+
+        return await message.reply_document(
+            document=document,
+            filename=f"chats_{datetime.now():%Y-%m-%d}.zip",
+            caption=f"{len(serialized_chats)} chats",
+        )
 
     @Command(chat_admin=True)
     async def mute(self, update: Update, context: CallbackContext):
@@ -538,7 +1369,7 @@ class Bot:
             )
 
         username = context.args[0]
-        minutes = 15
+        minutes = self.mute_minutes
         reason = " ".join(context.args[2:])
 
         try:
@@ -555,7 +1386,9 @@ class Bot:
             user = next(filter(lambda x: x.name == username, chat.users))
         except StopIteration:
             self.logger.warning(
-                f"Couldn't find user {username} in users for chat {effective_message.chat_id}",
+                "Couldn't find user %s in users for chat %s",
+                username,
+                effective_message.chat_id,
                 exc_info=True,
             )
             return await effective_message.reply_text(
@@ -594,7 +1427,7 @@ class Bot:
                 try:
                     await self.unmute_user(chat.id, user)
                 except BadRequest:
-                    self.logger.error(f"Failed to unmute user ({user})")
+                    self.logger.error("Failed to unmute user (%s)", user)
 
             return
 
@@ -604,7 +1437,9 @@ class Bot:
             )
         except StopIteration:
             self.logger.warning(
-                f"Couldn't find user {username} in users for chat {effective_message.chat_id}",
+                "Couldn't find user %s in users for chat %s",
+                username,
+                effective_message.chat_id,
                 exc_info=True,
             )
             return await effective_message.reply_text(
@@ -654,7 +1489,9 @@ class Bot:
             user: User = next(filter(lambda x: x.name == username, chat.users))
         except StopIteration:
             self.logger.warning(
-                f"Couldn't find user {username} in users for chat {effective_message.chat_id}",
+                "Couldn't find user %s in users for chat %s",
+                username,
+                effective_message.chat_id,
                 exc_info=True,
             )
             return await effective_message.reply_text(
@@ -672,7 +1509,10 @@ class Bot:
                     message = f"{user.name} was kicked from chat"
                     message += f" due to {reason}." if reason else "."
                     self.logger.debug(message)
-                    chat.users.remove(user)
+                    chat.remove_user(user)
+                    self.record_change(
+                        journal.USER_LEFT, chat_id=chat.id, user_id=user.id
+                    )
                     return await effective_message.reply_text(message)
                 else:
                     message = f"{user.name} couldn't be kicked from chat"
@@ -686,6 +1526,7 @@ class Bot:
         if message is None:
             raise ValueError("No message")
         new_title = str(message.new_chat_title)
+        self.chat_metadata.invalidate(chat.id)
 
         return await self.update_hhh_message(
             chat, new_title=new_title, create_changelog=True
@@ -693,11 +1534,21 @@ class Bot:
 
     @Command()
     async def chat_created(self, update: Update, context: CallbackContext):
+        return await self._announce_chat(update, context)
+
+    async def _announce_chat(
+        self, update: Update, context: CallbackContext
+    ) -> Message | None:
+        """
+        Adds the chat to the HHH list and announces it, once per service message
+        """
+        chat: Chat = context.chat_data["chat"]  # type: ignore[index]
+        message_id = update.effective_message.message_id  # type: ignore[union-attr]
+        if not self.claim_effect(f"announce:{chat.id}:{message_id}"):
+            return None
+
         try:
-            await self.update_hhh_message(
-                context.chat_data["chat"],  # type: ignore[index]
-                create_changelog=True,
-            )
+            await self.update_hhh_message(chat, create_changelog=True)
         except BadRequest:
             self.logger.exception("Failed to update message", exc_info=True)
 
@@ -716,6 +1567,10 @@ class Bot:
 
         if _validate_invite_link(invite_link):
             chat.invite_link = invite_link
+            chat.created_invite_link = False
+            self.record_change(
+                journal.INVITE_LINK_CHANGED, chat_id=chat.id, invite_link=invite_link
+            )
 
             if await message.reply_text("Added (new) invite link"):
                 await self.update_hhh_message(context.chat_data["chat"])  # type: ignore[index]
@@ -745,7 +1600,9 @@ class Bot:
             return await message.reply_text("Provide a group name moron")
 
         try:
-            chat: Chat = [c for c in self.chats.values() if c.title == group_name][0]
+            chat: ChatSummary = [
+                c for c in self.chats.summaries() if c.title == group_name
+            ][0]
         except IndexError:
             return await message.reply_text("I don't know that group")
 
@@ -758,12 +1615,16 @@ class Bot:
     async def remove_invite_link(self, update: Update, context: CallbackContext):
         chat: Chat = context.chat_data["chat"]  # type: ignore[index]
         chat.invite_link = None
+        chat.created_invite_link = False
+        self.record_change(
+            journal.INVITE_LINK_CHANGED, chat_id=chat.id, invite_link=None
+        )
         return await self.update_hhh_message(context.chat_data["chat"])  # type: ignore[index]
 
     @Command()
     async def migrate_chat_id(self, update: Update, context: CallbackContext):
         message = update.effective_message
-        self.logger.debug(f"Migrating {message}")
+        self.logger.debug("Migrating %s", message)
         if not message or not message.migrate_from_chat_id:
             self.logger.warning(
                 "Aborting migration since `migrate_from_chat_id` is unset, see #49"
@@ -773,16 +1634,26 @@ class Bot:
         from_id = int(message.migrate_from_chat_id)
         to_id = int(message.chat.id)
 
-        self.logger.debug(f"Update chat_id to {to_id} (was: {from_id})")
+        self.logger.debug("Update chat_id to %s (was: %s)", to_id, from_id)
         new_chat = context.chat_data["chat"]  # type: ignore[index]
         new_chat.id = to_id
 
         context.chat_data["chat"] = new_chat  # type: ignore[index]
         self.chats[to_id] = new_chat
         self.chats.pop(from_id)
+        self.search.migrate(from_id, to_id)
+        self.chat_metadata.pop(from_id)
+        self.chat_metadata.invalidate(to_id)
+        self.record_change(journal.CHAT_MIGRATED, from_id=from_id, to_id=to_id)
 
     @Command()
     async def renew_diff_message(self, update: Update, context: CallbackContext):
+        if self.shard_link:
+            return await self.shard_link.publish(
+                context.chat_data["chat"],  # type: ignore[index]
+                renew=True,
+            )
+
         self.group_message_ids = []
         # retry doesn't update the recent changes
         return await self.update_hhh_message(context.chat_data["chat"])  # type: ignore[index]
@@ -804,10 +1675,99 @@ class Bot:
             state = context.args[0].lower() == "true"
 
         chat.premium_users_only = state
+        self.record_change(
+            journal.CHAT_UPDATED,
+            chat_id=chat.id,
+            fields={"premium_users_only": state},
+        )
 
-        msg = "non premium-users will be kicked from this group when they interact with this chat again"
+        msg = "non premium-users will be kicked from this group when they join or interact with this chat again (use /sweep_non_premium to check existing members)"
         return await self.send_message(chat_id=chat.id, text=msg)
 
+    @Command(chat_admin=True)
+    async def set_spam_thresholds(self, update: Update, context: CallbackContext):
+        chat: Chat = context.chat_data["chat"]  # type: ignore[index]
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message")
+
+        args = context.args or []
+        if not args:
+            thresholds = chat.spam_thresholds or self.default_spam_thresholds
+            return await message.reply_text(
+                f"Spam thresholds: {thresholds}"
+                if thresholds
+                else "Spam detection is off"
+            )
+
+        if args == ["off"]:
+            thresholds = SpamThresholds(rate=0, same=0, consecutive=0)
+        elif args == ["default"]:
+            thresholds = None
+        else:
+            values = (chat.spam_thresholds or SpamThresholds()).serialize()
+            for arg in args:
+                key, _, value = arg.partition("=")
+                if key not in SpamThresholds.FIELDS or not value:
+                    return await message.reply_text(
+                        f"Use `off`, `default` or <key>=<value> with the keys {', '.join(SpamThresholds.FIELDS)}"
+                    )
+                values[key] = value
+            try:
+                thresholds = SpamThresholds.deserialize(values)
+            except ValueError as e:
+                return await message.reply_text(str(e))
+
+        chat.spam_thresholds = thresholds
+        self.record_change(
+            journal.CHAT_UPDATED,
+            chat_id=chat.id,
+            fields={"spam_thresholds": thresholds.serialize() if thresholds else None},
+        )
+
+        return await message.reply_text(
+            f"Spam thresholds: {thresholds or self.default_spam_thresholds or 'off'}"
+        )
+
+    @Command(chat_admin=True)
+    async def sweep_non_premium(self, update: Update, context: CallbackContext):
+        chat: Chat = context.chat_data["chat"]  # type: ignore[index]
+        message = update.effective_message
+        if message is None:
+            raise ValueError("No message")
+
+        if not chat.premium_users_only:
+            return await message.reply_text(
+                "This chat allows non premium-users, see /set_premium_users_only"
+            )
+        if self.gatekeeper.is_sweeping(chat):
+            return await message.reply_text("Already checking the users of this chat")
+
+        status_message = await message.reply_text(f"Checking {len(chat.users)} users")
+
+        async def _report(text: str) -> None:
+            try:
+                await status_message.edit_text(text)
+            except BadRequest:
+                self.logger.debug("Couldn't update sweep progress", exc_info=True)
+
+        self.application.create_task(
+            self.gatekeeper.sweep(chat, _report), update=update
+        )
+        return status_message
+
+
+def _message_content(message: Message) -> str | None:
+    if message.text or message.caption:
+        return message.text or message.caption
+
+    attachment = message.effective_attachment
+    # photos are a tuple of sizes
+    if isinstance(attachment, tuple):
+        attachment = attachment[-1] if attachment else None
+
+    return getattr(attachment, "file_unique_id", None)
+
 
 def _split_messages(lines):
     message_length = 4096
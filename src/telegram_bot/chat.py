@@ -6,12 +6,13 @@ from typing import Any
 
 from telegram import Bot as TBot
 from telegram import Chat as TChat
-from telegram import ChatPermissions, Message, Update
+from telegram import Message, Update
 from telegram.error import TelegramError
 
 from .decorators import group
-from .logger import create_logger
-from .user import User
+from .logger import ChatLoggerAdapter, chat_logger, create_logger
+from .spam import SpamThresholds
+from .user import Activity, User
 
 
 class ChatType(Enum):
@@ -42,19 +43,32 @@ class ChatType(Enum):
 
 class Chat:
     def __init__(self, _id: str | int, bot: TBot):
-        self.logger = create_logger(f"chat_{_id}")
-        self.logger.debug("Create chat")
         self.pinned_message_id: int | None = None
         self.id: int = int(_id)
+        self.logger.debug("Create chat")
         self.bot: TBot = bot
         self.users: set[User] = set()
         self.title: str | None = None
         self.type = ChatType.UNDEFINED
         self.invite_link: str | None = None
+        # `invite_link` has been created by the bot, it's replaced once it's revoked
+        self.created_invite_link = False
         self.description: str | None = None
         self.last_chat_event_time: datetime | None = None
         self.created_message_id: int | None = None
         self.premium_users_only = False
+        # `None` uses the default of the bot
+        self.spam_thresholds: SpamThresholds | None = None
+        # messages of all users
+        self.activity = Activity()
+        # changes whenever users join or leave, invalidates everything derived from `users`
+        self.users_version = 0
+        self._sorted_users: tuple[int, list[User]] | None = None
+
+    @property
+    def logger(self) -> ChatLoggerAdapter:
+        # the id changes when migrating to a supergroup
+        return chat_logger(self.id)
 
     def get_user_by_id(self, _id: int) -> User | None:
         result = next(filter(lambda user: user.id == _id, self.users), None)
@@ -75,17 +89,41 @@ class Chat:
             "users": [user.serialize() for user in self.users],
             "title": self.title,
             "invite_link": self.invite_link,
+            "created_invite_link": self.created_invite_link,
             "description": self.description,
             "type": chat_type.serialize(),
             "last_chat_event_isotime": last_chat_event_isotime,
             "created_message_id": self.created_message_id,
             "premium_users_only": self.premium_users_only,
+            "activity": self.activity.serialize(),
+            "spam_thresholds": (
+                self.spam_thresholds.serialize() if self.spam_thresholds else None
+            ),
         }
 
         return serialized
 
     def add_user(self, user: User):
-        self.users.add(user)
+        if user not in self.users:
+            self.users.add(user)
+            self.users_version += 1
+
+    def remove_user(self, user: User) -> None:
+        if user in self.users:
+            self.users.remove(user)
+            self.users_version += 1
+
+    def sorted_users(self) -> list[User]:
+        """
+        The users sorted by name, only sorted again after users joined or left
+        """
+        if self._sorted_users and self._sorted_users[0] == self.users_version:
+            return self._sorted_users[1]
+
+        sorted_users = sorted(self.users, key=lambda _user: _user.name)
+        self._sorted_users = (self.users_version, sorted_users)
+
+        return sorted_users
 
     @classmethod
     def deserialize(cls, json_object: dict, bot: TBot) -> Chat | None:
@@ -102,12 +140,20 @@ class Chat:
         }
         chat.title = json_object.get("title", None)
         chat.invite_link = json_object.get("invite_link", None)
+        chat.created_invite_link = bool(json_object.get("created_invite_link", False))
         chat.description = json_object.get("description", None)
         chat.type = ChatType.deserialize(json_object.get("type", ""))
         chat.created_message_id = json_object.get("created_message_id", None)
         if last_chat_event_time := json_object.get("last_chat_event_isotime"):
             chat.last_chat_event_time = datetime.fromisoformat(last_chat_event_time)
         chat.premium_users_only = bool(json_object.get("premium_users_only", False))
+        chat.activity = Activity.deserialize(json_object.get("activity"))
+        if spam_thresholds := json_object.get("spam_thresholds"):
+            try:
+                chat.spam_thresholds = SpamThresholds.deserialize(spam_thresholds)
+            except ValueError as e:
+                # stored before the thresholds were validated, the defaults apply
+                chat.logger.warning("Ignoring invalid spam thresholds: %s", e)
 
         return chat
 
@@ -127,11 +173,11 @@ class Chat:
                 disable_notification=disable_notifications,
             )
         except TelegramError as e:
-            self.logger.error(f"Couldn't pin message due to error: {e}")
+            self.logger.error("Couldn't pin message due to error: %s", e)
 
         if successful_pin:
             self.pinned_message_id = message_id
-            self.logger.debug(f"Successfully pinned message: {message_id}")
+            self.logger.debug("Successfully pinned message: %s", message_id)
             return True
         else:
             self.logger.warning("Pinning message failed")
@@ -144,7 +190,7 @@ class Chat:
         try:
             successful_unpin = await self.bot.unpin_chat_message(chat_id=self.id)
         except TelegramError as e:
-            self.logger.error(f"Couldn't unpin message due to error: {e}")
+            self.logger.error("Couldn't unpin message due to error: %s", e)
 
         if successful_unpin:
             self.logger.info("Successfully unpinned message")
@@ -161,12 +207,11 @@ class Chat:
         :raises: TelegramError Raises TelegramError if the message couldn't be sent
         :return:
         """
-        message = " | ".join([f"{key}: {val}" for key, val in kwargs.items()])
-        self.logger.info(f"Send message with: {message}")
+        self.logger.debug("Send message with: %s", kwargs)
 
         result = await self.bot.send_message(chat_id=self.id, **kwargs)
 
-        self.logger.info(f"Result of sending message: {result}")
+        self.logger.debug("Result of sending message: %s", result)
         return result
 
     @group
@@ -202,6 +247,9 @@ class Chat:
         user = self.get_user_by_id(update.effective_user.id)  # type: ignore[union-attr]
 
         user.messages.add(update.effective_message)  # type: ignore[arg-type, union-attr]
+        now = datetime.now()
+        user.activity.record(now)  # type: ignore[union-attr]
+        self.activity.record(now)
 
     def messages(self) -> list[Message]:
         messages: list[Message] = []
@@ -224,9 +272,3 @@ class Chat:
                 return f"{self.title}"
         except AttributeError:
             return f"{self.title}"
-
-    async def permissions(self) -> ChatPermissions:
-        chat = await self.bot.get_chat(self.id)
-        if permissions := chat.permissions:
-            return permissions
-        raise ValueError("Missing chat.permissions despite library docs")
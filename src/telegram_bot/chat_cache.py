@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator, MutableMapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any
+
+from telegram import Bot as TBot
+
+from . import snapshot
+from .chat import Chat, ChatType
+from .logger import create_logger
+
+
+class ChatSummary:
+    """
+    The parts of a chat needed for the HHH list, kept in memory for evicted chats
+    """
+
+    __slots__ = ("id", "title", "invite_link", "type", "created_invite_link")
+
+    def __init__(
+        self,
+        _id: int,
+        title: str | None,
+        invite_link: str | None,
+        _type: ChatType,
+        created_invite_link: bool = False,
+    ):
+        self.id = _id
+        self.title = title
+        self.invite_link = invite_link
+        self.type = _type
+        self.created_invite_link = created_invite_link
+
+    @classmethod
+    def from_chat(cls, chat: Chat) -> ChatSummary:
+        return cls(
+            chat.id, chat.title, chat.invite_link, chat.type, chat.created_invite_link
+        )
+
+    @classmethod
+    def from_serialized(cls, json_object: dict[str, Any]) -> ChatSummary:
+        return cls(
+            int(json_object["id"]),
+            json_object.get("title"),
+            json_object.get("invite_link"),
+            ChatType.deserialize(json_object.get("type", "")),
+            bool(json_object.get("created_invite_link", False)),
+        )
+
+    def serialize(self) -> dict[str, Any]:
+        chat_type = (
+            self.type if isinstance(self.type, ChatType) else ChatType(self.type)
+        )
+        return {
+            "id": self.id,
+            "title": self.title,
+            "invite_link": self.invite_link,
+            "type": chat_type.serialize(),
+            "created_invite_link": self.created_invite_link,
+        }
+
+    def is_group(self) -> bool:
+        return self.type in [ChatType.GROUP, ChatType.SUPERGROUP]
+
+    def to_message_entry(self) -> str:
+        if self.invite_link:
+            return f'<a href="{self.invite_link}">{self.title}</a>'
+        else:
+            return f"{self.title}"
+
+    def __repr__(self) -> str:
+        return f"<{self.id} | {self.title}>"
+
+
+class ChatCache(MutableMapping[int, Chat]):
+    """
+    Mapping of chat ids to chats which only keeps recently active chats in memory.
+
+    Evicted chats are kept as their compactly encoded serialization (see `snapshot`) and
+    a `ChatSummary`, accessing them materializes a full `Chat` again.
+    Note that `User.messages` isn't serialized and therefore dropped on eviction.
+    Chats which are in use across an `await` have to be `pinned`, otherwise changes could be
+    made to a chat which has been evicted in the meantime.
+    """
+
+    def __init__(
+        self,
+        bot: TBot,
+        max_resident: int = 0,
+        idle_timeout: timedelta | None = None,
+        on_evict: Callable[[int], None] | None = None,
+    ):
+        """
+        :param bot: TBot Passed to materialized chats
+        :param max_resident: int Maximum number of materialized chats, 0 for no limit
+        :param idle_timeout: timedelta Chats without events for this long are evicted by `evict_idle`
+        :param on_evict: Callable[[int], None] Called with the chat id of every evicted chat
+        """
+        self.logger = create_logger("chat_cache")
+        self.bot = bot
+        self.max_resident = max_resident
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self._resident: OrderedDict[int, Chat] = OrderedDict()
+        self._evicted: dict[int, snapshot.EncodedChat] = {}
+        self._summaries: dict[int, ChatSummary] = {}
+        # chat id -> number of users of the chat
+        self._pins: dict[int, int] = {}
+
+    def __getitem__(self, chat_id: int) -> Chat:
+        chat = self._resident.get(chat_id)
+        if chat is not None:
+            self._resident.move_to_end(chat_id)
+            return chat
+
+        serialized = self._evicted[chat_id].decode()
+        chat = Chat.deserialize(serialized, self.bot)  # type: ignore[assignment]
+        if chat is None:
+            raise KeyError(chat_id)
+
+        self.logger.debug("Materialized chat %s", chat)
+        del self._evicted[chat_id]
+        del self._summaries[chat_id]
+        self._resident[chat_id] = chat
+        self._enforce_limit()
+
+        return chat
+
+    def __setitem__(self, chat_id: int, chat: Chat) -> None:
+        self._evicted.pop(chat_id, None)
+        self._summaries.pop(chat_id, None)
+        self._resident[chat_id] = chat
+        self._resident.move_to_end(chat_id)
+        self._enforce_limit()
+
+    def __delitem__(self, chat_id: int) -> None:
+        if chat_id in self._resident:
+            del self._resident[chat_id]
+        else:
+            del self._evicted[chat_id]
+            del self._summaries[chat_id]
+
+    def __contains__(self, chat_id: object) -> bool:
+        return chat_id in self._resident or chat_id in self._evicted
+
+    def __iter__(self) -> Iterator[int]:
+        yield from list(self._resident)
+        yield from list(self._evicted)
+
+    def __len__(self) -> int:
+        return len(self._resident) + len(self._evicted)
+
+    @property
+    def resident_count(self) -> int:
+        return len(self._resident)
+
+    def resident_chats(self) -> list[Chat]:
+        return list(self._resident.values())
+
+    def resident(self, chat_id: int) -> Chat | None:
+        """
+        The chat if it's materialized, without materializing it or marking it as used
+        """
+        return self._resident.get(chat_id)
+
+    def summary(self, chat_id: int) -> ChatSummary | None:
+        """
+        The summary of a chat without materializing it
+        """
+        chat = self._resident.get(chat_id)
+        if chat is not None:
+            return ChatSummary.from_chat(chat)
+
+        return self._summaries.get(chat_id)
+
+    def summaries(self) -> list[ChatSummary]:
+        """
+        Summaries of all chats without materializing evicted chats
+        """
+        return [ChatSummary.from_chat(chat) for chat in self._resident.values()] + list(
+            self._summaries.values()
+        )
+
+    def serialize(self) -> list[dict[str, Any]]:
+        """
+        `Chat.serialize` of all chats without materializing evicted chats
+        """
+        return [chat.serialize() for chat in self._resident.values()] + [
+            encoded.decode() for encoded in self._evicted.values()
+        ]
+
+    def serialize_encoded(self) -> list[dict[str, Any] | snapshot.EncodedChat]:
+        """
+        Like `serialize`, but evicted chats stay encoded (see `snapshot.dumps`)
+        """
+        return [chat.serialize() for chat in self._resident.values()] + list(
+            self._evicted.values()
+        )
+
+    @contextmanager
+    def pinned(self, chat_id: int | None) -> Iterator[None]:
+        """
+        The chat isn't evicted until the context is left
+        """
+        if chat_id is None:
+            yield
+            return
+
+        self._pins[chat_id] = self._pins.get(chat_id, 0) + 1
+        try:
+            yield
+        finally:
+            count = self._pins.pop(chat_id) - 1
+            if count:
+                self._pins[chat_id] = count
+
+    def load(self, serialized_chats: Iterable[dict[str, Any]]) -> None:
+        """
+        Replaces the content with the given serialized chats, idle chats aren't materialized
+        """
+        self._resident.clear()
+        self._evicted.clear()
+        self._summaries.clear()
+
+        now = datetime.now()
+        for serialized in serialized_chats:
+            try:
+                summary = ChatSummary.from_serialized(serialized)
+            except (KeyError, TypeError, ValueError):
+                self.logger.error("Invalid chat id in %s", serialized.get("id"))
+                continue
+
+            last_event = serialized.get("last_chat_event_isotime")
+            last_event_time = datetime.fromisoformat(last_event) if last_event else None
+            muted = any(user.get("muted") for user in serialized.get("users", []))
+            if not muted and self._is_idle(last_event_time, now):
+                self._store(summary, serialized)
+            else:
+                chat = Chat.deserialize(serialized, self.bot)
+                if chat is not None:
+                    self._resident[chat.id] = chat
+
+        self._enforce_limit()
+        self.logger.info(
+            "Loaded %s chats (%s materialized)", len(self), self.resident_count
+        )
+
+    def evict(self, chat_id: int) -> bool:
+        chat = self._resident.get(chat_id)
+        if chat is None or not self._is_evictable(chat):
+            return False
+
+        del self._resident[chat_id]
+        self._store(ChatSummary.from_chat(chat), chat.serialize())
+        self.logger.debug("Evicted chat %s", chat)
+        if self.on_evict:
+            self.on_evict(chat_id)
+
+        return True
+
+    def evict_idle(self, now: datetime | None = None) -> int:
+        """
+        Evicts every chat which didn't have an event within `idle_timeout`
+        :return: int Number of evicted chats
+        """
+        now = now or datetime.now()
+        idle_chat_ids = [
+            chat_id
+            for chat_id, chat in self._resident.items()
+            if self._is_idle(chat.last_chat_event_time, now)
+        ]
+
+        return sum(self.evict(chat_id) for chat_id in idle_chat_ids)
+
+    def _store(self, summary: ChatSummary, serialized: dict[str, Any]) -> None:
+        self._evicted[summary.id] = snapshot.EncodedChat.encode(serialized)
+        self._summaries[summary.id] = summary
+
+    def _is_idle(self, last_event_time: datetime | None, now: datetime) -> bool:
+        if self.idle_timeout is None:
+            return False
+
+        return last_event_time is None or now - last_event_time > self.idle_timeout
+
+    def _is_evictable(self, chat: Chat) -> bool:
+        # pending mute resets hold references to the user objects
+        return chat.id not in self._pins and not any(user.muted for user in chat.users)
+
+    def _enforce_limit(self) -> None:
+        if not self.max_resident or len(self._resident) <= self.max_resident:
+            return
+
+        # least recently used first, the most recently used chat is never evicted
+        for chat_id in list(self._resident)[:-1]:
+            if len(self._resident) <= self.max_resident:
+                break
+            self.evict(chat_id)
@@ -1,24 +1,348 @@
+"""
+Typed settings which can be changed while the bots are running.
+
+Every setting is read from the environment (upper case name) and from the JSON object in
+`CONFIG_FILE` (lower case name), the file takes precedence. The file is read again when it
+changes and on `SIGHUP`; if it's invalid, the previous settings are kept.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
 import json
+import os
+from collections.abc import Callable
 from json import JSONDecodeError
+from typing import Any
 
 from .logger import create_logger
+from .spam import SpamThresholds
+from .state import FsyncPolicy
+
+DEFAULT_HHH_ID = -1001473841450
+
+
+class ConfigError(ValueError):
+    pass
 
 
 class Config(dict):  # type: ignore[type-arg]
-    def __init__(self, filename: str, **kwargs):
+    def __init__(self, filename: str, strict: bool = False, **kwargs):
+        """
+        :param strict: bool Raise a `ConfigError` instead of logging it if the file can't be read
+        """
+        super().__init__(**kwargs)
         logger = create_logger("config")
         try:
-            logger.debug(f"Open {filename}")
+            logger.debug("Open %s", filename)
             with open(filename, "r") as file:
                 logger.debug("Load file content as json")
                 content = json.load(file)
                 logger.debug("Update config")
                 self.update(content)
-        except OSError:
-            logger.error(f"Couldn't open {filename} due to an OS error", exc_info=True)
-        except JSONDecodeError:
+        except OSError as e:
+            if strict:
+                raise ConfigError(f"Couldn't open {filename} ({e})") from e
+            logger.error("Couldn't open %s due to an OS error", filename, exc_info=True)
+        except (JSONDecodeError, TypeError, ValueError) as e:
+            if strict:
+                raise ConfigError(f"{filename} isn't a JSON object ({e})") from e
             logger.error(
-                f"Couldn't open {filename} due to json decoding error", exc_info=True
+                "Couldn't open %s due to json decoding error", filename, exc_info=True
             )
 
-        super().__init__(**kwargs)
+
+def _integer(value: Any) -> int:
+    """
+    Values of the environment are strings, values of the file have to be of the right type
+    """
+    if isinstance(value, str):
+        return int(value)
+    # `bool` is a subclass of `int`
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(f"has to be an integer, not {json.dumps(value)}")
+
+    return value
+
+
+def _number(value: Any) -> float:
+    if isinstance(value, str):
+        return float(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"has to be a number, not {json.dumps(value)}")
+
+    return float(value)
+
+
+def _boolean(value: Any) -> bool:
+    if isinstance(value, str):
+        if value.strip().lower() in ("1", "true"):
+            return True
+        if value.strip().lower() in ("", "0", "false"):
+            return False
+        raise ValueError(f"has to be true or false, not `{value}`")
+    if not isinstance(value, bool):
+        raise TypeError(f"has to be a boolean, not {json.dumps(value)}")
+
+    return value
+
+
+def _choice(*choices: str) -> Callable[[Any], str]:
+    def parse(value: Any) -> str:
+        if not isinstance(value, str):
+            raise TypeError(f"has to be a string, not {json.dumps(value)}")
+        if value.strip().lower() not in choices:
+            raise ValueError(f"has to be one of {', '.join(choices)}")
+
+        return value.strip().lower()
+
+    return parse
+
+
+def _main_admin_ids(value: Any) -> set[int]:
+    """
+    Malformed ids are logged and ignored instead of being an error, so a typo doesn't keep the
+    bots from starting (they run without main admins then)
+    """
+    logger = create_logger("config")
+    try:
+        id_list = json.loads(value) if isinstance(value, str) else value
+    except ValueError:
+        logger.error("main_admin_ids isn't JSON: %s", value)
+        return set()
+    if not isinstance(id_list, list):
+        logger.error("main_admin_ids isn't a JSON list: %s", json.dumps(id_list))
+        return set()
+
+    result = set()
+    for main_admin_id in id_list:
+        try:
+            result.add(_integer(main_admin_id))
+        except (TypeError, ValueError):
+            logger.error("Not a valid user ID: %s", main_admin_id)
+
+    return result
+
+
+def _spam_thresholds(value: Any) -> SpamThresholds:
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not isinstance(value, dict):
+        raise ValueError("not a JSON object")
+    for field, field_value in value.items():
+        if field not in SpamThresholds.FIELDS:
+            raise ValueError(f"unknown threshold `{field}`")
+        try:
+            (_number if field == "window" else _integer)(field_value)
+        except TypeError as e:
+            raise TypeError(f"`{field}` {e}") from e
+
+    return SpamThresholds.deserialize(value)
+
+
+_fsync_mode = _choice(FsyncPolicy.ALWAYS, FsyncPolicy.INTERVAL, FsyncPolicy.NEVER)
+
+
+class Setting:
+    def __init__(
+        self,
+        name: str,
+        parse: Callable[[Any], Any],
+        default: Any,
+        minimum: float | None = None,
+        maximum: float | None = None,
+    ):
+        self.name = name
+        self.parse = parse
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def read(self, file_values: dict[str, Any]) -> Any:
+        raw_value = file_values.get(self.name, os.getenv(self.name.upper()))
+        if raw_value is None:
+            return copy.copy(self.default)
+
+        value = self.parse(raw_value)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"has to be at least {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"has to be at most {self.maximum}")
+
+        return value
+
+
+SETTINGS = (
+    # `main_admin_ids` of tenants take precedence
+    Setting("main_admin_ids", _main_admin_ids, set()),
+    # only read on startup, `hhh_id` of tenants takes precedence
+    Setting("hhh_id", _integer, DEFAULT_HHH_ID),
+    Setting("mute_minutes", _integer, 15, minimum=1),
+    Setting("message_length", _integer, 4096, minimum=100, maximum=4096),
+    Setting("users_page_size", _integer, 40, minimum=1),
+    Setting("search_messages_per_chat", _integer, 0, minimum=0),
+    Setting("recent_update_ids", _integer, 10000, minimum=1),
+    # the default matches the number of updates fetched at once
+    Setting("update_redelivery_window", _integer, 100, minimum=0),
+    Setting("effect_keys", _integer, 1000, minimum=1),
+    Setting("spam_detection", _boolean, False),
+    # used for chats without their own thresholds
+    Setting("spam_thresholds", _spam_thresholds, SpamThresholds()),
+    Setting("spam_max_users_per_chat", _integer, 1000, minimum=1),
+    Setting("update_shed_threshold", _integer, 1000, minimum=0),
+    Setting("update_shed_sample_rate", _number, 0.1, minimum=0, maximum=1),
+    Setting("gatekeeping_verdict_ttl", _number, 3600, minimum=0),
+    Setting("chat_cache_size", _integer, 1000, minimum=0),
+    Setting("chat_idle_eviction", _number, 7 * 24 * 60 * 60, minimum=0),
+    Setting("chat_eviction_interval", _number, 600, minimum=0),
+    Setting("chat_metadata_ttl", _number, 3600, minimum=0),
+    Setting("chat_metadata_refresh_interval", _number, 60, minimum=1),
+    Setting("chat_metadata_batch_size", _integer, 20, minimum=1),
+    Setting("invite_link_refresh_interval", _number, 3600, minimum=1),
+    Setting("invite_link_max_attempts", _integer, 5, minimum=1),
+    Setting("invite_link_backoff", _number, 30, minimum=0),
+    Setting("hhh_update_batch_delay", _number, 5, minimum=0),
+    Setting("state_fsync", _fsync_mode, FsyncPolicy.ALWAYS),
+    Setting("state_fsync_interval", _number, 1, minimum=0),
+    Setting("state_journal_fsync", _fsync_mode, FsyncPolicy.INTERVAL),
+    Setting("state_compaction_interval", _number, 300, minimum=1),
+    Setting("state_compaction_threshold", _integer, 1000, minimum=1),
+    Setting("chat_reaper_interval", _number, 24 * 60 * 60, minimum=0),
+    Setting("chat_reaper_concurrency", _integer, 5, minimum=1),
+    Setting("chat_reaper_grace_period", _number, 7 * 24 * 60 * 60, minimum=0),
+)
+
+
+class Settings:
+    main_admin_ids: set[int]
+    hhh_id: int
+    mute_minutes: int
+    message_length: int
+    users_page_size: int
+    search_messages_per_chat: int
+    recent_update_ids: int
+    update_redelivery_window: int
+    effect_keys: int
+    spam_detection: bool
+    spam_thresholds: SpamThresholds
+    spam_max_users_per_chat: int
+    update_shed_threshold: int
+    update_shed_sample_rate: float
+    gatekeeping_verdict_ttl: float
+    chat_cache_size: int
+    chat_idle_eviction: float
+    chat_eviction_interval: float
+    chat_metadata_ttl: float
+    chat_metadata_refresh_interval: float
+    chat_metadata_batch_size: int
+    invite_link_refresh_interval: float
+    invite_link_max_attempts: int
+    invite_link_backoff: float
+    hhh_update_batch_delay: float
+    state_fsync: str
+    state_fsync_interval: float
+    state_journal_fsync: str
+    state_compaction_interval: float
+    state_compaction_threshold: int
+    chat_reaper_interval: float
+    chat_reaper_concurrency: int
+    chat_reaper_grace_period: float
+
+    def __init__(self, values: dict[str, Any]):
+        for setting in SETTINGS:
+            setattr(self, setting.name, values[setting.name])
+
+    @classmethod
+    def load(cls, filename: str | None = None) -> Settings:
+        """
+        :raises: ConfigError if the file can't be read or a setting is invalid
+        """
+        file_values = Config(filename, strict=True) if filename else {}
+        errors = [
+            f"unknown setting `{name}`"
+            for name in file_values
+            if name not in {setting.name for setting in SETTINGS}
+        ]
+        values = {}
+        for setting in SETTINGS:
+            try:
+                values[setting.name] = setting.read(file_values)
+            except (TypeError, ValueError) as e:
+                errors.append(f"`{setting.name}` {e}")
+
+        if errors:
+            raise ConfigError(f"Invalid settings: {', '.join(errors)}")
+
+        return cls(values)
+
+    def changed(self, other: Settings) -> list[str]:
+        return [
+            setting.name
+            for setting in SETTINGS
+            if getattr(self, setting.name) != getattr(other, setting.name)
+        ]
+
+
+class LiveConfig:
+    """
+    The current settings, reloaded when `filename` changes (checked every `poll_interval`
+    seconds) or `reload` is called
+    """
+
+    def __init__(self, filename: str | None = None, poll_interval: float = 5):
+        self.logger = create_logger("live_config")
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.settings = Settings.load(filename)
+        self._modified_at = self._modification_time()
+        self._listeners: list[Callable[[Settings], None]] = []
+
+    @classmethod
+    def from_env(cls) -> LiveConfig:
+        return cls(
+            os.getenv("CONFIG_FILE"), float(os.getenv("CONFIG_POLL_INTERVAL", 5))
+        )
+
+    def subscribe(self, listener: Callable[[Settings], None]) -> None:
+        """
+        Calls `listener` with the current settings and whenever they changed
+        """
+        self._listeners.append(listener)
+        listener(self.settings)
+
+    def reload(self) -> bool:
+        """
+        :return: bool `False` if the settings are invalid and have been ignored
+        """
+        try:
+            settings = Settings.load(self.filename)
+        except ConfigError as e:
+            self.logger.error("Keeping the previous settings: %s", e)
+            return False
+
+        changed = self.settings.changed(settings)
+        self.settings = settings
+        if changed:
+            self.logger.info("Changed settings: %s", ", ".join(changed))
+            for listener in self._listeners:
+                listener(settings)
+
+        return True
+
+    def _modification_time(self) -> float | None:
+        if not self.filename:
+            return None
+
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            modified_at = self._modification_time()
+            if modified_at != self._modified_at:
+                self._modified_at = modified_at
+                self.reload()
@@ -5,10 +5,9 @@ import inspect
 from datetime import datetime, timedelta
 
 from telegram import Update
-from telegram.error import BadRequest, TelegramError
 from telegram.ext import CallbackContext
 
-from . import bot, chat, logger, user
+from . import bot, chat, journal, logger, user
 
 
 class Command:
@@ -22,19 +21,20 @@ class Command:
         effective_chat = update.effective_chat
         if effective_chat is None:
             raise ValueError("No effective chat")
-        log.debug(f"Start with {effective_chat.id}")
+        log.debug("Start with %s", effective_chat.id)
         new_chat = clazz.chats.get(effective_chat.id)
         if new_chat is None:
             log.debug("Creating new chat")
             new_chat = chat.Chat(effective_chat.id, clazz.application.bot)
             new_chat.title = effective_chat.title
             clazz.chats[new_chat.id] = new_chat
+            clazz.record_change(journal.CHAT_ADDED, chat=new_chat.serialize())
 
-            log.debug(f"Created new chat ({new_chat})")
+            log.debug("Created new chat (%s)", new_chat)
 
         context.chat_data["chat"] = new_chat  # type: ignore[index]
 
-        log.debug(f"End with {new_chat}")
+        log.debug("End with %s", new_chat)
         return new_chat
 
     @staticmethod
@@ -42,14 +42,40 @@ class Command:
         return user.User.from_tuser(update.effective_user)  # type: ignore[arg-type]
 
     def __call__(self, func):
+        signature = inspect.signature(func)
+
         @functools.wraps(func)
         async def wrapped_f(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            update: Update | None = arguments.get("update")
+            if not update:
+                return await handle(*args, **kwargs)
+
+            clazz: bot.Bot = arguments["self"]
+            clazz.metrics.inc(
+                "hhh_updates_total", tenant=clazz.tenant.name, handler=func.__name__
+            )
+
+            tokens = logger.set_log_context(
+                update.effective_chat.id if update.effective_chat else None,
+                update.effective_user.id if update.effective_user else None,
+                func.__name__,
+            )
+            try:
+                # the chat must not be evicted while the handler awaits something
+                with clazz.chats.pinned(
+                    update.effective_chat.id if update.effective_chat else None
+                ):
+                    return await handle(*args, **kwargs)
+            finally:
+                logger.reset_log_context(tokens)
+
+        async def handle(*args, **kwargs):
             exception = None
             log = logger.create_logger(f"command_{func.__name__}")
             log.debug("Start")
-            log.debug(f"args: {args} | kwargs: {kwargs}")
+            log.debug("args: %s | kwargs: %s", args, kwargs)
 
-            signature = inspect.signature(func)
             arguments = signature.bind(*args, **kwargs).arguments
 
             clazz: bot.Bot = arguments.get("self")
@@ -67,57 +93,60 @@ class Command:
 
                 return result
 
-            log.debug(f"message from user: {update.effective_user.first_name}")
+            log.debug("message from user: %s", update.effective_user.first_name)
             current_chat = context.chat_data.get("chat")
             if not current_chat:
                 current_chat = self._add_chat(clazz, update, context)
             if not current_chat.title:
                 log.debug(
-                    f"Assign title ({update.effective_chat.title}) to chat ({current_chat}) (previously missing)"
+                    "Assign title (%s) to chat (%s) (previously missing)",
+                    update.effective_chat.title,
+                    current_chat,
                 )
                 current_chat.title = update.effective_chat.title
+                clazz.record_change(
+                    journal.CHAT_RENAMED,
+                    chat_id=current_chat.id,
+                    title=current_chat.title,
+                )
             current_chat.last_chat_event_time = datetime.now()
 
             is_group_chat = current_chat.is_group()
-            log.debug(f"Checking for group chat: {is_group_chat}")
+            log.debug("Checking for group chat: %s", is_group_chat)
             if is_group_chat:
-                chat_admins = [
-                    admin.user.id
-                    for admin in await current_chat.bot.get_chat_administrators(
-                        chat_id=current_chat.id
-                    )
-                ]
-                bot_id = (await clazz.me()).id
-                bot_is_admin = bot_id in chat_admins
-                log.debug(f"bot id: {bot_id} | admin ids: {chat_admins}")
-                create_invite_link = not current_chat.invite_link and bot_is_admin
-                log.debug(
-                    f"invite link create decision: not {current_chat.invite_link} and {bot_is_admin} -> {create_invite_link}"
-                )
-                if create_invite_link:
-                    log.info(f"creating invite link for {current_chat.title}")
-                    try:
-                        current_chat.invite_link = (
-                            await update.effective_chat.create_invite_link()
-                        ).invite_link
-                        await clazz.update_hhh_message(current_chat)
-                    except BadRequest:
-                        log.exception(
-                            "failed creating invite link or updating message: ",
-                            exc_info=True,
-                        )
-                        pass
+                if not current_chat.invite_link:
+                    log.debug("Queue invite link creation for %s", current_chat)
+                    clazz.invite_links.enqueue(current_chat.id)
             else:
-                log.debug(f"chat is not a group chat ({current_chat.type})")
+                log.debug("chat is not a group chat (%s)", current_chat.type)
 
+            previous_type = current_chat.type
             current_chat.type = update.effective_chat.type
 
             if not clazz.chats.get(current_chat.id):
                 clazz.chats[current_chat.id] = current_chat
+                clazz.record_change(journal.CHAT_ADDED, chat=current_chat.serialize())
+            elif previous_type != current_chat.type or not update.effective_message:
+                # the event time of messages is part of `journal.USER_ACTIVE`
+                clazz.record_change(
+                    journal.CHAT_UPDATED,
+                    chat_id=current_chat.id,
+                    fields={
+                        "type": chat.ChatType.deserialize(
+                            current_chat.type
+                        ).serialize(),
+                        "last_chat_event_isotime": current_chat.last_chat_event_time.isoformat(),
+                    },
+                )
 
             current_user = current_chat.get_user_by_id(update.effective_user.id)
             if not current_user:
                 current_user = self._add_user(update, context)
+                clazz.record_change(
+                    journal.USER_JOINED,
+                    chat_id=current_chat.id,
+                    user=current_user.serialize(),
+                )
 
             current_chat.add_user(current_user)
             context.user_data["user"] = current_user
@@ -131,7 +160,7 @@ class Command:
                     await clazz.mute_user(
                         chat_id=current_chat.id,
                         user=current_user,
-                        until_date=timedelta(minutes=15),
+                        until_date=timedelta(minutes=clazz.mute_minutes),
                         reason=message,
                     )
                     exception = PermissionError()
@@ -145,7 +174,8 @@ class Command:
                     log.debug("Execute function due to coming from a private chat")
                 elif current_user in administrators:
                     log.debug(
-                        f"User ({current_user.name}) is a chat admin and therefore allowed to perform this action, executing"
+                        "User (%s) is a chat admin and therefore allowed to perform this action, executing",
+                        current_user.name,
                     )
                 elif (
                     update.effective_user.name == "@GroupAnonymousBot"
@@ -157,33 +187,32 @@ class Command:
                     log.debug("anonymous mode for admins is allowed")
                 else:
                     log.error(
-                        f"User ({current_user.name}) isn't a chat_admin and is not allowed to perform this action."
+                        "User (%s) isn't a chat_admin and is not allowed to perform this action.",
+                        current_user.name,
                     )
                     exception = PermissionError()
 
             if update.effective_message:
-                log.debug(f"Message: {update.effective_message.text}")
+                log.debug("Message: %s", update.effective_message.text)
                 current_chat.add_message(update)  # Needs user in chat
+                clazz.record_change(
+                    journal.USER_ACTIVE,
+                    chat_id=current_chat.id,
+                    user_id=current_user.id,
+                    activity=current_user.activity.serialize(),
+                    chat_activity=current_chat.activity.serialize(),
+                    last_chat_event_isotime=current_chat.last_chat_event_time.isoformat(),
+                )
+                clazz.index_message(
+                    current_chat, current_user, update.effective_message
+                )
+                await clazz.check_spam(
+                    current_chat, current_user, update.effective_message
+                )
 
-            # gatekeeping
+            # gatekeeping, new members are checked when they join (`Bot.new_member`)
             if current_chat.premium_users_only and update.effective_user:
-                users = [update.effective_user]
-                if (
-                    update.effective_message
-                    and update.effective_message.new_chat_members
-                ):
-                    users.extend(update.effective_message.new_chat_members)
-                for _user in users:
-                    # don't kick premium members/bots
-                    if not (_user.is_premium or _user.is_bot):
-                        try:
-                            log.info(f"kick {_user} from {current_chat}")
-                            await clazz.kick_user(current_chat, _user.id)
-                        except TelegramError as e:
-                            message = (
-                                f"Couldn't remove {_user} from chat due to error ({e})"
-                            )
-                            log.error(message)
+                await clazz.gatekeeper.enforce(current_chat, update.effective_user)
 
             log.debug(execution_message)
             try:
@@ -204,9 +233,13 @@ class Command:
 
                 raise e
             finally:
+                # persisted with the changes made while handling it
+                await clazz.complete_update(update)
                 clazz.save_state()
                 log.debug("End")
 
+        # read by the update processor to prioritize admin commands
+        wrapped_f.command = self  # type: ignore[attr-defined]
         return wrapped_f
 
 
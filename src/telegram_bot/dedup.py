@@ -0,0 +1,51 @@
+"""
+Deduplication of updates which are delivered more than once (after restarts or webhook retries)
+and of side effects which must not be repeated.
+"""
+
+from __future__ import annotations
+
+import itertools
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+
+
+class RecentKeys:
+    """
+    Bounded set of the most recently added keys, the oldest ones are forgotten first
+    """
+
+    def __init__(self, max_size: int, keys: Iterable[Hashable] = ()):
+        self.max_size = max_size
+        self._keys: OrderedDict[Hashable, None] = OrderedDict()
+        for key in keys:
+            self.add(key)
+
+    def add(self, key: Hashable) -> bool:
+        """
+        :return: bool `False` if the key has been added before
+        """
+        if key in self._keys:
+            return False
+
+        self._keys[key] = None
+        # `max_size` may have been decreased
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+        return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def newest(self, count: int) -> list[Hashable]:
+        """
+        :return: list[Hashable] The `count` most recently added keys, oldest first
+        """
+        return list(itertools.islice(reversed(self._keys), count))[::-1]
+
+    def serialize(self) -> list[Hashable]:
+        return list(self._keys)
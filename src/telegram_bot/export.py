@@ -0,0 +1,88 @@
+"""
+Exports of serialized chats (as returned by `Chat.serialize`) into in-memory upload buffers
+"""
+
+import csv
+import gzip
+import io
+import json
+import re
+import zipfile
+from typing import Any
+
+JSON = "json"
+GZIP = "gz"
+CSV = "csv"
+
+FORMATS = (JSON, GZIP, CSV)
+
+
+class ExportFormatError(ValueError):
+    pass
+
+
+def export_filename(serialized_chat: dict[str, Any], fmt: str) -> str:
+    # titles may contain anything, filenames shouldn't
+    title = re.sub(r"[^\w\- ]+", "_", serialized_chat.get("title") or "").strip()
+    name = title or str(serialized_chat["id"])
+    if fmt == GZIP:
+        return f"{name}.json.gz"
+
+    return f"{name}.{fmt}"
+
+
+def _write_users_csv(serialized_chat: dict[str, Any], buffer: io.BytesIO) -> None:
+    text = io.TextIOWrapper(buffer, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(["id", "name", "muted"])
+    for user in sorted(serialized_chat.get("users", []), key=lambda u: u["id"]):
+        writer.writerow([user["id"], user["name"], user["muted"]])
+    # the buffer is still needed by the caller
+    text.detach()
+
+
+def export_chat(serialized_chat: dict[str, Any], fmt: str = JSON) -> io.BytesIO:
+    """
+    :param fmt: str `json`, `gz` (gzip compressed JSON) or `csv` (the users of the chat)
+    :return: io.BytesIO The export, positioned at its start
+    :raises: ExportFormatError if `fmt` is unknown
+    """
+    buffer = io.BytesIO()
+    if fmt == JSON:
+        buffer.write(json.dumps(serialized_chat).encode("utf-8"))
+    elif fmt == GZIP:
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+            f.write(json.dumps(serialized_chat).encode("utf-8"))
+    elif fmt == CSV:
+        _write_users_csv(serialized_chat, buffer)
+    else:
+        raise ExportFormatError(
+            f"Unknown format `{fmt}`, use one of {', '.join(FORMATS)}"
+        )
+
+    buffer.seek(0)
+    return buffer
+
+
+def export_chats(serialized_chats: list[dict[str, Any]], fmt: str = JSON) -> io.BytesIO:
+    """
+    A zip archive containing `export_chat` of every chat, named `<title>_<id>.<format>`
+    """
+    if fmt not in FORMATS:
+        raise ExportFormatError(
+            f"Unknown format `{fmt}`, use one of {', '.join(FORMATS)}"
+        )
+
+    buffer = io.BytesIO()
+    # gzip compressed entries aren't compressed again
+    compression = zipfile.ZIP_STORED if fmt == GZIP else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(buffer, mode="w", compression=compression) as archive:
+        for serialized_chat in serialized_chats:
+            name, _, extension = export_filename(serialized_chat, fmt).partition(".")
+            archive.writestr(
+                f"{name}_{serialized_chat['id']}.{extension}",
+                export_chat(serialized_chat, fmt).getvalue(),
+            )
+
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+from telegram import User as TUser
+from telegram.error import TelegramError
+
+from . import bot, journal
+from .chat import Chat
+from .logger import create_logger
+
+
+class TtlCache:
+    """
+    Bounded mapping whose entries expire `ttl` seconds after they have been set
+    """
+
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Gatekeeper:
+    """
+    Enforces `Chat.premium_users_only`.
+
+    Users are checked when they join (and when they write, for members who joined before the
+    setting was enabled). Verdicts are cached per user and a kick is attempted at most once
+    per chat and user within `verdict_ttl`, so repeated updates don't repeat failing API calls.
+    """
+
+    def __init__(
+        self,
+        hhh_bot: bot.Bot,
+        verdict_ttl: float = 3600,
+        sweep_concurrency: int = 4,
+        verdicts: TtlCache | None = None,
+    ):
+        self.logger = create_logger("gatekeeper")
+        self.bot = hhh_bot
+        self.sweep_concurrency = sweep_concurrency
+        # may be shared between tenants
+        self._verdicts = verdicts if verdicts is not None else TtlCache(verdict_ttl)
+        self._kick_attempts = TtlCache(verdict_ttl)
+        self._sweeps: set[int] = set()
+
+    @classmethod
+    def from_env(cls, hhh_bot: bot.Bot, verdicts: TtlCache | None = None) -> Gatekeeper:
+        return cls(
+            hhh_bot,
+            verdict_ttl=hhh_bot.config.settings.gatekeeping_verdict_ttl,
+            sweep_concurrency=int(os.getenv("GATEKEEPING_SWEEP_CONCURRENCY", 4)),
+            verdicts=verdicts,
+        )
+
+    @property
+    def verdict_ttl(self) -> float:
+        return self._kick_attempts.ttl
+
+    @verdict_ttl.setter
+    def verdict_ttl(self, value: float) -> None:
+        # the verdicts may be shared, they are updated by their owner as well
+        self._verdicts.ttl = value
+        self._kick_attempts.ttl = value
+
+    def verdict(self, tuser: TUser) -> bool:
+        # don't kick premium members/bots
+        allowed = bool(tuser.is_premium or tuser.is_bot)
+        self._verdicts.set(tuser.id, allowed)
+
+        return allowed
+
+    async def enforce(self, chat: Chat, tuser: TUser) -> bool:
+        """
+        Kicks `tuser` from `chat` if the chat only allows premium users and the user isn't one
+        :return: bool Whether the user is allowed in the chat
+        """
+        if not chat.premium_users_only or self.verdict(tuser):
+            return True
+
+        await self._kick(chat, tuser.id, str(tuser))
+        return False
+
+    async def _kick(self, chat: Chat, user_id: int, name: str) -> bool:
+        key = (chat.id, user_id)
+        if self._kick_attempts.get(key):
+            return False
+        self._kick_attempts.set(key, True)
+
+        try:
+            self.logger.info("kick %s from %s", name, chat)
+            await self.bot.kick_user(chat, user_id)
+        except TelegramError as e:
+            self.logger.error("Couldn't remove %s from chat due to error (%s)", name, e)
+            return False
+
+        # the chat may have been evicted and materialized again while kicking
+        chat = self.bot.chats.get(chat.id) or chat
+        user = chat.get_user_by_id(user_id)
+        if user:
+            chat.remove_user(user)
+            self.bot.record_change(journal.USER_LEFT, chat_id=chat.id, user_id=user_id)
+
+        return True
+
+    def is_sweeping(self, chat: Chat) -> bool:
+        return chat.id in self._sweeps
+
+    async def sweep(
+        self, chat: Chat, report: Callable[[str], Awaitable[Any]]
+    ) -> tuple[int, int]:
+        """
+        Checks every known member of `chat` once, at most `sweep_concurrency` at a time
+        :param report: Callable[[str], Awaitable] Called with progress messages
+        :return: tuple[int, int] Number of checked and kicked users
+        """
+        if chat.id in self._sweeps:
+            raise RuntimeError(f"{chat} is already being swept")
+        self._sweeps.add(chat.id)
+
+        users = list(chat.users)
+        semaphore = asyncio.Semaphore(self.sweep_concurrency)
+        report_every = max(len(users) // 10, 1)
+        checked = 0
+        kicked = 0
+
+        async def _check(user_id: int, name: str) -> None:
+            nonlocal checked, kicked
+            async with semaphore:
+                allowed = self._verdicts.get(user_id)
+                try:
+                    if allowed is None:
+                        member = await self.bot.application.bot.get_chat_member(
+                            chat_id=chat.id, user_id=user_id
+                        )
+                        allowed = self.verdict(member.user)
+                    if not allowed and await self._kick(chat, user_id, name):
+                        kicked += 1
+                except TelegramError as e:
+                    self.logger.warning("Couldn't check %s in %s: %s", name, chat, e)
+
+                checked += 1
+                if checked % report_every == 0 and checked < len(users):
+                    await report(
+                        f"Checked {checked}/{len(users)} users, kicked {kicked}"
+                    )
+
+        try:
+            with self.bot.chats.pinned(chat.id):
+                await asyncio.gather(*(_check(user.id, user.name) for user in users))
+        finally:
+            self._sweeps.discard(chat.id)
+
+        await report(f"Checked {checked}/{len(users)} users, kicked {kicked}")
+        self.bot.save_state()
+
+        return checked, kicked
@@ -0,0 +1,227 @@
+"""
+Append-only journal for state changes.
+
+Every mutation of the state appends a small record (one JSON object per line) instead of
+rewriting the whole state. The journal is folded into a new state snapshot by
+`Bot.compact_state` and replayed on top of the last snapshot on startup.
+"""
+
+import json
+import os
+import threading
+from typing import Any
+
+from .logger import create_logger
+from .state import FsyncPolicy, atomic_write
+
+CHAT_ADDED = "chat_added"
+CHAT_UPDATED = "chat_updated"
+CHAT_RENAMED = "chat_renamed"
+CHAT_MIGRATED = "chat_migrated"
+CHAT_DELETED = "chat_deleted"
+USER_JOINED = "user_joined"
+USER_LEFT = "user_left"
+USER_MUTED = "user_muted"
+UNMUTE_SCHEDULED = "unmute_scheduled"
+USER_ACTIVE = "user_active"
+INVITE_LINK_CHANGED = "invite_link_changed"
+HHH_MESSAGES_CHANGED = "hhh_messages_changed"
+STATE_UPDATED = "state_updated"
+UPDATE_PROCESSED = "update_processed"
+EFFECT_APPLIED = "effect_applied"
+
+# Key in the state containing the sequence number of the last record included in it
+SEQUENCE_KEY = "journal_seq"
+
+
+def journal_filepath(state_filepath: str) -> str:
+    return f"{state_filepath}.journal"
+
+
+class Journal:
+    def __init__(
+        self,
+        filepath: str,
+        sequence: int = 0,
+        fsync_policy: FsyncPolicy | None = None,
+    ):
+        self.logger = create_logger("journal")
+        self.filepath = filepath
+        self.fsync_policy = fsync_policy or FsyncPolicy(FsyncPolicy.NEVER)
+        self.sequence = sequence
+        # number of records written since the last compaction
+        self.size = 0
+        self._pending: list[dict[str, Any]] = []
+        # records may be appended from other threads
+        self._lock = threading.Lock()
+
+    def append(self, op: str, **fields) -> None:
+        with self._lock:
+            self.sequence += 1
+            self._pending.append({"seq": self.sequence, "op": op, **fields})
+
+    def flush(self) -> int:
+        """
+        Writes all pending records to the journal file
+        :return: int Number of written records
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+
+            lines = "".join(json.dumps(record) + "\n" for record in pending)
+            with open(self.filepath, "a") as f:
+                f.write(lines)
+                f.flush()
+                if self.fsync_policy.should_sync():
+                    os.fsync(f.fileno())
+
+            self.size += len(pending)
+            return len(pending)
+
+    def read(self, after: int = 0) -> list[dict[str, Any]]:
+        """
+        Reads all records with a sequence number greater than `after`.
+        A partially written last line (e.g. due to a crash) is skipped.
+        """
+        if not os.path.exists(self.filepath):
+            return []
+
+        records = []
+        with open(self.filepath) as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.warning(
+                        "Skipping corrupt journal record in line %s", line_number
+                    )
+                    continue
+
+                if record.get("seq", 0) > after:
+                    records.append(record)
+
+        if records:
+            self.sequence = max(self.sequence, records[-1]["seq"])
+        self.size = len(records)
+
+        return records
+
+    def truncate(self, sequence: int) -> None:
+        """
+        Drops every record which is included in a snapshot (sequence number <= `sequence`).
+        Records which were flushed after the snapshot has been taken are kept.
+        """
+        with self._lock:
+            remaining = self.read(after=sequence)
+            lines = "".join(json.dumps(record) + "\n" for record in remaining)
+            atomic_write(
+                self.filepath, lines.encode("utf-8"), fsync_policy=self.fsync_policy
+            )
+            self.size = len(remaining)
+
+
+def replay(state: dict[str, Any], records: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    Applies the given journal records to a serialized state (as written by `Bot.save_state`)
+    :return: dict[str, Any] The updated state
+    """
+    chats: dict[Any, dict[str, Any]] = {
+        chat.get("id"): chat for chat in state.get("chats", [])
+    }
+    sequence = state.get(SEQUENCE_KEY, 0)
+
+    for record in records:
+        if record["seq"] <= sequence:
+            continue
+
+        _apply(state, chats, record)
+        sequence = record["seq"]
+
+    state["chats"] = list(chats.values())
+    state[SEQUENCE_KEY] = sequence
+
+    return state
+
+
+def _apply(
+    state: dict[str, Any], chats: dict[Any, dict[str, Any]], record: dict[str, Any]
+) -> None:
+    op = record["op"]
+
+    if op in (HHH_MESSAGES_CHANGED, STATE_UPDATED):
+        state.update(record["fields"])
+        return
+    elif op == UPDATE_PROCESSED:
+        state["last_update_id"] = record["update_id"]
+        # bounded again when the state is loaded
+        state.setdefault("recent_update_ids", []).extend(record.get("update_ids", []))
+        return
+    elif op == EFFECT_APPLIED:
+        state.setdefault("effect_keys", []).append(record["key"])
+        return
+    elif op == UNMUTE_SCHEDULED:
+        _drop_scheduled_unmute(state, record["chat_id"], record["user_id"])
+        state["scheduled_unmutes"].append(
+            {
+                "chat_id": record["chat_id"],
+                "user_id": record["user_id"],
+                "timestamp": record["timestamp"],
+            }
+        )
+        return
+    elif op == CHAT_ADDED:
+        chats[record["chat"]["id"]] = record["chat"]
+        return
+    elif op == CHAT_MIGRATED:
+        chat = chats.pop(record["from_id"], None)
+        if chat is not None:
+            chat["id"] = record["to_id"]
+            chats[record["to_id"]] = chat
+        return
+    elif op == CHAT_DELETED:
+        chats.pop(record["chat_id"], None)
+        return
+
+    if op == USER_MUTED and not record["muted"]:
+        # the reset isn't needed anymore
+        _drop_scheduled_unmute(state, record["chat_id"], record["user_id"])
+
+    chat = chats.get(record["chat_id"])
+    if chat is None:
+        return
+
+    if op == CHAT_UPDATED:
+        chat.update(record["fields"])
+    elif op == CHAT_RENAMED:
+        chat["title"] = record["title"]
+    elif op == INVITE_LINK_CHANGED:
+        chat["invite_link"] = record["invite_link"]
+        chat["created_invite_link"] = record.get("created", False)
+    elif op == USER_JOINED:
+        users = [u for u in chat.get("users", []) if u["id"] != record["user"]["id"]]
+        chat["users"] = users + [record["user"]]
+    elif op == USER_LEFT:
+        chat["users"] = [
+            u for u in chat.get("users", []) if u["id"] != record["user_id"]
+        ]
+    elif op == USER_ACTIVE:
+        if "last_chat_event_isotime" in record:
+            chat["last_chat_event_isotime"] = record["last_chat_event_isotime"]
+        chat["activity"] = record["chat_activity"]
+        for user in chat.get("users", []):
+            if user["id"] == record["user_id"]:
+                user["activity"] = record["activity"]
+    elif op == USER_MUTED:
+        for user in chat.get("users", []):
+            if user["id"] == record["user_id"]:
+                user["muted"] = record["muted"]
+
+
+def _drop_scheduled_unmute(state: dict[str, Any], chat_id: int, user_id: int) -> None:
+    state["scheduled_unmutes"] = [
+        entry
+        for entry in state.get("scheduled_unmutes", [])
+        if (entry["chat_id"], entry["user_id"]) != (chat_id, user_id)
+    ]
@@ -1,17 +1,188 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
+import sys
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
+chat_id_context: ContextVar[int | None] = ContextVar("chat_id", default=None)
+user_id_context: ContextVar[int | None] = ContextVar("user_id", default=None)
+handler_context: ContextVar[str | None] = ContextVar("handler", default=None)
 
-def create_logger(name: str, level: int = logging.INFO) -> logging.Logger:
-    import sys
+_CONTEXT_FIELDS: dict[str, ContextVar[Any]] = {
+    "chat_id": chat_id_context,
+    "user_id": user_id_context,
+    "handler": handler_context,
+}
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds `chat_id`, `user_id` and `handler` of the update which is currently handled to every record
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, context in _CONTEXT_FIELDS.items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get())
+
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Only lets every `every`-th DEBUG record of each call site pass
+    """
+
+    def __init__(self, every: int = 1):
+        super().__init__()
+        self.every = max(every, 1)
+        self._counts: dict[tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or record.levelno > logging.DEBUG:
+            return True
+
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+
+        return count % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.module}.{record.funcName}#{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for field in _CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to a background thread, drops them instead of blocking if the queue is full
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only the formatting which needs the caller's state happens here,
+        # the rest is done by the formatter in the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-    logger = logging.getLogger(name)
-    ch = logging.StreamHandler(sys.stdout)
 
-    formatting = f"[{name}] %(asctime)s\t%(levelname)s\t%(module)s.%(funcName)s#%(lineno)d | %(message)s"
-    formatter = logging.Formatter(formatting)
-    ch.setFormatter(formatter)
+class ChatLoggerAdapter(logging.LoggerAdapter):
+    """
+    Tags records with the chat id without requiring a logger per chat
+    """
 
-    logger.addHandler(ch)
-    logger.setLevel(level)
+    def process(
+        self, msg: Any, kwargs: MutableMapping[str, Any]
+    ) -> tuple[Any, MutableMapping[str, Any]]:
+        kwargs["extra"] = {**(self.extra or {}), **kwargs.get("extra", {})}
+        return msg, kwargs
+
+
+_TEXT_FORMAT = "[%(name)s] %(asctime)s\t%(levelname)s\t%(module)s.%(funcName)s#%(lineno)d | chat=%(chat_id)s user=%(user_id)s handler=%(handler)s | %(message)s"
+
+_sink: DroppingQueueHandler | None = None
+
+
+def _create_sink() -> DroppingQueueHandler:
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "text").strip().lower() == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(_TEXT_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    handler = DroppingQueueHandler(log_queue)
+    # both need the caller's context, the listener runs in its own thread
+    handler.addFilter(SamplingFilter(int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", 1))))
+    handler.addFilter(ContextFilter())
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return handler
+
+
+def log_sink() -> DroppingQueueHandler:
+    """
+    The handler shared by all loggers, records are written to stdout by a background thread
+    """
+    global _sink
+    if _sink is None:
+        _sink = _create_sink()
+
+    return _sink
+
+
+def create_logger(name: str, level: int = logging.INFO) -> logging.Logger:
+    logger = logging.getLogger(name)
+    # loggers are global, only configure them once
+    if not logger.handlers:
+        logger.addHandler(log_sink())
+    # setting the level clears the cache of every logger
+    if logger.level != level:
+        logger.setLevel(level)
 
     return logger
+
+
+def chat_logger(chat_id: int) -> ChatLoggerAdapter:
+    return ChatLoggerAdapter(create_logger("chat"), {"chat_id": chat_id})
+
+
+def set_log_context(
+    chat_id: int | None, user_id: int | None, handler: str | None
+) -> list[tuple[ContextVar, Any]]:
+    """
+    Sets the context which is added to every log record
+    :return: list Tokens to pass to `reset_log_context`
+    """
+    return [
+        (chat_id_context, chat_id_context.set(chat_id)),
+        (user_id_context, user_id_context.set(user_id)),
+        (handler_context, handler_context.set(handler)),
+    ]
+
+
+def reset_log_context(tokens: list[tuple[ContextVar, Any]]) -> None:
+    for context, token in tokens:
+        context.reset(token)
@@ -1,10 +1,40 @@
+import asyncio
+import json
+import multiprocessing
 import os
+import signal
 import sys
-from collections.abc import Callable
-
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.process import BaseProcess
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    CommandHandler,
+    MessageHandler,
+    TypeHandler,
+    filters,
+)
 
 from telegram_bot import Bot, create_logger
+from telegram_bot.metrics import Metrics
+from telegram_bot.scheduling import PriorityUpdateProcessor
+from telegram_bot.sharding import ShardCoordinator, ShardLink, seed_shard_state
+from telegram_bot.state import dump_state, load_state
+from telegram_bot.tenants import SharedResources, Tenant, load_tenants
+
+STARTED_AT = time.monotonic()
+
+ALLOWED_UPDATES = [
+    update_type
+    for update_type in Update.ALL_TYPES
+    if update_type not in (Update.MESSAGE_REACTION, Update.MESSAGE_REACTION_COUNT)
+]
 
 
 def _identity(x):
@@ -17,23 +47,27 @@ def update_state(
     state_mutation_function: Callable[[dict], dict] | None = None,
     chat_mutation_function: Callable[[dict], dict] | None = None,
 ):
-    import json
-
     if not state_mutation_function:
         state_mutation_function = _identity
     if not chat_mutation_function:
         chat_mutation_function = _identity
 
-    with open(state_filepath) as f:
-        state = json.load(f)
+    logger = create_logger("update_state")
+    try:
+        state = load_state(state_filepath)
+    except FileNotFoundError:
+        logger.info("No state at %s, nothing to update", state_filepath)
+        return
+    except ValueError as e:
+        logger.error("Unable to update state: %s", e)
+        return
     new_chats = []
     state = state_mutation_function(state)
     for chat in state["chats"]:
         new_chats.append(chat_mutation_function(chat))
 
     state["chats"] = new_chats
-    with open(state_filepath, "w+") as f:
-        json.dump(state, f)
+    dump_state(state_filepath, state)
 
 
 def cleanup_state(content: dict, **kwargs) -> dict:
@@ -59,20 +93,161 @@ def cleanup_state(content: dict, **kwargs) -> dict:
     return dedup
 
 
-def start(bot_token: str, state_file: str):
-    logger = create_logger("start")
-    logger.debug("Start bot")
+def drop_search_indexes(content: dict, **kwargs) -> dict:
+    """
+    The search indexes are stored separately (and only if the search is enabled)
+    """
+    for chat in content["chats"]:
+        chat.pop("search", None)
+        chat.pop("search_pending", None)
+
+    return content
+
 
-    application = ApplicationBuilder().token(bot_token).build()
-    bot = Bot(application, state_file)
+# applied once to the loaded state, in order, the names are stored in the state
+MIGRATIONS: list[tuple[str, Callable[[dict], dict]]] = [
+    ("cleanup_state", cleanup_state),
+    ("drop_search_indexes", drop_search_indexes),
+]
+
+
+def migrate_state(state: dict) -> bool:
+    """
+    Applies all migrations which haven't been applied to `state` yet
+    :return: bool Whether the state has been changed
+    """
+    logger = create_logger("migrate_state")
+    applied: list[str] = state.get("migrations", [])
+    changed = False
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+
+        logger.info("Apply migration %s", name)
+        state.update(migration(state))
+        applied = applied + [name]
+        state["migrations"] = applied
+        changed = True
+
+    return changed
+
+
+def _build_application(tenant: Tenant, shared: SharedResources) -> ApplicationBuilder:
+    # the HTTP connection pools are shared by all tenants
+    return (
+        ApplicationBuilder()
+        .token(tenant.token)
+        .request(shared.request)
+        .get_updates_request(shared.get_updates_request)
+        .concurrent_updates(
+            PriorityUpdateProcessor.from_env(shared.metrics, tenant.name)
+        )
+    )
+
+
+def _admin_commands(application: Application) -> set[str]:
+    """
+    The commands whose handlers require chat or main admin rights
+    """
+    result: set[str] = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            command = getattr(handler.callback, "command", None)
+            if isinstance(handler, CommandHandler) and (
+                command and (command.chat_admin or command.main_admin)
+            ):
+                result.update(handler.commands)
+
+    return result
+
+
+def read_state(state_filepath: str) -> dict | None:
+    """
+    Loads and migrates the state
+    :return: dict | None `None` if there is no valid state
+    """
+    logger = create_logger("start")
+    logger.debug("Read state from %s", state_filepath)
+    try:
+        state = load_state(state_filepath)
+        if migrate_state(state):
+            dump_state(state_filepath, state)
+    except FileNotFoundError:
+        logger.info("No previous state found")
+        return None
+    except ValueError as e:
+        logger.warning("Unable to load previous state: %s", e)
+        return None
+
+    return state
+
+
+def read_states(state_filepaths: list[str]) -> list[dict | None]:
+    """
+    `read_state` for several states, decoded in parallel processes
+    """
+    if len(state_filepaths) < 2:
+        return [read_state(filepath) for filepath in state_filepaths]
+
+    with ProcessPoolExecutor(
+        min(len(state_filepaths), os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        return list(executor.map(read_state, state_filepaths))
+
+
+def load_bot_state(bot: Bot, state: dict | None) -> None:
+    # replays the journal (if enabled) even without a previous state file
+    bot.set_state(state if state is not None else bot.state)
+
+
+def create_application(
+    tenant: Tenant,
+    shared: SharedResources,
+    shard_link: ShardLink | None = None,
+    state: dict | None = None,
+) -> Application:
+    """
+    :param state: dict | None The state read by `read_state`, read from the state file if not given
+    """
+    logger = create_logger("start")
+    logger.debug("Create bot %s", tenant.name)
+
+    builder = _build_application(tenant, shared)
+    if shard_link:
+        # updates are received from the coordinator
+        builder = builder.updater(None)
+    application = builder.build()
+    bot = Bot(
+        application,
+        tenant.state_filepath,
+        tenant=tenant,
+        shared=shared,
+        shard_link=shard_link,
+    )
+    application.post_init = bot.post_init
+    application.post_stop = bot.post_stop
+    application.post_shutdown = bot.post_shutdown
 
     logger.debug("Register command handlers")
+    # runs before every other handler
+    application.add_handler(TypeHandler(Update, bot.skip_processed_update), group=-1)
+
     # CommandHandler
     application.add_handler(CommandHandler("users", bot.show_users))
+    application.add_handler(CommandHandler("activity", bot.show_activity))
+    application.add_handler(CommandHandler("search", bot.search_messages))
+    application.add_handler(
+        CallbackQueryHandler(bot.show_users_page, pattern=r"^users:-?\d+:\d+$")
+    )
     application.add_handler(CommandHandler("get_invite_link", bot.get_invite_link))
 
     # main_admin
     application.add_handler(CommandHandler("delete_chat_by_id", bot.delete_chat_by_id))
+    application.add_handler(CommandHandler("metrics", bot.show_metrics))
+    application.add_handler(CommandHandler("dead_chats", bot.show_dead_chats))
+    application.add_handler(CommandHandler("memory", bot.trace_memory))
+    application.add_handler(CommandHandler("export_all", bot.export_all))
 
     # chat_admin
     application.add_handler(CommandHandler("delete_chat", bot.delete_chat))
@@ -90,6 +265,10 @@ def start(bot_token: str, state_file: str):
     application.add_handler(
         CommandHandler("set_premium_users_only", bot.set_premium_users_only)
     )
+    application.add_handler(CommandHandler("sweep_non_premium", bot.sweep_non_premium))
+    application.add_handler(
+        CommandHandler("set_spam_thresholds", bot.set_spam_thresholds)
+    )
 
     # Debugging
     application.add_handler(CommandHandler("status", bot.status))
@@ -113,19 +292,301 @@ def start(bot_token: str, state_file: str):
     application.add_handler(
         MessageHandler(filters.StatusUpdate.MIGRATE, bot.migrate_chat_id)
     )
+    application.add_handler(
+        ChatMemberHandler(bot.chat_member_update, ChatMemberHandler.CHAT_MEMBER)
+    )
+    application.add_handler(
+        ChatMemberHandler(bot.my_chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER)
+    )
     application.add_handler(MessageHandler(filters.ALL, bot.noop))
+    # runs after every other handler
+    application.add_handler(TypeHandler(Update, bot.complete_update), group=1)
+
+    processor = application.update_processor
+    if isinstance(processor, PriorityUpdateProcessor):
+        processor.admin_commands = _admin_commands(application)
+
+    load_bot_state(
+        bot, state if state is not None else read_state(tenant.state_filepath)
+    )
+
+    return application
+
+
+def metrics_port(offset: int = 0) -> int | None:
+    """
+    :param offset: int Added to `METRICS_PORT`, every process needs its own port
+    :return: int | None `None` if metrics aren't served
+    """
+    port = os.getenv("METRICS_PORT")
+    return int(port) + offset if port else None
+
+
+async def run_applications(
+    applications: list[Application],
+    shared: SharedResources,
+    stop_event: asyncio.Event | None = None,
+    metrics_port: int | None = None,
+) -> None:
+    """
+    Runs all applications on the current event loop until SIGINT or SIGTERM is received
+    (or `stop_event` is set). Mirrors `Application.run_polling` for more than one application.
+    :param metrics_port: int | None The port serving the metrics, not served if `None`
+    """
+    logger = create_logger("start")
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+    loop.add_signal_handler(signal.SIGHUP, shared.config.reload)
+    config_watcher = (
+        asyncio.create_task(shared.config.watch()) if shared.config.filename else None
+    )
+
+    metrics_server = None
+    started: list[Application] = []
+    try:
+        if metrics_port is not None:
+            metrics_server = await shared.metrics.serve(metrics_port)
+        for application in applications:
+            await application.initialize()
+            started.append(application)
+            if application.post_init:
+                await application.post_init(application)
+            if application.updater:
+                # `chat_member` updates are only sent when requested explicitly
+                await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+            await application.start()
+
+        startup_seconds = time.monotonic() - STARTED_AT
+        shared.metrics.set("hhh_startup_seconds", startup_seconds)
+        logger.info(
+            "Running %s bots, started in %.2fs", len(applications), startup_seconds
+        )
+        await stop_event.wait()
+    finally:
+        await shutdown_applications(started)
+        if shared.encoder:
+            shared.encoder.shutdown()
+        if metrics_server:
+            metrics_server.close()
+        if config_watcher:
+            config_watcher.cancel()
+
+
+async def shutdown_applications(applications: list[Application]) -> None:
+    """
+    Stops fetching updates, handles the pending ones for at most `SHUTDOWN_TIMEOUT` seconds
+    (default `20`) and writes the state of every application.
+    A failing application doesn't keep the others from being shut down.
+    """
+    logger = create_logger("shutdown")
+    timeout = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+
+    async def _run(application: Application, step: str, awaitable: Awaitable) -> None:
+        try:
+            await awaitable
+        except Exception:
+            logger.error(
+                "Failed to %s @%s", step, application.bot.username, exc_info=True
+            )
+
+    for application in applications:
+        if application.updater and application.updater.running:
+            await _run(application, "stop polling", application.updater.stop())
+
+    stopping = [
+        asyncio.create_task(_run(application, "stop", application.stop()))
+        for application in applications
+        if application.running
+    ]
+    if stopping:
+        _, pending = await asyncio.wait(stopping, timeout=timeout)
+        if pending:
+            logger.warning("Pending updates weren't handled within %ss", timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    for application in applications:
+        # also after the timeout, so background tasks are cancelled and pending changes are
+        # flushed before the state is written
+        if application.post_stop:
+            await _run(application, "run post_stop", application.post_stop(application))
+        await _run(application, "shut down", application.shutdown())
+        # the state is written even if closing the connections failed
+        if application.post_shutdown:
+            await _run(
+                application, "write the state", application.post_shutdown(application)
+            )
+    logger.info("Shut down %s bots", len(applications))
+
+
+def start(tenants: list[Tenant]):
+    shared = SharedResources(len(tenants))
+    states = read_states([tenant.state_filepath for tenant in tenants])
+    applications = [
+        create_application(tenant, shared, state=state)
+        for tenant, state in zip(tenants, states)
+    ]
+
+    asyncio.run(run_applications(applications, shared, metrics_port=metrics_port()))
+
+
+def run_worker(tenant: Tenant, shard: int, shard_count: int, host: str, port: int):
+    """
+    Entrypoint of a worker process, handles the updates of one shard
+    """
+    state_filepath = seed_shard_state(tenant.state_filepath, shard, shard_count)
+    shard_tenant = Tenant(
+        f"{tenant.name}-{shard}",
+        tenant.token,
+        state_filepath,
+        hhh_id=tenant.hhh_id,
+        main_admin_ids=tenant.main_admin_ids,
+    )
 
-    logger.debug(f"Read state from {state_file}")
-    if os.path.exists(state_file):
-        with open(state_file) as file:
-            try:
-                state = json.load(file)
-                bot.set_state(state)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning(f"Unable to load previous state: {e}")
+    async def _run() -> None:
+        shared = SharedResources()
+        shard_link = ShardLink(shard, host, port)
+        application = create_application(shard_tenant, shared, shard_link)
+        # the coordinator going away stops the worker as well
+        await run_applications(
+            [application],
+            shared,
+            stop_event=shard_link.closed,
+            # the coordinator serves its metrics on `METRICS_PORT`
+            metrics_port=metrics_port(1 + shard),
+        )
+
+    asyncio.run(_run())
+
+
+async def run_coordinator(tenant: Tenant, shard_count: int) -> None:
+    """
+    Fetches the updates, routes them to `shard_count` worker processes and updates the HHH list
+    """
+    logger = create_logger("start")
+    shared = SharedResources()
+    application = _build_application(tenant, shared).build()
+    bot = Bot(application, tenant.state_filepath, tenant=tenant, shared=shared)
+    # the background tasks of the chats run in the workers
+    application.post_init = bot.post_init_coordinator
+    application.post_shutdown = bot.post_shutdown
+    load_bot_state(bot, read_state(tenant.state_filepath))
+
+    coordinator = ShardCoordinator(bot, shard_count)
+    application.add_handler(TypeHandler(Update, bot.skip_processed_update), group=-1)
+    # updates are completed once they have been sent to their worker
+    application.add_handler(TypeHandler(Update, coordinator.route))
+
+    host = os.getenv("SHARD_HOST", "127.0.0.1")
+    server = await coordinator.serve(host, int(os.getenv("SHARD_PORT", 0)))
+    port = server.sockets[0].getsockname()[1]
+
+    context = multiprocessing.get_context("spawn")
+
+    def _start_worker(shard: int) -> BaseProcess:
+        worker = context.Process(
+            target=run_worker,
+            args=(tenant, shard, shard_count, host, port),
+            name=f"shard-{shard}",
+        )
+        worker.start()
+        return worker
+
+    workers = [_start_worker(shard) for shard in range(shard_count)]
+    stop_event = asyncio.Event()
+    failed_workers: list[str] = []
+
+    def _fail(worker: BaseProcess) -> None:
+        failed_workers.append(worker.name)
+        stop_event.set()
 
-    logger.info("Running")
-    application.run_polling()
+    supervisor = asyncio.create_task(
+        supervise_workers(workers, _start_worker, _fail, shared.metrics)
+    )
+
+    async def _stop_workers(application: Application) -> None:
+        # stopped workers mustn't be restarted
+        supervisor.cancel()
+        timeout = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+        try:
+            # the workers still report HHH list changes while they shut down
+            await asyncio.wait_for(coordinator.drain(), timeout)
+        except TimeoutError:
+            logger.warning("Updates weren't sent to the workers within %ss", timeout)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            await asyncio.to_thread(worker.join)
+            logger.info("%s exited with %s", worker.name, worker.exitcode)
+        # stops the compactor
+        await bot.post_stop(application)
+
+    application.post_stop = _stop_workers
+    try:
+        await run_applications(
+            [application], shared, stop_event=stop_event, metrics_port=metrics_port()
+        )
+    finally:
+        supervisor.cancel()
+        for worker in workers:
+            if worker.is_alive():
+                worker.kill()
+            worker.join()
+        server.close()
+
+    if failed_workers:
+        raise RuntimeError(f"Workers {', '.join(failed_workers)} kept exiting")
+
+
+async def supervise_workers(
+    workers: list[BaseProcess],
+    start_worker: Callable[[int], BaseProcess],
+    fail: Callable[[BaseProcess], None],
+    metrics: Metrics,
+    interval: float = 1,
+    max_restarts: int = 3,
+    restart_window: float = 600,
+) -> None:
+    """
+    Restarts workers which exited (`workers` is updated), the updates routed to them meanwhile
+    are sent once they are connected again. Calls `fail` instead if a worker exited more than
+    `max_restarts` times within `restart_window` seconds.
+    """
+    logger = create_logger("supervisor")
+    restarts: dict[int, list[float]] = {}
+    while True:
+        await asyncio.sleep(interval)
+        for shard, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+
+            worker.join()
+            now = time.monotonic()
+            recent = [
+                restarted_at
+                for restarted_at in restarts.get(shard, [])
+                if now - restarted_at < restart_window
+            ]
+            if len(recent) >= max_restarts:
+                logger.critical(
+                    "%s exited with %s, %s restarts within %ss didn't help",
+                    worker.name,
+                    worker.exitcode,
+                    len(recent),
+                    restart_window,
+                )
+                fail(worker)
+                return
+
+            logger.error(
+                "%s exited with %s, restarting it", worker.name, worker.exitcode
+            )
+            metrics.inc("hhh_shard_restarts_total", shard=shard)
+            restarts[shard] = recent + [now]
+            workers[shard] = start_worker(shard)
 
 
 def get_token() -> str:
@@ -147,17 +608,23 @@ def get_token() -> str:
 
 
 if __name__ == "__main__":
-    state_filepath = (
-        "state.json" if os.path.exists("state.json") else "/data/state.json"
-    )
-    update_state(state_filepath, state_mutation_function=cleanup_state)
-    import json
+    state_directory = "." if os.path.exists("state.json") else "/data"
+    tenants = load_tenants(state_directory)
+    if tenants is None:
+        tenants = [
+            Tenant("default", get_token(), os.path.join(state_directory, "state.json"))
+        ]
 
-    token = get_token()
+    shard_count = int(os.getenv("SHARD_WORKERS", 0))
+    if shard_count > 1 and len(tenants) > 1:
+        raise ValueError("Sharding only supports a single bot")
 
     # noinspection PyBroadException
     try:
-        start(token, state_filepath)
+        if shard_count > 1:
+            asyncio.run(run_coordinator(tenants[0], shard_count))
+        else:
+            start(tenants)
     except Exception as e:
         create_logger("__main__").error(e, exc_info=True)
         sys.exit(1)
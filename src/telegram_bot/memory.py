@@ -0,0 +1,140 @@
+"""
+Memory investigations in production with `tracemalloc`.
+
+Tracing is started on demand with few frames per allocation and stopped automatically after
+`max_seconds`, so the overhead is bounded. Snapshots are analyzed in a worker thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gc
+import logging
+import os
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterable
+
+from .chat import Chat
+from .logger import create_logger
+from .search import SearchStore
+
+
+def object_counts(top: int) -> list[tuple[str, int]]:
+    """
+    :return: list[tuple[str, int]] The most common types of the objects tracked by the GC
+    """
+    return Counter(type(obj).__name__ for obj in gc.get_objects()).most_common(top)
+
+
+def chat_report(chats: Iterable[Chat], search: SearchStore) -> list[str]:
+    lines = ["id | title | users | retained messages | indexed messages"]
+    rows = sorted(
+        ((sum(len(user.messages) for user in chat.users), chat) for chat in chats),
+        key=lambda row: -row[0],
+    )
+    for message_count, chat in rows:
+        index = search.get(chat.id)
+        lines.append(
+            f"{chat.id} | {chat.title} | {len(chat.users)} | {message_count} | "
+            f"{len(index) if index else 0}"
+        )
+
+    return lines
+
+
+class MemoryProfiler:
+    def __init__(self, frames: int = 1, max_seconds: float = 600, top: int = 30):
+        self.logger = create_logger("memory_profiler")
+        self.frames = frames
+        self.max_seconds = max_seconds
+        self.top = top
+        self._baseline: tracemalloc.Snapshot | None = None
+        self._auto_stop: asyncio.TimerHandle | None = None
+
+    @classmethod
+    def from_env(cls) -> MemoryProfiler:
+        return cls(
+            frames=int(os.getenv("TRACEMALLOC_FRAMES", 1)),
+            max_seconds=float(os.getenv("TRACEMALLOC_MAX_SECONDS", 600)),
+        )
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> bool:
+        """
+        :return: bool `False` if tracing has already been started
+        """
+        if self.tracing:
+            return False
+
+        self.logger.info("Start tracing for at most %ss", self.max_seconds)
+        tracemalloc.start(self.frames)
+        self._baseline = None
+        self._auto_stop = asyncio.get_running_loop().call_later(
+            self.max_seconds, self.stop
+        )
+
+        return True
+
+    def stop(self) -> None:
+        if self._auto_stop:
+            self._auto_stop.cancel()
+            self._auto_stop = None
+        if self.tracing:
+            self.logger.info("Stop tracing")
+            tracemalloc.stop()
+        self._baseline = None
+
+    def status(self) -> str:
+        if not self.tracing:
+            return "Not tracing"
+
+        current, peak = tracemalloc.get_traced_memory()
+        overhead = tracemalloc.get_tracemalloc_memory()
+        return (
+            f"Tracing with {tracemalloc.get_traceback_limit()} frames: "
+            f"{current / 2**20:.1f} MiB traced (peak {peak / 2**20:.1f} MiB), "
+            f"{overhead / 2**20:.1f} MiB overhead"
+        )
+
+    def _report(self, chat_lines: list[str], diff: bool) -> str:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        lines = [self.status(), ""]
+        if diff and self._baseline:
+            lines.append(f"Top {self.top} allocation sites since the last snapshot")
+            lines.extend(
+                str(stat)
+                for stat in snapshot.compare_to(self._baseline, "lineno")[: self.top]
+            )
+        else:
+            lines.append(f"Top {self.top} allocation sites")
+            lines.extend(
+                str(stat) for stat in snapshot.statistics("lineno")[: self.top]
+            )
+        self._baseline = snapshot
+
+        lines.extend(["", f"Top {self.top} object types"])
+        lines.extend(f"{name}: {count}" for name, count in object_counts(self.top))
+        lines.extend(["", f"Loggers: {len(logging.Logger.manager.loggerDict)}", ""])
+        lines.extend(chat_lines)
+
+        return "\n".join(lines)
+
+    async def report(
+        self, chats: list[Chat], search: SearchStore, diff: bool = False
+    ) -> str:
+        """
+        Takes a snapshot, which is the baseline of the next diff
+        :param diff: bool Compare with the previous snapshot instead of listing everything
+        :raises: RuntimeError if tracing hasn't been started
+        """
+        if not self.tracing:
+            raise RuntimeError("Tracing hasn't been started")
+
+        # the chats are changed by the event loop
+        return await asyncio.to_thread(self._report, chat_report(chats, search), diff)
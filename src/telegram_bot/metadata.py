@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from telegram import ChatFullInfo, ChatPermissions
+from telegram.error import TelegramError
+
+from . import bot, journal
+from .logger import create_logger
+
+
+class ChatMetadata:
+    __slots__ = ("title", "description", "invite_link", "permissions", "fetched_at")
+
+    def __init__(self, chat: ChatFullInfo):
+        self.title = chat.title
+        self.description = chat.description
+        self.invite_link = chat.invite_link
+        self.permissions: ChatPermissions | None = chat.permissions
+        self.fetched_at = time.monotonic()
+
+
+class ChatMetadataCache:
+    """
+    Caches `get_chat` of the chats whose metadata has been used.
+
+    Entries are refreshed in the background once they are older than `ttl` or have been
+    invalidated (by a new title, a migration or changed rights of the bot), at most
+    `batch_size` chats at a time every `refresh_interval` seconds. Evicted chats (see
+    `ChatCache`) are refreshed once they have been materialized again. Stale entries are still
+    returned until then. At most `max_size` chats are cached, the least recently used are dropped.
+    """
+
+    def __init__(
+        self,
+        hhh_bot: bot.Bot,
+        ttl: float = 3600,
+        refresh_interval: float = 60,
+        batch_size: int = 20,
+        max_size: int = 10000,
+    ):
+        self.logger = create_logger("chat_metadata")
+        self.bot = hhh_bot
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self._entries: OrderedDict[int, ChatMetadata] = OrderedDict()
+        self._invalidated: set[int] = set()
+
+    @classmethod
+    def from_env(cls, hhh_bot: bot.Bot) -> ChatMetadataCache:
+        return cls(
+            hhh_bot,
+            max_size=int(os.getenv("CHAT_METADATA_CACHE_SIZE", 10000)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, chat_id: int) -> ChatMetadata:
+        """
+        :raises: TelegramError if the chat isn't cached and `get_chat` fails
+        """
+        metadata = self._entries.get(chat_id)
+        if metadata is None:
+            self.bot.metrics.inc(
+                "hhh_chat_metadata_misses_total", tenant=self.bot.tenant.name
+            )
+            return await self.fetch(chat_id)
+
+        self._entries.move_to_end(chat_id)
+        return metadata
+
+    async def permissions(self, chat_id: int) -> ChatPermissions | None:
+        try:
+            return (await self.get(chat_id)).permissions
+        except TelegramError:
+            self.logger.warning("Couldn't get the permissions of %s", chat_id)
+            return None
+
+    def invalidate(self, chat_id: int) -> None:
+        if chat_id in self._entries:
+            self._invalidated.add(chat_id)
+
+    def pop(self, chat_id: int) -> None:
+        self._entries.pop(chat_id, None)
+        self._invalidated.discard(chat_id)
+
+    async def fetch(self, chat_id: int) -> ChatMetadata:
+        metadata = ChatMetadata(await self.bot.application.bot.get_chat(chat_id))
+        self._entries[chat_id] = metadata
+        self._entries.move_to_end(chat_id)
+        self._invalidated.discard(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        self._apply(chat_id, metadata)
+        return metadata
+
+    def _apply(self, chat_id: int, metadata: ChatMetadata) -> None:
+        # titles are changed by `Bot.new_chat_title` which updates the HHH list as well
+        chat = self.bot.chats.resident(chat_id)
+        if chat is None:
+            return
+
+        if chat.description != metadata.description:
+            chat.description = metadata.description
+            self.bot.record_change(
+                journal.CHAT_UPDATED,
+                chat_id=chat.id,
+                fields={"description": chat.description},
+            )
+        if metadata.invite_link and not chat.invite_link:
+            chat.invite_link = metadata.invite_link
+            self.bot.record_change(
+                journal.INVITE_LINK_CHANGED,
+                chat_id=chat.id,
+                invite_link=chat.invite_link,
+            )
+
+    def stale(self) -> list[int]:
+        """
+        The stale entries of materialized chats
+        """
+        expired_before = time.monotonic() - self.ttl
+        return [
+            chat_id
+            for chat_id, metadata in self._entries.items()
+            if (chat_id in self._invalidated or metadata.fetched_at < expired_before)
+            and self.bot.chats.resident(chat_id) is not None
+        ]
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            stale = self.stale()[: self.batch_size]
+            if not stale:
+                continue
+
+            self.logger.debug("Refreshing %s chats", len(stale))
+            results = await asyncio.gather(
+                *(self.fetch(chat_id) for chat_id in stale), return_exceptions=True
+            )
+            for chat_id, result in zip(stale, results):
+                if isinstance(result, TelegramError):
+                    self.logger.warning("Couldn't refresh %s: %s", chat_id, result)
+                    # retried after another `ttl`
+                    self._invalidated.discard(chat_id)
+                    if chat_id in self._entries:
+                        self._entries[chat_id].fetched_at = time.monotonic()
+                elif isinstance(result, BaseException):
+                    self.logger.error("Failed refreshing %s", chat_id, exc_info=result)
+            self.bot.save_state()
@@ -0,0 +1,100 @@
+"""
+In-process metrics shared by all bot instances, rendered in the Prometheus text format.
+"""
+
+import asyncio
+from collections.abc import Callable
+
+from .logger import create_logger
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._gauges: dict[str, dict[Labels, float]] = {}
+        self._callbacks: dict[str, dict[Labels, Callable[[], float]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        series = self._counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def gauge(self, name: str, callback: Callable[[], float], **labels) -> None:
+        """
+        Registers a gauge whose value is read from `callback` when rendering
+        """
+        self._callbacks.setdefault(name, {})[_labels(labels)] = callback
+
+    def value(self, name: str, **labels) -> float | None:
+        key = _labels(labels)
+        for metrics in (self._counters, self._gauges):
+            if key in metrics.get(name, {}):
+                return metrics[name][key]
+        if callback := self._callbacks.get(name, {}).get(key):
+            return callback()
+
+        return None
+
+    def render(self) -> str:
+        lines = []
+        for metric_type, metrics in (
+            ("counter", self._counters),
+            ("gauge", self._gauges),
+        ):
+            for name, series in sorted(metrics.items()):
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, callbacks in sorted(self._callbacks.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, callback in callbacks.items():
+                lines.append(f"{name}{_format_labels(labels)} {callback()}")
+
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int, host: str = "0.0.0.0") -> asyncio.Server:
+        """
+        Serves `render` over HTTP for scraping, every request gets the metrics
+        """
+        logger = create_logger("metrics")
+
+        async def _handle(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+                logger.debug("Invalid metrics request", exc_info=True)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(_handle, host, port)
+        logger.info("Serving metrics on port %s", port)
+
+        return server
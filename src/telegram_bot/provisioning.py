@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+
+from telegram import ChatMember, ChatMemberAdministrator
+from telegram.error import BadRequest, TelegramError
+
+from . import bot, journal
+from .chat_cache import ChatSummary
+from .gatekeeping import TtlCache
+from .logger import create_logger
+
+
+def can_invite(member: ChatMember) -> bool:
+    return member.status == ChatMember.OWNER or (
+        isinstance(member, ChatMemberAdministrator) and member.can_invite_users
+    )
+
+
+class InviteLinkProvisioner:
+    """
+    Creates missing invite links in the background instead of while handling an update.
+
+    Chats are deduplicated while queued, failures are retried with exponential backoff.
+    Chats in which no link can be created (the bot isn't allowed to or gave up retrying) aren't
+    queued again for `refresh_interval` seconds or until the rights of the bot change.
+    Every `refresh_interval` seconds chats without an invite link are queued again and the links
+    created by the bot are checked, revoked or expired ones are replaced.
+    Changed links are collected for `batch_delay` seconds before the HHH list is updated once.
+    """
+
+    def __init__(
+        self,
+        hhh_bot: bot.Bot,
+        refresh_interval: float = 3600,
+        max_attempts: int = 5,
+        backoff: float = 30,
+        batch_delay: float = 5,
+    ):
+        self.logger = create_logger("invite_link_provisioner")
+        self.bot = hhh_bot
+        # chat id -> `True` for chats which aren't queued until the entry expires
+        self._unavailable = TtlCache(refresh_interval)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.batch_delay = batch_delay
+        self._queue: asyncio.Queue[int] = asyncio.Queue()
+        self._queued: set[int] = set()
+        self._attempts: dict[int, int] = {}
+        self._changed_chat_id: int | None = None
+        self._hhh_update: asyncio.Task | None = None
+
+    @property
+    def refresh_interval(self) -> float:
+        return self._unavailable.ttl
+
+    @refresh_interval.setter
+    def refresh_interval(self, value: float) -> None:
+        self._unavailable.ttl = value
+
+    def enqueue(self, chat_id: int) -> None:
+        if chat_id in self._queued or self._unavailable.get(chat_id):
+            return
+
+        self._queued.add(chat_id)
+        self._queue.put_nowait(chat_id)
+
+    async def run(self) -> None:
+        while True:
+            chat_id = await self._queue.get()
+            self._queued.discard(chat_id)
+            try:
+                await self._provision(chat_id)
+            except TelegramError as e:
+                self._retry(chat_id, e)
+            except Exception:
+                self.logger.error(
+                    "Unexpected error while provisioning %s", chat_id, exc_info=True
+                )
+
+    def rights_changed(self, chat_id: int, member: ChatMember) -> None:
+        """
+        Called with the new membership of the bot in a chat
+        """
+        self._unavailable.pop(chat_id)
+        if can_invite(member):
+            self.enqueue(chat_id)
+
+    async def run_refresh(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for summary in self.bot.chats.summaries():
+                if summary.is_group() and (
+                    not summary.invite_link or summary.created_invite_link
+                ):
+                    self.enqueue(summary.id)
+
+    async def _provision(self, chat_id: int) -> None:
+        # summaries don't materialize evicted chats
+        summary = self.bot.chats.summary(chat_id)
+        if summary is None or not summary.is_group():
+            self._attempts.pop(chat_id, None)
+            return
+        if summary.invite_link:
+            if summary.created_invite_link:
+                await self._refresh(summary)
+            self._attempts.pop(chat_id, None)
+            return
+
+        tbot = self.bot.application.bot
+        member = await tbot.get_chat_member(chat_id=chat_id, user_id=tbot.id)
+        if not can_invite(member):
+            self.logger.debug("Not allowed to create an invite link in %s", summary)
+            self._attempts.pop(chat_id, None)
+            self._unavailable.set(chat_id, True)
+            return
+
+        self.logger.info("creating invite link for %s", summary.title)
+        invite_link = await tbot.create_chat_invite_link(chat_id=chat_id)
+        self._attempts.pop(chat_id, None)
+        self._set_invite_link(chat_id, invite_link.invite_link)
+
+    async def _refresh(self, summary: ChatSummary) -> None:
+        """
+        Replaces the invite link created by the bot if it has been revoked or has expired
+        """
+        try:
+            invite_link = await self.bot.application.bot.edit_chat_invite_link(
+                chat_id=summary.id, invite_link=summary.invite_link
+            )
+        except BadRequest as e:
+            if not _is_invalid_link(e):
+                raise
+            self.logger.info("Invite link of %s is invalid: %s", summary, e)
+        else:
+            if not invite_link.is_revoked:
+                return
+            self.logger.info("Invite link of %s has been revoked", summary)
+
+        # created again by the next attempt
+        self._set_invite_link(summary.id, None)
+        self.enqueue(summary.id)
+
+    def _set_invite_link(self, chat_id: int, invite_link: str | None) -> None:
+        # the chat may have been evicted (or deleted) while waiting for the API
+        chat = self.bot.chats.get(chat_id)
+        if chat is None:
+            return
+
+        chat.invite_link = invite_link
+        chat.created_invite_link = invite_link is not None
+        self.bot.record_change(
+            journal.INVITE_LINK_CHANGED,
+            chat_id=chat.id,
+            invite_link=chat.invite_link,
+            created=chat.created_invite_link,
+        )
+        self.bot.save_state()
+        self._schedule_hhh_update(chat.id)
+
+    def _retry(self, chat_id: int, error: TelegramError) -> None:
+        attempts = self._attempts.get(chat_id, 0) + 1
+        if attempts >= self.max_attempts:
+            self.logger.error(
+                "Giving up creating an invite link for %s after %s attempts: %s",
+                chat_id,
+                attempts,
+                error,
+            )
+            self._attempts.pop(chat_id, None)
+            self._unavailable.set(chat_id, True)
+            return
+
+        self._attempts[chat_id] = attempts
+        delay = self.backoff * 2 ** (attempts - 1)
+        self.logger.warning(
+            "Failed creating invite link for %s (%s), retrying in %ss",
+            chat_id,
+            error,
+            delay,
+        )
+        asyncio.get_running_loop().call_later(delay, self.enqueue, chat_id)
+
+    def _schedule_hhh_update(self, chat_id: int) -> None:
+        self._changed_chat_id = chat_id
+        if self._hhh_update is None or self._hhh_update.done():
+            self._hhh_update = asyncio.create_task(self._update_hhh_message())
+
+    async def flush(self) -> None:
+        """
+        Updates the HHH list right away if an update is pending
+        """
+        if self._hhh_update and not self._hhh_update.done():
+            self._hhh_update.cancel()
+        if self._changed_chat_id is not None:
+            self._hhh_update = asyncio.create_task(self._update_hhh_message(delay=0))
+        if self._hhh_update:
+            await asyncio.gather(self._hhh_update, return_exceptions=True)
+
+    async def _update_hhh_message(self, delay: float | None = None) -> None:
+        await asyncio.sleep(self.batch_delay if delay is None else delay)
+        chat_id, self._changed_chat_id = self._changed_chat_id, None
+        # resolved again, the chat may have been evicted in the meantime
+        chat = self.bot.chats.get(chat_id) if chat_id is not None else None
+        if chat is None:
+            return
+
+        try:
+            await self.bot.update_hhh_message(chat)
+        except TelegramError:
+            self.logger.error("Failed updating the HHH message", exc_info=True)
+        self.bot.save_state()
+
+
+def _is_invalid_link(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return any(reason in message for reason in ("expired", "revoked", "invite_hash"))
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from . import bot, journal
+from .chat import Chat
+from .logger import create_logger
+
+# Key in the state containing the ids of unreachable chats and since when they are unreachable
+UNREACHABLE_KEY = "unreachable_chats"
+
+
+class ReapResult:
+    def __init__(self, chat: Chat, reason: str, since: datetime, prune_at: datetime):
+        self.chat = chat
+        self.reason = reason
+        self.since = since
+        self.prune_at = prune_at
+
+    def __str__(self) -> str:
+        return (
+            f"{self.chat.id} | {self.chat.title} | {self.reason} | "
+            f"since {self.since:%Y-%m-%d %H:%M}, pruned after {self.prune_at:%Y-%m-%d %H:%M}"
+        )
+
+
+class ChatReaper:
+    """
+    Finds chats the bot was removed from while it was offline (or which were deleted).
+
+    Every `interval` seconds (`0` disables it) all groups are checked with `get_chat` (`concurrency` at a time).
+    Chats which are unreachable are marked, chats which are still unreachable `grace_period`
+    seconds later are removed with a single update of the HHH list.
+    """
+
+    def __init__(
+        self,
+        hhh_bot: bot.Bot,
+        interval: float = 86400,
+        grace_period: float = 7 * 86400,
+        concurrency: int = 5,
+    ):
+        self.logger = create_logger("chat_reaper")
+        self.bot = hhh_bot
+        self.interval = interval
+        self.grace_period = timedelta(seconds=grace_period)
+        self.concurrency = concurrency
+
+    @property
+    def unreachable(self) -> dict[str, str]:
+        """
+        chat id -> ISO time since when it's unreachable
+        """
+        return self.bot.state.get(UNREACHABLE_KEY, {})
+
+    def _set_unreachable(self, unreachable: dict[str, str]) -> None:
+        self.bot.state[UNREACHABLE_KEY] = unreachable
+        self.bot.record_change(
+            journal.STATE_UPDATED, fields={UNREACHABLE_KEY: unreachable}
+        )
+
+    async def _check(self, chat_id: int, semaphore: asyncio.Semaphore) -> str | None:
+        """
+        :return: str | None The reason if the chat is unreachable
+        """
+        async with semaphore:
+            try:
+                await self.bot.application.bot.get_chat(chat_id)
+            except Forbidden as e:
+                return e.message
+            except BadRequest as e:
+                if "not found" in e.message.lower():
+                    return e.message
+                self.logger.warning("Couldn't check %s: %s", chat_id, e)
+            except TelegramError as e:
+                # network errors and flood control don't mean anything
+                self.logger.warning("Couldn't check %s: %s", chat_id, e)
+
+        return None
+
+    async def find_unreachable(self) -> dict[int, str]:
+        """
+        :return: dict[int, str] chat id -> reason of all unreachable chats
+        """
+        hhh_id = self.bot.state.get("hhh_id")
+        # only groups are listed, private chats are kept even if the user blocked the bot
+        chat_ids = [
+            summary.id
+            for summary in self.bot.chats.summaries()
+            if summary.is_group() and summary.id != hhh_id
+        ]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reasons = await asyncio.gather(
+            *(self._check(chat_id, semaphore) for chat_id in chat_ids)
+        )
+
+        return {chat_id: reason for chat_id, reason in zip(chat_ids, reasons) if reason}
+
+    async def reap(self, dry_run: bool = False) -> list[ReapResult]:
+        """
+        Marks unreachable chats and prunes the ones which are unreachable for longer than the
+        grace period
+        :param dry_run: bool Only reports what would happen
+        :return: list[ReapResult] The unreachable chats
+        """
+        found = await self.find_unreachable()
+        now = datetime.now()
+        # chats which are reachable again aren't marked anymore
+        unreachable = {
+            chat_id: since
+            for chat_id, since in self.unreachable.items()
+            if int(chat_id) in found
+        }
+
+        results = []
+        for chat_id, reason in found.items():
+            chat = self.bot.chats.get(chat_id)
+            if chat is None:
+                continue
+            since = unreachable.setdefault(str(chat_id), now.isoformat())
+            since_time = datetime.fromisoformat(since)
+            results.append(
+                ReapResult(chat, reason, since_time, since_time + self.grace_period)
+            )
+
+        self.logger.info(
+            "%s of %s chats are unreachable", len(results), len(self.bot.chats)
+        )
+        if dry_run:
+            return results
+
+        if unreachable != self.unreachable:
+            self._set_unreachable(unreachable)
+        prunable = [result.chat for result in results if result.prune_at <= now]
+        if prunable:
+            await self.prune(prunable)
+        self.bot.save_state()
+
+        return results
+
+    async def prune(self, chats: list[Chat]) -> None:
+        self.logger.info("Pruning %s unreachable chats", len(chats))
+        pruned_ids = {str(chat.id) for chat in chats}
+        self._set_unreachable(
+            {
+                chat_id: since
+                for chat_id, since in self.unreachable.items()
+                if chat_id not in pruned_ids
+            }
+        )
+        self.bot.metrics.inc(
+            "hhh_chats_pruned_total", len(chats), tenant=self.bot.tenant.name
+        )
+
+        if self.bot.shard_link:
+            # the coordinator owns the HHH list
+            for chat in chats:
+                await self.bot.update_hhh_message(
+                    chat, delete=True, create_changelog=True
+                )
+            return
+
+        for chat in chats:
+            self.bot.update_recent_changes(
+                self.bot.create_latest_change_text(chat, "", delete=True)
+            )
+        for chat in chats[:-1]:
+            self.bot.chats.pop(chat.id)
+            self.bot.record_change(journal.CHAT_DELETED, chat_id=chat.id)
+        # the HHH list is only updated once
+        await self.bot.update_hhh_message(chats[-1], delete=True)
+
+    async def run(self) -> None:
+        while True:
+            # checked again later if disabled, it can be enabled by reloading the settings
+            await asyncio.sleep(self.interval or 60)
+            if not self.interval:
+                continue
+            try:
+                await self.reap()
+            except TelegramError:
+                self.logger.error("Failed reaping chats", exc_info=True)
@@ -0,0 +1,172 @@
+"""
+Prioritized processing of updates.
+
+Updates are handled one at a time (or by `workers` at a time) like before, but waiting updates
+are taken in the order of their priority instead of their arrival: admin commands first, then
+other commands and status updates, then plain messages. Under overload plain messages are only
+sampled, the rest of them is dropped.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .logger import create_logger
+from .metrics import Metrics
+
+ADMIN_COMMAND = 0
+STATUS = 1
+MESSAGE = 2
+
+PRIORITY_NAMES = {ADMIN_COMMAND: "admin_command", STATUS: "status", MESSAGE: "message"}
+
+
+def command_name(update: Update) -> str | None:
+    """
+    :return: str | None The command of a message like `/mute@bot 10`, `None` if it's no command
+    """
+    message = update.message or update.edited_message
+    if not message or not message.text or not message.text.startswith("/"):
+        return None
+
+    return message.text[1:].split(maxsplit=1)[0].split("@")[0].lower()
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    def __init__(
+        self,
+        metrics: Metrics,
+        tenant_name: str,
+        workers: int = 1,
+        max_pending: int = 10000,
+        shed_threshold: int = 1000,
+        sample_rate: float = 0.1,
+    ):
+        """
+        :param workers: int Number of updates handled at the same time
+        :param max_pending: int Number of updates accepted for processing, further ones wait
+            in the update queue
+        :param shed_threshold: int Number of waiting plain messages from which on only
+            `sample_rate` of the new ones are handled
+        """
+        super().__init__(max_pending)
+        self.logger = create_logger("update_processor")
+        self.metrics = metrics
+        self.tenant_name = tenant_name
+        self.workers = workers
+        self.shed_threshold = shed_threshold
+        self.sample_rate = sample_rate
+        # commands which require admin rights, filled once the handlers are known
+        self.admin_commands: set[str] = set()
+        self._waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._pending = dict.fromkeys(PRIORITY_NAMES, 0)
+        for priority, name in PRIORITY_NAMES.items():
+            metrics.gauge(
+                "hhh_update_queue_depth",
+                self._depth_callback(priority),
+                tenant=tenant_name,
+                priority=name,
+            )
+
+    @classmethod
+    def from_env(cls, metrics: Metrics, tenant_name: str) -> PriorityUpdateProcessor:
+        return cls(
+            metrics,
+            tenant_name,
+            workers=int(os.getenv("UPDATE_WORKERS", 1)),
+            max_pending=int(os.getenv("UPDATE_MAX_PENDING", 10000)),
+        )
+
+    def _depth_callback(self, priority: int) -> Callable[[], float]:
+        return lambda: self._pending[priority]
+
+    def priority(self, update: object) -> int:
+        if not isinstance(update, Update):
+            return STATUS
+
+        command = command_name(update)
+        if command is not None:
+            return ADMIN_COMMAND if command in self.admin_commands else STATUS
+
+        message = update.message or update.edited_message
+        # callback queries, chat member updates, ...
+        if message is None:
+            return STATUS
+        if (
+            message.new_chat_members
+            or message.left_chat_member
+            or message.new_chat_title
+            or message.migrate_from_chat_id
+            or message.group_chat_created
+            or message.supergroup_chat_created
+        ):
+            return STATUS
+
+        return MESSAGE
+
+    def _shed(self, priority: int) -> bool:
+        return (
+            priority == MESSAGE
+            and self._pending[MESSAGE] >= self.shed_threshold
+            and random.random() >= self.sample_rate
+        )
+
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        priority = self.priority(update)
+        if self._shed(priority):
+            self.metrics.inc("hhh_updates_shed_total", tenant=self.tenant_name)
+            coroutine.close()  # type: ignore[attr-defined]
+            return
+
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), turn))
+        self._pending[priority] += 1
+        self._start_next()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                self._finish()
+            coroutine.close()  # type: ignore[attr-defined]
+            raise
+        finally:
+            self._pending[priority] -= 1
+
+        try:
+            await coroutine
+        finally:
+            self._finish()
+
+    def _start_next(self) -> None:
+        while self._running < self.workers and self._waiting:
+            _, _, turn = heapq.heappop(self._waiting)
+            if turn.cancelled():
+                continue
+            self._running += 1
+            turn.set_result(None)
+
+    def _finish(self) -> None:
+        self._running -= 1
+        self._start_next()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._waiting:
+            self.logger.warning(
+                "Shutting down with %s waiting updates", len(self._waiting)
+            )
@@ -0,0 +1,188 @@
+"""
+Inverted index over the text of the most recent messages of a chat, backing `/search`.
+
+Only the first `MAX_TEXT_LENGTH` characters of a message are indexed and kept. The indexes are
+persisted separately from the state and only with the retained messages, the postings are
+rebuilt when they are loaded.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import OrderedDict
+from collections.abc import Container
+from typing import Any
+
+MAX_TEXT_LENGTH = 500
+
+_TOKEN = re.compile(r"\w{2,}")
+
+
+def search_filepath(state_filepath: str) -> str:
+    return f"{state_filepath}.search"
+
+
+def tokenize(text: str) -> set[str]:
+    return set(_TOKEN.findall(text.casefold()))
+
+
+class SearchIndex:
+    def __init__(self, max_messages: int = 500):
+        self.max_messages = max_messages
+        # message id -> (user id, text), oldest first
+        self._messages: OrderedDict[int, tuple[int, str]] = OrderedDict()
+        self._postings: dict[str, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def resize(self, max_messages: int) -> None:
+        self.max_messages = max_messages
+        while len(self._messages) > self.max_messages:
+            self._evict_oldest()
+
+    def add(self, message_id: int, user_id: int, text: str) -> None:
+        if message_id in self._messages:
+            return
+
+        text = text[:MAX_TEXT_LENGTH]
+        self._messages[message_id] = (user_id, text)
+        for token in tokenize(text):
+            self._postings.setdefault(token, set()).add(message_id)
+
+        while len(self._messages) > self.max_messages:
+            self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        message_id, (_, text) = self._messages.popitem(last=False)
+        for token in tokenize(text):
+            message_ids = self._postings.get(token)
+            if message_ids is None:
+                continue
+            message_ids.discard(message_id)
+            if not message_ids:
+                del self._postings[token]
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[int, int, str]]:
+        """
+        :return: list[tuple[int, int, str]] (message id, user id, text) of the newest messages
+            containing all terms of the query
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        postings = sorted(
+            (self._postings.get(token, set()) for token in tokens), key=len
+        )
+        matches = set(postings[0]).intersection(*postings[1:])
+
+        return [
+            (message_id, *self._messages[message_id])
+            for message_id in sorted(matches, reverse=True)[:limit]
+        ]
+
+    @classmethod
+    def deserialize(cls, messages: list[list[Any]], max_messages: int) -> SearchIndex:
+        index = cls(max_messages)
+        for message_id, user_id, text in messages:
+            index.add(message_id, user_id, text)
+
+        return index
+
+    def serialize(self) -> list[list[Any]]:
+        """
+        Only the messages, oldest first
+        """
+        return [
+            [message_id, user_id, text]
+            for message_id, (user_id, text) in self._messages.items()
+        ]
+
+
+class SearchStore:
+    """
+    The search indexes of all chats, which keep the last `max_messages` messages of every chat.
+    `0` disables the search and drops all indexes.
+
+    `dirty` is set by every change, the owner writes the indexes and resets it.
+    """
+
+    def __init__(self, max_messages: int = 0):
+        self._max_messages = max_messages
+        self._indexes: dict[int, SearchIndex] = {}
+        self.dirty = False
+
+    @property
+    def max_messages(self) -> int:
+        return self._max_messages
+
+    @max_messages.setter
+    def max_messages(self, value: int) -> None:
+        if value == self._max_messages:
+            return
+
+        self._max_messages = value
+        if not value and self._indexes:
+            self._indexes = {}
+        for index in self._indexes.values():
+            index.resize(value)
+        self.dirty = True
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def get(self, chat_id: int) -> SearchIndex | None:
+        return self._indexes.get(chat_id)
+
+    def add(self, chat_id: int, message_id: int, user_id: int, text: str) -> None:
+        if not self.max_messages:
+            return
+
+        index = self._indexes.get(chat_id)
+        if index is None:
+            index = self._indexes[chat_id] = SearchIndex(self.max_messages)
+        index.add(message_id, user_id, text)
+        self.dirty = True
+
+    def pop(self, chat_id: int) -> None:
+        if self._indexes.pop(chat_id, None) is not None:
+            self.dirty = True
+
+    def migrate(self, from_id: int, to_id: int) -> None:
+        index = self._indexes.pop(from_id, None)
+        if index is not None:
+            self._indexes[to_id] = index
+            self.dirty = True
+
+    def retain(self, chat_ids: Container[int]) -> None:
+        """
+        Drops the indexes of the chats which aren't in `chat_ids` (e.g. deleted ones)
+        """
+        for chat_id in [
+            chat_id for chat_id in self._indexes if chat_id not in chat_ids
+        ]:
+            self.pop(chat_id)
+
+    def load(self, json_object: dict[str, Any]) -> None:
+        indexes = json_object.get("indexes", {})
+        if not self.max_messages:
+            # written empty, so disabling the search removes the texts from the disk
+            self.dirty = bool(indexes)
+            return
+
+        self._indexes = {
+            int(chat_id): SearchIndex.deserialize(messages, self.max_messages)
+            for chat_id, messages in indexes.items()
+        }
+
+    def serialize(self) -> dict[str, Any]:
+        """
+        A copy which isn't changed by later messages
+        """
+        return {
+            "indexes": {
+                str(chat_id): index.serialize()
+                for chat_id, index in self._indexes.items()
+            }
+        }
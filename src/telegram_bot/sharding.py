@@ -0,0 +1,261 @@
+"""
+Partitions the chats across worker processes.
+
+The coordinator is the only process fetching updates. It forwards every update to the worker
+owning the chat (see `shard_of`) and owns the HHH list: workers send it an event with the chat
+summary instead of editing the list themselves. Coordinator and workers exchange JSON lines over
+a TCP connection, so the whole topology runs on one machine with local processes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from typing import Any
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Application, CallbackContext
+
+from . import bot, journal
+from .chat import Chat
+from .chat_cache import ChatSummary
+from .logger import create_logger
+from .state import dump_state, load_state
+
+# Key in the coordinator's state containing the chats which don't belong to `shard_of`
+ROUTES_KEY = "shard_routes"
+
+
+def shard_of(chat_id: int, shard_count: int) -> int:
+    return abs(chat_id) % shard_count
+
+
+def shard_state_filepath(state_filepath: str, shard: int, shard_count: int) -> str:
+    return f"{state_filepath}.shard-{shard}-of-{shard_count}"
+
+
+def seed_shard_state(state_filepath: str, shard: int, shard_count: int) -> str:
+    """
+    Creates the state of a shard from the unsharded state if it doesn't exist yet
+    :return: str The state filepath of the shard
+    """
+    filepath = shard_state_filepath(state_filepath, shard, shard_count)
+    if os.path.exists(filepath):
+        return filepath
+
+    try:
+        state = load_state(state_filepath)
+    except (FileNotFoundError, ValueError):
+        return filepath
+
+    routes = {int(key): value for key, value in state.get(ROUTES_KEY, {}).items()}
+    state["chats"] = [
+        chat
+        for chat in state.get("chats", [])
+        if routes.get(chat["id"], shard_of(chat["id"], shard_count)) == shard
+    ]
+    create_logger("sharding").info(
+        "Seeding shard %s with %s chats", shard, len(state["chats"])
+    )
+    dump_state(filepath, state)
+
+    return filepath
+
+
+def _encode(value: dict[str, Any]) -> bytes:
+    return json.dumps(value).encode("utf-8") + b"\n"
+
+
+class ShardCoordinator:
+    """
+    Routes updates to the workers and applies their chat events to the HHH list of `hhh_bot`
+    """
+
+    def __init__(self, hhh_bot: bot.Bot, shard_count: int):
+        self.logger = create_logger("shard_coordinator")
+        self.bot = hhh_bot
+        self.shard_count = shard_count
+        # migrated chats stay on the shard of their previous id
+        self.routes: dict[int, int] = {
+            int(key): value for key, value in hhh_bot.state.get(ROUTES_KEY, {}).items()
+        }
+        self._queues: list[asyncio.Queue[Update]] = [
+            asyncio.Queue() for _ in range(shard_count)
+        ]
+        # per shard the update which is being sent, sent again if the connection fails
+        self._unacknowledged: list[Update | None] = [None] * shard_count
+        for shard, shard_queue in enumerate(self._queues):
+            hhh_bot.metrics.gauge(
+                "hhh_shard_queue_depth", shard_queue.qsize, shard=shard
+            )
+
+    def shard_for(self, chat_id: int) -> int:
+        return self.routes.get(chat_id, shard_of(chat_id, self.shard_count))
+
+    async def route(self, update: Update, context: CallbackContext) -> None:
+        message = update.effective_message
+        if message and message.migrate_from_chat_id:
+            shard = self._migrate(message.migrate_from_chat_id, message.chat.id)
+        elif update.effective_chat:
+            shard = self.shard_for(update.effective_chat.id)
+        elif update.effective_user:
+            shard = self.shard_for(update.effective_user.id)
+        else:
+            shard = 0
+
+        self.bot.metrics.inc("hhh_shard_updates_total", shard=shard)
+        self._queues[shard].put_nowait(update)
+
+    def _migrate(self, from_id: int, to_id: int) -> int:
+        shard = self.shard_for(from_id)
+        if shard != shard_of(to_id, self.shard_count):
+            self.routes[to_id] = shard
+            self.bot.state[ROUTES_KEY] = {
+                str(chat_id): route for chat_id, route in self.routes.items()
+            }
+
+        chat = self.bot.chats.pop(from_id, None)
+        if chat is not None:
+            chat.id = to_id
+            self.bot.chats[to_id] = chat
+            self.bot.record_change(journal.CHAT_MIGRATED, from_id=from_id, to_id=to_id)
+        # routes aren't part of the journal
+        self.bot.compact_state()
+
+        return shard
+
+    async def serve(self, host: str, port: int) -> asyncio.Server:
+        server = await asyncio.start_server(self._handle_worker, host, port)
+        self.logger.info(
+            "Waiting for %s workers on port %s",
+            self.shard_count,
+            server.sockets[0].getsockname()[1],
+        )
+
+        return server
+
+    async def drain(self) -> None:
+        """
+        Waits until all routed updates have been sent to the workers, never returns while the
+        worker of a shard with routed updates is disconnected
+        """
+        await asyncio.gather(*(shard_queue.join() for shard_queue in self._queues))
+
+    async def _handle_worker(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        hello = json.loads(await reader.readline())
+        shard = int(hello["shard"])
+        self.logger.info("Worker for shard %s connected", shard)
+        sender = asyncio.create_task(self._send_updates(shard, writer))
+
+        try:
+            while line := await reader.readline():
+                await self._handle_event(json.loads(line))
+        except ConnectionError:
+            self.logger.debug("Connection of shard %s failed", shard, exc_info=True)
+        finally:
+            self.logger.warning("Worker for shard %s disconnected", shard)
+            sender.cancel()
+            writer.close()
+
+    async def _send_updates(self, shard: int, writer: asyncio.StreamWriter) -> None:
+        """
+        Updates are only completed (see `Bot.complete_update`) once they have been sent, an
+        update whose connection failed is sent first to the next worker of the shard. It may be
+        delivered twice then, the worker skips it the second time.
+        """
+        shard_queue = self._queues[shard]
+        while True:
+            update = self._unacknowledged[shard]
+            if update is None:
+                update = self._unacknowledged[shard] = await shard_queue.get()
+
+            writer.write(_encode(update.to_dict()))
+            await writer.drain()
+            self._unacknowledged[shard] = None
+            shard_queue.task_done()
+            await self.bot.complete_update(update)
+
+    async def _handle_event(self, event: dict[str, Any]) -> None:
+        summary = ChatSummary.from_serialized(event["chat"])
+        chat = self.bot.chats.get(summary.id)
+        if chat is None:
+            chat = Chat.deserialize(event["chat"], self.bot.application.bot)
+            if chat is None:
+                return
+        elif chat.invite_link != summary.invite_link:
+            chat.invite_link = summary.invite_link
+            self.bot.record_change(
+                journal.INVITE_LINK_CHANGED,
+                chat_id=chat.id,
+                invite_link=chat.invite_link,
+            )
+        chat.type = summary.type
+
+        if event.get("renew"):
+            self.bot.group_message_ids = []
+
+        try:
+            await self.bot.update_hhh_message(
+                chat,
+                new_title=event.get("new_title", ""),
+                delete=event.get("delete", False),
+                create_changelog=event.get("create_changelog", False),
+            )
+        except TelegramError:
+            self.logger.error("Failed updating the HHH message", exc_info=True)
+        self.bot.save_state()
+
+
+class ShardLink:
+    """
+    Connection of a worker to the coordinator
+    """
+
+    def __init__(self, shard: int, host: str, port: int):
+        self.logger = create_logger("shard_link")
+        self.shard = shard
+        self.host = host
+        self.port = port
+        # set once the coordinator closed the connection
+        self.closed = asyncio.Event()
+        self._writer: asyncio.StreamWriter | None = None
+        self._receiver: asyncio.Task | None = None
+
+    async def connect(self, application: Application) -> None:
+        reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(_encode({"shard": self.shard}))
+        await self._writer.drain()
+        self._receiver = asyncio.create_task(self._receive(reader, application))
+
+    async def _receive(
+        self, reader: asyncio.StreamReader, application: Application
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                update = Update.de_json(json.loads(line), application.bot)
+                await application.update_queue.put(update)
+        finally:
+            self.closed.set()
+
+    async def publish(self, chat: Chat, **event) -> None:
+        """
+        Sends the summary of `chat` with the arguments of `Bot.update_hhh_message`
+        """
+        if self._writer is None or self._writer.is_closing():
+            self.logger.error("Not connected, dropping the update of %s", chat)
+            return
+
+        self._writer.write(
+            _encode({"chat": ChatSummary.from_chat(chat).serialize(), **event})
+        )
+        await self._writer.drain()
+
+    async def close(self) -> None:
+        if self._receiver:
+            self._receiver.cancel()
+        if self._writer:
+            self._writer.close()
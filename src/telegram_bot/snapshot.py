@@ -0,0 +1,412 @@
+"""
+Compact binary snapshot format for the bot state.
+
+Layout (all integers are unsigned LEB128 varints unless stated otherwise)::
+
+    magic    b"HHHS"
+    version  uint16 (big endian)
+    flags    uint16 (big endian, reserved)
+    crc32    uint32 (big endian) of everything after the header
+    strings  count, then (length, utf-8 bytes) for every interned string
+    state    the state without `chats`, as a tagged value
+    index    count, then (tagged chat id, offset, length) for every chat
+    chats    the encoded chats, back to back
+
+Chats which are already encoded (see `EncodedChat`) are embedded as they are, as a nested
+snapshot containing only that chat, so they don't have to be decoded for writing a snapshot.
+
+Every string (keys as well as values) is stored exactly once in the string table and
+referenced by its index. Lists of dicts sharing the same keys (e.g. `Chat.users`) are
+stored column by column, so keys like `name`, `muted` and `id` aren't repeated per user.
+The chat index allows decoding a single chat without touching the others.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import struct
+import sys
+import zlib
+from typing import Any
+
+MAGIC = b"HHHS"
+VERSION = 2
+# version 1 didn't embed encoded chats
+SUPPORTED_VERSIONS = (1, 2)
+
+_HEADER = struct.Struct(">4sHHI")
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_LIST = 6
+_DICT = 7
+_TABLE = 8
+_EMBEDDED = 9
+
+_FLOAT_STRUCT = struct.Struct(">d")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class EncodedChat:
+    """
+    A serialized chat encoded as `dumps({"chats": [chat]})`
+    """
+
+    __slots__ = ("id", "data")
+
+    def __init__(self, chat_id: int, data: bytes):
+        self.id = chat_id
+        self.data = data
+
+    @classmethod
+    def encode(cls, chat: dict[str, Any]) -> EncodedChat:
+        return cls(chat["id"], dumps({"chats": [chat]}))
+
+    def decode(self) -> dict[str, Any]:
+        return SnapshotReader(self.data, verify=False).chats()[0]
+
+
+def is_snapshot(data: bytes) -> bool:
+    return data[: len(MAGIC)] == MAGIC
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            buffer.append(byte | 0x80)
+        else:
+            buffer.append(byte)
+            return
+
+
+def _read_varint(data: memoryview, offset: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[offset]
+        except IndexError:
+            raise SnapshotError("Unexpected end of snapshot") from None
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+class _Encoder:
+    def __init__(self):
+        self.strings: dict[str, int] = {}
+
+    def _intern(self, string: str) -> int:
+        index = self.strings.get(string)
+        if index is None:
+            index = len(self.strings)
+            self.strings[string] = index
+
+        return index
+
+    @staticmethod
+    def _table_keys(values: list) -> list[str] | None:
+        if len(values) < 2 or not all(isinstance(value, dict) for value in values):
+            return None
+
+        keys = list(values[0].keys())
+        if not all(isinstance(key, str) for key in keys):
+            return None
+
+        key_set = set(keys)
+        if any(value.keys() != key_set for value in values):
+            return None
+
+        return keys
+
+    def encode(self, buffer: bytearray, value: Any) -> None:
+        if value is None:
+            buffer.append(_NONE)
+        elif value is True:
+            buffer.append(_TRUE)
+        elif value is False:
+            buffer.append(_FALSE)
+        elif isinstance(value, int):
+            buffer.append(_INT)
+            _write_varint(buffer, _zigzag(value))
+        elif isinstance(value, float):
+            buffer.append(_FLOAT)
+            buffer += _FLOAT_STRUCT.pack(value)
+        elif isinstance(value, str):
+            buffer.append(_STR)
+            _write_varint(buffer, self._intern(value))
+        elif isinstance(value, dict):
+            buffer.append(_DICT)
+            _write_varint(buffer, len(value))
+            for key, item in value.items():
+                if not isinstance(key, str):
+                    raise SnapshotError(f"Only string keys are supported (got {key!r})")
+                _write_varint(buffer, self._intern(key))
+                self.encode(buffer, item)
+        elif isinstance(value, list | tuple):
+            keys = self._table_keys(value)  # type: ignore[arg-type]
+            if keys is None:
+                buffer.append(_LIST)
+                _write_varint(buffer, len(value))
+                for item in value:
+                    self.encode(buffer, item)
+            else:
+                buffer.append(_TABLE)
+                _write_varint(buffer, len(keys))
+                for key in keys:
+                    _write_varint(buffer, self._intern(key))
+                _write_varint(buffer, len(value))
+                for key in keys:
+                    for row in value:
+                        self.encode(buffer, row[key])
+        else:
+            raise SnapshotError(f"Unsupported type {type(value).__name__}")
+
+    def string_table(self) -> bytearray:
+        buffer = bytearray()
+        _write_varint(buffer, len(self.strings))
+        for string in self.strings:
+            encoded = string.encode("utf-8")
+            _write_varint(buffer, len(encoded))
+            buffer += encoded
+
+        return buffer
+
+
+def dumps(state: dict[str, Any]) -> bytes:
+    """
+    Encodes the given state (as produced by `Bot.save_state`) into a snapshot
+    :param state: dict[str, Any] The state, chats are expected to be `Chat.serialize` dicts
+        or `EncodedChat`s
+    :return: bytes
+    """
+    encoder = _Encoder()
+
+    rest = {key: value for key, value in state.items() if key != "chats"}
+    state_buffer = bytearray()
+    encoder.encode(state_buffer, rest)
+
+    index_buffer = bytearray()
+    chats_buffer = bytearray()
+    chats = state.get("chats", [])
+    _write_varint(index_buffer, len(chats))
+    for chat in chats:
+        offset = len(chats_buffer)
+        if isinstance(chat, EncodedChat):
+            chats_buffer.append(_EMBEDDED)
+            _write_varint(chats_buffer, len(chat.data))
+            chats_buffer += chat.data
+            encoder.encode(index_buffer, chat.id)
+        else:
+            encoder.encode(chats_buffer, chat)
+            encoder.encode(index_buffer, chat.get("id"))
+        _write_varint(index_buffer, offset)
+        _write_varint(index_buffer, len(chats_buffer) - offset)
+
+    body = encoder.string_table() + state_buffer + index_buffer + chats_buffer
+    header = _HEADER.pack(MAGIC, VERSION, 0, zlib.crc32(body))
+
+    return header + bytes(body)
+
+
+class SnapshotReader:
+    """
+    Gives access to the state in a snapshot, chats are only decoded when requested
+    """
+
+    def __init__(self, data: bytes, verify: bool = True):
+        if len(data) < _HEADER.size:
+            raise SnapshotError("Snapshot is too short")
+
+        magic, version, _flags, checksum = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise SnapshotError("Not a snapshot (magic mismatch)")
+        if version not in SUPPORTED_VERSIONS:
+            raise SnapshotError(f"Unsupported snapshot version {version}")
+
+        self._data = memoryview(data)[_HEADER.size :]
+        if verify and zlib.crc32(self._data) != checksum:
+            raise SnapshotError("Snapshot checksum mismatch")
+
+        count, offset = _read_varint(self._data, 0)
+        self._string_offsets: list[tuple[int, int]] = []
+        for _ in range(count):
+            length, offset = _read_varint(self._data, offset)
+            self._string_offsets.append((offset, length))
+            offset += length
+        self._strings: dict[int, str] = {}
+
+        self._state_offset = offset
+        _, offset = self._decode(offset)
+
+        count, offset = _read_varint(self._data, offset)
+        index: dict[Any, tuple[int, int]] = {}
+        for _ in range(count):
+            chat_id, offset = self._decode(offset)
+            chat_offset, offset = _read_varint(self._data, offset)
+            length, offset = _read_varint(self._data, offset)
+            index[chat_id] = (chat_offset, length)
+        self._chats_offset = offset
+        self._index = index
+
+    def _string(self, index: int) -> str:
+        string = self._strings.get(index)
+        if string is None:
+            try:
+                offset, length = self._string_offsets[index]
+            except IndexError:
+                raise SnapshotError(f"Unknown string reference {index}") from None
+            string = str(self._data[offset : offset + length], "utf-8")
+            self._strings[index] = string
+
+        return string
+
+    def _decode(self, offset: int) -> tuple[Any, int]:
+        data = self._data
+        try:
+            tag = data[offset]
+        except IndexError:
+            raise SnapshotError("Unexpected end of snapshot") from None
+        offset += 1
+
+        if tag == _NONE:
+            return None, offset
+        elif tag == _FALSE:
+            return False, offset
+        elif tag == _TRUE:
+            return True, offset
+        elif tag == _INT:
+            value, offset = _read_varint(data, offset)
+            return _unzigzag(value), offset
+        elif tag == _FLOAT:
+            (number,) = _FLOAT_STRUCT.unpack_from(data, offset)
+            return number, offset + _FLOAT_STRUCT.size
+        elif tag == _STR:
+            value, offset = _read_varint(data, offset)
+            return self._string(value), offset
+        elif tag == _LIST:
+            count, offset = _read_varint(data, offset)
+            items = []
+            for _ in range(count):
+                item, offset = self._decode(offset)
+                items.append(item)
+            return items, offset
+        elif tag == _DICT:
+            count, offset = _read_varint(data, offset)
+            result = {}
+            for _ in range(count):
+                key_index, offset = _read_varint(data, offset)
+                result[self._string(key_index)], offset = self._decode(offset)
+            return result, offset
+        elif tag == _TABLE:
+            key_count, offset = _read_varint(data, offset)
+            keys = []
+            for _ in range(key_count):
+                key_index, offset = _read_varint(data, offset)
+                keys.append(self._string(key_index))
+            row_count, offset = _read_varint(data, offset)
+            rows: list[dict[str, Any]] = [{} for _ in range(row_count)]
+            for key in keys:
+                for row in rows:
+                    row[key], offset = self._decode(offset)
+            return rows, offset
+        elif tag == _EMBEDDED:
+            length, offset = _read_varint(data, offset)
+            embedded = SnapshotReader(
+                bytes(data[offset : offset + length]), verify=False
+            )
+            return embedded.chats()[0], offset + length
+        else:
+            raise SnapshotError(f"Unknown tag {tag}")
+
+    def chat_ids(self) -> list[Any]:
+        return list(self._index.keys())
+
+    def chat(self, chat_id: Any) -> dict[str, Any] | None:
+        try:
+            offset, _ = self._index[chat_id]
+        except KeyError:
+            return None
+
+        chat, _ = self._decode(self._chats_offset + offset)
+        return chat
+
+    def chats(self) -> list[dict[str, Any]]:
+        return [self.chat(chat_id) for chat_id in self._index]  # type: ignore[misc]
+
+    def state(self, include_chats: bool = True) -> dict[str, Any]:
+        state, _ = self._decode(self._state_offset)
+        if include_chats:
+            state["chats"] = self.chats()
+
+        return state
+
+
+def loads(data: bytes, verify: bool = True) -> dict[str, Any]:
+    return SnapshotReader(data, verify=verify).state()
+
+
+def load_chat(data: bytes, chat_id: Any, verify: bool = True) -> dict[str, Any] | None:
+    return SnapshotReader(data, verify=verify).chat(chat_id)
+
+
+def json_to_snapshot(source: str, destination: str) -> None:
+    with open(source) as f:
+        state = json.load(f)
+
+    with open(destination, "wb") as f:
+        f.write(dumps(state))
+
+
+def snapshot_to_json(source: str, destination: str) -> None:
+    with open(source, "rb") as f:
+        state = loads(f.read())
+
+    with open(destination, "w+") as f:
+        json.dump(state, f)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m telegram_bot.snapshot",
+        description="Convert the bot state between JSON and the snapshot format",
+    )
+    parser.add_argument("direction", choices=["to-json", "from-json"])
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.direction == "to-json":
+            snapshot_to_json(args.source, args.destination)
+        else:
+            json_to_snapshot(args.source, args.destination)
+    except (OSError, ValueError) as e:
+        print(f"Conversion failed: {e}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
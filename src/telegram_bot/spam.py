@@ -0,0 +1,213 @@
+"""
+Streaming spam detection over sliding windows of the messages of every user in a chat.
+
+Every check is O(1) amortized per message and the memory per user is bounded by the thresholds:
+a user has at most `max(rate, same)` remembered messages, a chat remembers at most `consecutive`
+messages of the current run and at most `max_users` users are tracked per chat (the least
+recently active ones are forgotten first).
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict, deque
+from collections.abc import Hashable
+from enum import Enum
+from typing import Any
+
+
+class SpamType(Enum):
+    NONE = 0
+    CONSECUTIVE = 1
+    DIFFERENT = 2
+    SAME = 3
+
+
+class SpamThresholds:
+    """
+    A user is considered a spammer if they send
+    - `rate` messages within `window` seconds (`DIFFERENT`)
+    - `same` identical messages within `window` seconds (`SAME`)
+    - `consecutive` messages in a row within `window` seconds without anybody else writing
+      (`CONSECUTIVE`)
+
+    `0` disables a check. Spammers are muted for `mute_minutes`.
+    """
+
+    FIELDS = ("rate", "window", "same", "consecutive", "mute_minutes")
+    # Telegram treats longer restrictions as permanent
+    MAX_MUTE_MINUTES = 366 * 24 * 60
+
+    def __init__(
+        self,
+        rate: int = 10,
+        window: float = 10,
+        same: int = 4,
+        consecutive: int = 15,
+        mute_minutes: int = 15,
+    ):
+        self.rate = rate
+        self.window = window
+        self.same = same
+        self.consecutive = consecutive
+        self.mute_minutes = mute_minutes
+
+    @classmethod
+    def deserialize(cls, json_object: dict[str, Any]) -> SpamThresholds:
+        """
+        :raises: ValueError if a threshold isn't a number or out of range
+        """
+        try:
+            thresholds = cls(
+                int(json_object.get("rate", 10)),
+                float(json_object.get("window", 10)),
+                int(json_object.get("same", 4)),
+                int(json_object.get("consecutive", 15)),
+                int(json_object.get("mute_minutes", 15)),
+            )
+        except (TypeError, ValueError) as e:
+            raise ValueError("Thresholds have to be numbers") from e
+
+        for field in ("rate", "same", "consecutive"):
+            if getattr(thresholds, field) < 0:
+                raise ValueError(f"{field} can't be negative")
+        if not math.isfinite(thresholds.window) or thresholds.window <= 0:
+            raise ValueError("window has to be positive")
+        if not 0 < thresholds.mute_minutes <= cls.MAX_MUTE_MINUTES:
+            raise ValueError(
+                f"mute_minutes has to be between 1 and {cls.MAX_MUTE_MINUTES}"
+            )
+
+        return thresholds
+
+    def serialize(self) -> dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __eq__(self, other: object) -> bool:
+        # compared when the settings are reloaded
+        return (
+            isinstance(other, SpamThresholds) and self.serialize() == other.serialize()
+        )
+
+    def __str__(self) -> str:
+        return " ".join(f"{field}={getattr(self, field)}" for field in self.FIELDS)
+
+
+class _UserWindow:
+    __slots__ = ("times", "contents", "counts")
+
+    def __init__(self, size: int):
+        self.times: deque[float] = deque(maxlen=size)
+        self.contents: deque[Hashable] = deque(maxlen=size)
+        # number of occurrences of every content in `contents`
+        self.counts: dict[Hashable, int] = {}
+
+    def _drop_oldest(self) -> None:
+        self.times.popleft()
+        content = self.contents.popleft()
+        if content is None:
+            return
+
+        count = self.counts[content] - 1
+        if count:
+            self.counts[content] = count
+        else:
+            del self.counts[content]
+
+    def add(self, now: float, content: Hashable | None, window: float) -> None:
+        while self.times and (
+            now - self.times[0] > window or len(self.times) == self.times.maxlen
+        ):
+            self._drop_oldest()
+
+        self.times.append(now)
+        self.contents.append(content)
+        if content is not None:
+            self.counts[content] = self.counts.get(content, 0) + 1
+
+
+class _ChatWindows:
+    __slots__ = ("users", "last_user_id", "consecutive")
+
+    def __init__(self):
+        self.users: OrderedDict[int, _UserWindow] = OrderedDict()
+        self.last_user_id: int | None = None
+        # times of the messages of the current run of `last_user_id`
+        self.consecutive: deque[float] = deque()
+
+
+class SpamDetector:
+    def __init__(self, max_users: int = 1000, max_chats: int = 10000):
+        self.max_users = max_users
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, _ChatWindows] = OrderedDict()
+
+    def feed(
+        self,
+        chat_id: int,
+        user_id: int,
+        content: Hashable | None,
+        thresholds: SpamThresholds,
+        now: float | None = None,
+    ) -> SpamType:
+        """
+        Adds a message to the windows of the user
+        :param content: Hashable | None Identifies the content (e.g. the text), `None` if unknown
+        :return: SpamType The kind of spam detected, `SpamType.NONE` for none
+        """
+        if now is None:
+            now = time.monotonic()
+
+        chat_windows = self._chats.get(chat_id)
+        if chat_windows is None:
+            chat_windows = self._chats[chat_id] = _ChatWindows()
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+
+        if chat_windows.last_user_id != user_id:
+            chat_windows.last_user_id = user_id
+            chat_windows.consecutive.clear()
+        run = chat_windows.consecutive
+        while run and (
+            now - run[0] > thresholds.window
+            or len(run) >= max(thresholds.consecutive, 1)
+        ):
+            run.popleft()
+        run.append(now)
+
+        size = max(thresholds.rate, thresholds.same, 1)
+        window = chat_windows.users.get(user_id)
+        if window is None or window.times.maxlen != size:
+            window = chat_windows.users[user_id] = _UserWindow(size)
+            if len(chat_windows.users) > self.max_users:
+                chat_windows.users.popitem(last=False)
+        else:
+            chat_windows.users.move_to_end(user_id)
+
+        window.add(now, content, thresholds.window)
+
+        if thresholds.same and content is not None:
+            if window.counts[content] >= thresholds.same:
+                return SpamType.SAME
+        if thresholds.rate and len(window.times) >= thresholds.rate:
+            return SpamType.DIFFERENT
+        if (
+            thresholds.consecutive
+            and len(chat_windows.consecutive) >= thresholds.consecutive
+        ):
+            return SpamType.CONSECUTIVE
+
+        return SpamType.NONE
+
+    def reset(self, chat_id: int, user_id: int) -> None:
+        chat_windows = self._chats.get(chat_id)
+        if chat_windows is None:
+            return
+
+        chat_windows.users.pop(user_id, None)
+        if chat_windows.last_user_id == user_id:
+            chat_windows.last_user_id = None
+            chat_windows.consecutive.clear()
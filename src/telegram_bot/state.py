@@ -0,0 +1,297 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any
+
+from . import snapshot
+from .logger import create_logger
+
+JSON_FORMAT = "json"
+SNAPSHOT_FORMAT = "snapshot"
+
+
+def state_format() -> str:
+    value = os.getenv("STATE_FORMAT", JSON_FORMAT).strip().lower()
+    if value not in (JSON_FORMAT, SNAPSHOT_FORMAT):
+        raise ValueError(f"Unknown STATE_FORMAT `{value}`")
+
+    return value
+
+
+class FsyncPolicy:
+    """
+    Decides when written data is forced to disk.
+
+    `always` syncs after every write, `interval` at most once every `interval` seconds
+    and `never` leaves it to the OS.
+    """
+
+    ALWAYS = "always"
+    INTERVAL = "interval"
+    NEVER = "never"
+
+    def __init__(self, mode: str = ALWAYS, interval: float = 1.0):
+        if mode not in (self.ALWAYS, self.INTERVAL, self.NEVER):
+            raise ValueError(f"Unknown fsync policy `{mode}`")
+
+        self.mode = mode
+        self.interval = interval
+        self._last_sync = 0.0
+
+    @classmethod
+    def from_env(cls) -> "FsyncPolicy":
+        """
+        Used outside of the bots, which apply the `state_fsync` setting
+        """
+        return cls(
+            os.getenv("STATE_FSYNC", cls.ALWAYS).strip().lower(),
+            float(os.getenv("STATE_FSYNC_INTERVAL", 1.0)),
+        )
+
+    def should_sync(self) -> bool:
+        if self.mode == self.ALWAYS:
+            return True
+        elif self.mode == self.NEVER:
+            return False
+
+        now = time.monotonic()
+        if now - self._last_sync >= self.interval:
+            self._last_sync = now
+            return True
+
+        return False
+
+
+def state_backups() -> int:
+    return int(os.getenv("STATE_BACKUPS", 3))
+
+
+def backup_filepath(filepath: str, index: int) -> str:
+    return f"{filepath}.{index}"
+
+
+def fsync_directory(filepath: str) -> None:
+    directory = os.path.dirname(os.path.abspath(filepath))
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # not supported on every platform
+        return
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(
+    filepath: str,
+    data: bytes,
+    *,
+    fsync_policy: FsyncPolicy | None = None,
+    backups: int = 0,
+) -> None:
+    """
+    Writes `data` to a temporary file and renames it to `filepath` afterwards,
+    `filepath` therefore either contains the old or the new content, never a partial write.
+
+    :param fsync_policy: FsyncPolicy Decides whether the data is synced to disk before renaming
+    :param backups: int Number of previous versions to keep as `filepath.1` (newest) to `filepath.N`
+    """
+    sync = fsync_policy.should_sync() if fsync_policy else False
+    tmp_filepath = f"{filepath}.tmp"
+
+    with open(tmp_filepath, "wb") as f:
+        f.write(data)
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+
+    if backups > 0 and os.path.exists(filepath):
+        for index in range(backups - 1, 0, -1):
+            older = backup_filepath(filepath, index)
+            if os.path.exists(older):
+                os.replace(older, backup_filepath(filepath, index + 1))
+        os.replace(filepath, backup_filepath(filepath, 1))
+
+    os.replace(tmp_filepath, filepath)
+    if sync:
+        fsync_directory(filepath)
+
+
+def encode_state(state: dict[str, Any], fmt: str | None = None) -> bytes:
+    if (fmt or state_format()) == SNAPSHOT_FORMAT:
+        return snapshot.dumps(state)
+
+    return json.dumps(state, default=_decode_encoded_chat).encode("utf-8")
+
+
+def _decode_encoded_chat(value: Any) -> dict[str, Any]:
+    if isinstance(value, snapshot.EncodedChat):
+        return value.decode()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def decode_state(data: bytes) -> dict[str, Any]:
+    """
+    Decodes a state written by `encode_state`, the format is detected from the content
+    :raises: ValueError if the content is neither a valid snapshot nor valid JSON
+    """
+    if snapshot.is_snapshot(data):
+        return snapshot.loads(data)
+
+    state = json.loads(data)
+    if not isinstance(state, dict):
+        raise ValueError("State is not a JSON object")
+
+    return state
+
+
+def load_state(filepath: str, backups: int | None = None) -> dict[str, Any]:
+    """
+    Loads the state from `filepath`, falls back to the newest valid backup if `filepath`
+    is missing or corrupt.
+
+    :raises: FileNotFoundError if neither the state file nor a backup exists
+    :raises: ValueError if no existing file contains a valid state
+    """
+    logger = create_logger("load_state")
+    if backups is None:
+        backups = state_backups()
+
+    candidates = [filepath] + [
+        backup_filepath(filepath, index) for index in range(1, backups + 1)
+    ]
+    errors = []
+    for candidate in candidates:
+        try:
+            with open(candidate, "rb") as f:
+                state = decode_state(f.read())
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logger.warning("Invalid state in %s: %s", candidate, e)
+            errors.append(f"{candidate}: {e}")
+            continue
+
+        if candidate != filepath:
+            logger.warning("Restored state from backup %s", candidate)
+        return state
+
+    if errors:
+        raise ValueError(f"No valid state found ({'; '.join(errors)})")
+
+    raise FileNotFoundError(filepath)
+
+
+def dump_state(
+    filepath: str,
+    state: dict[str, Any],
+    fmt: str | None = None,
+    fsync_policy: FsyncPolicy | None = None,
+) -> None:
+    data = encode_state(state, fmt)
+    atomic_write(
+        filepath,
+        data,
+        fsync_policy=fsync_policy or FsyncPolicy.from_env(),
+        backups=state_backups(),
+    )
+
+
+class StateWriter:
+    """
+    Writes states with `dump_state` in a background thread, so handlers don't wait for it.
+
+    Only the latest submitted state is written if several are pending, the `after` callbacks of
+    all of them are called once it has been written. The submitted state must not be changed
+    afterwards. Encoding happens in `encoder` (e.g. a `ProcessPoolExecutor`) if given, writes
+    happen in the order of their submission.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        fsync_policy: FsyncPolicy | None = None,
+        encoder: Executor | None = None,
+        backups: int | None = None,
+    ):
+        """
+        :param backups: int | None The number of backups, `STATE_BACKUPS` if `None`
+        """
+        self.logger = create_logger("state_writer")
+        self.filepath = filepath
+        self.fsync_policy = fsync_policy or FsyncPolicy.from_env()
+        self.encoder = encoder
+        self.backups = backups
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="state_writer"
+        )
+        self._lock = threading.Lock()
+        self._pending: dict[str, Any] | None = None
+        # callbacks of the pending state and of the states it replaced
+        self._after: list[Callable[[], None]] = []
+
+    def submit(
+        self, state: dict[str, Any], after: Callable[[], None] | None = None
+    ) -> None:
+        """
+        :param after: Callable Called in the writer thread once `state` has been written
+        """
+        with self._lock:
+            self._pending = state
+            if after:
+                self._after.append(after)
+        self._executor.submit(self._write_pending)
+
+    def _write_pending(self) -> None:
+        with self._lock:
+            state, self._pending = self._pending, None
+            callbacks, self._after = self._after, []
+        # already written by a previous call
+        if state is None:
+            return
+
+        try:
+            fmt = state_format()
+            if self.encoder:
+                data = self.encoder.submit(encode_state, state, fmt).result()
+            else:
+                data = encode_state(state, fmt)
+            atomic_write(
+                self.filepath,
+                data,
+                fsync_policy=self.fsync_policy,
+                backups=state_backups() if self.backups is None else self.backups,
+            )
+        except Exception:
+            self.logger.error("Failed to write state", exc_info=True)
+            return
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def call(self, function: Callable[[], Any]) -> None:
+        """
+        Calls `function` in the writer thread once the previously submitted states have been written
+        """
+        self._executor.submit(self._call, function)
+
+    def _call(self, function: Callable[[], Any]) -> None:
+        try:
+            function()
+        except Exception:
+            self.logger.error("Failed to call %s", function, exc_info=True)
+
+    def flush(self) -> None:
+        """
+        Blocks until all submitted states have been written
+        """
+        self._executor.submit(lambda: None).result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any
+
+from .config import LiveConfig, Settings
+from .gatekeeping import TtlCache
+from .memory import MemoryProfiler
+from .metrics import Metrics
+from .transport import InstrumentedRequest
+
+
+class Tenant:
+    """
+    A bot instance hosted by this process
+    """
+
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        state_filepath: str,
+        hhh_id: int | None = None,
+        main_admin_ids: set[int] | None = None,
+    ):
+        self.name = name
+        self.token = token
+        self.state_filepath = state_filepath
+        # `None` uses the `hhh_id` setting
+        self.hhh_id = hhh_id
+        # `None` reads them from `MAIN_ADMIN_IDS`
+        self.main_admin_ids = main_admin_ids
+
+    @classmethod
+    def deserialize(cls, json_object: dict[str, Any], state_directory: str) -> Tenant:
+        try:
+            name = str(json_object["name"])
+            token = str(json_object["token"]).strip()
+        except KeyError as e:
+            raise ValueError(f"Tenant is missing `{e.args[0]}`") from e
+
+        main_admin_ids = json_object.get("main_admin_ids")
+        hhh_id = json_object.get("hhh_id")
+        return cls(
+            name,
+            token,
+            json_object.get(
+                "state_file", os.path.join(state_directory, f"state.{name}.json")
+            ),
+            hhh_id=int(hhh_id) if hhh_id is not None else None,
+            main_admin_ids=(
+                {int(admin_id) for admin_id in main_admin_ids}
+                if main_admin_ids is not None
+                else None
+            ),
+        )
+
+    def __repr__(self) -> str:
+        return f"<Tenant {self.name}>"
+
+
+def load_tenants(state_directory: str) -> list[Tenant] | None:
+    """
+    Reads the tenants from `BOT_TENANTS` (a JSON list) or the JSON file at `TENANTS_FILE`.
+    Every entry needs a `name` and a `token` and may set `hhh_id`, `state_file` and `main_admin_ids`.
+
+    :return: list[Tenant] | None `None` if no tenants are configured
+    """
+    if raw_value := os.getenv("BOT_TENANTS"):
+        content = json.loads(raw_value)
+    elif filename := os.getenv("TENANTS_FILE"):
+        with open(filename) as f:
+            content = json.load(f)
+    else:
+        return None
+
+    if not isinstance(content, list) or not content:
+        raise ValueError("Tenants have to be a non-empty JSON list")
+
+    tenants = [Tenant.deserialize(entry, state_directory) for entry in content]
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("Tenant names have to be unique")
+
+    return tenants
+
+
+class SharedResources:
+    """
+    Everything shared between the tenants of this process
+    """
+
+    def __init__(self, tenant_count: int = 1):
+        self.config = LiveConfig.from_env()
+        self.metrics = Metrics()
+        # long polling doesn't wait for connections used by outgoing calls,
+        # every tenant keeps one `get_updates` request open
+        self.get_updates_request = InstrumentedRequest.from_env(
+            "get_updates",
+            self.metrics,
+            "GET_UPDATES_HTTP",
+            connection_pool_size=tenant_count,
+        )
+        self.request = InstrumentedRequest.from_env(
+            "bot_api", self.metrics, "HTTP", connection_pool_size=256
+        )
+        # encodes the states of all tenants, the event loop threads only take snapshots
+        encode_processes = int(os.getenv("STATE_ENCODE_PROCESSES", 0))
+        self.encoder: Executor | None = (
+            ProcessPoolExecutor(
+                encode_processes, mp_context=multiprocessing.get_context("spawn")
+            )
+            if encode_processes
+            else None
+        )
+        # premium status doesn't depend on the bot asking for it
+        self.verdicts = TtlCache(self.config.settings.gatekeeping_verdict_ttl)
+        # tracemalloc traces the whole process
+        self.memory = MemoryProfiler.from_env()
+        self.config.subscribe(self._apply_settings)
+
+    def _apply_settings(self, settings: Settings) -> None:
+        self.verdicts.ttl = settings.gatekeeping_verdict_ttl
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import os
+import time
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest, RequestData
+
+from .metrics import Metrics
+
+
+def _optional_float(name: str, default: float | None) -> float | None:
+    raw_value = os.getenv(name)
+    if raw_value is None:
+        return default
+    # `none` disables the timeout
+    if raw_value.strip().lower() in ("", "none"):
+        return None
+
+    return float(raw_value)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    `HTTPXRequest` which reports its pool usage as `hhh_http_*` metrics, labeled with `pool`.
+
+    Saturation shows as `hhh_http_requests_in_flight` close to `hhh_http_pool_size`
+    and as increasing `hhh_http_pool_timeouts_total` (requests which didn't get a connection).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        metrics: Metrics,
+        connection_pool_size: int = 1,
+        keepalive_connections: int | None = None,
+        keepalive_expiry: float | None = 5,
+        **kwargs,
+    ):
+        limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=(
+                connection_pool_size
+                if keepalive_connections is None
+                else keepalive_connections
+            ),
+            keepalive_expiry=keepalive_expiry,
+        )
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            httpx_kwargs={"limits": limits},
+            **kwargs,
+        )
+        self.name = name
+        self.metrics = metrics
+        self.in_flight = 0
+        metrics.set("hhh_http_pool_size", connection_pool_size, pool=name)
+        metrics.gauge("hhh_http_requests_in_flight", lambda: self.in_flight, pool=name)
+
+    @classmethod
+    def from_env(
+        cls,
+        name: str,
+        metrics: Metrics,
+        prefix: str,
+        connection_pool_size: int,
+        read_timeout: float | None = 5,
+    ) -> InstrumentedRequest:
+        """
+        Reads `<prefix>_POOL_SIZE`, `<prefix>_KEEPALIVE_CONNECTIONS`, `<prefix>_KEEPALIVE_EXPIRY`,
+        `<prefix>_{READ,WRITE,CONNECT,POOL,MEDIA_WRITE}_TIMEOUT` and `<prefix>_VERSION`
+        """
+        keepalive_connections = os.getenv(f"{prefix}_KEEPALIVE_CONNECTIONS")
+        return cls(
+            name,
+            metrics,
+            connection_pool_size=int(
+                os.getenv(f"{prefix}_POOL_SIZE", connection_pool_size)
+            ),
+            keepalive_connections=(
+                int(keepalive_connections) if keepalive_connections else None
+            ),
+            keepalive_expiry=_optional_float(f"{prefix}_KEEPALIVE_EXPIRY", 5),
+            read_timeout=_optional_float(f"{prefix}_READ_TIMEOUT", read_timeout),
+            write_timeout=_optional_float(f"{prefix}_WRITE_TIMEOUT", 5),
+            connect_timeout=_optional_float(f"{prefix}_CONNECT_TIMEOUT", 5),
+            pool_timeout=_optional_float(f"{prefix}_POOL_TIMEOUT", 1),
+            media_write_timeout=_optional_float(f"{prefix}_MEDIA_WRITE_TIMEOUT", 20),
+            # HTTP/2 multiplexes requests over few connections,
+            # it requires `python-telegram-bot[http2]`
+            http_version=os.getenv(f"{prefix}_VERSION", "1.1"),  # type: ignore[arg-type]
+        )
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        *args,
+        **kwargs,
+    ) -> tuple[int, bytes]:
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                self.metrics.inc("hhh_http_pool_timeouts_total", pool=self.name)
+            else:
+                self.metrics.inc("hhh_http_timeouts_total", pool=self.name)
+            raise
+        finally:
+            self.in_flight -= 1
+            self.metrics.inc("hhh_http_requests_total", pool=self.name)
+            self.metrics.inc(
+                "hhh_http_request_seconds_total",
+                time.perf_counter() - start,
+                pool=self.name,
+            )
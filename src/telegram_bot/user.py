@@ -1,11 +1,82 @@
 from __future__ import annotations
 
+from datetime import datetime
 from typing import Any
 
 from telegram import Message
 from telegram import User as TUser
 
 
+class Activity:
+    """
+    Message counters of the current day, the current week and of all time.
+    Serialized compactly as `[total, day, day count, week, week count]`,
+    `day` and `week` are numbered from 0001-01-01 (weeks start on monday).
+    """
+
+    DAY = "day"
+    WEEK = "week"
+    ALL = "all"
+
+    PERIODS = (DAY, WEEK, ALL)
+
+    __slots__ = ("total", "day", "day_count", "week", "week_count")
+
+    def __init__(self):
+        self.total = 0
+        self.day = 0
+        self.day_count = 0
+        self.week = 0
+        self.week_count = 0
+
+    @staticmethod
+    def _buckets(now: datetime) -> tuple[int, int]:
+        day = now.toordinal()
+        return day, (day - 1) // 7
+
+    def record(self, now: datetime) -> None:
+        day, week = self._buckets(now)
+        if day != self.day:
+            self.day = day
+            self.day_count = 0
+        if week != self.week:
+            self.week = week
+            self.week_count = 0
+
+        self.total += 1
+        self.day_count += 1
+        self.week_count += 1
+
+    def count(self, period: str = ALL, now: datetime | None = None) -> int:
+        if period == self.ALL:
+            return self.total
+
+        day, week = self._buckets(now or datetime.now())
+        if period == self.DAY:
+            return self.day_count if day == self.day else 0
+        if period == self.WEEK:
+            return self.week_count if week == self.week else 0
+
+        raise ValueError(f"Unknown period `{period}`")
+
+    @classmethod
+    def deserialize(cls, values: list[int] | None) -> Activity:
+        activity = cls()
+        if values:
+            (
+                activity.total,
+                activity.day,
+                activity.day_count,
+                activity.week,
+                activity.week_count,
+            ) = values
+
+        return activity
+
+    def serialize(self) -> list[int]:
+        return [self.total, self.day, self.day_count, self.week, self.week_count]
+
+
 class User:
     def __init__(self, name: str, _id: int, chat_user: TUser | None = None):
         self.name = name
@@ -13,6 +84,7 @@ class User:
         self._internal = chat_user
         self.muted = False
         self.messages: set[Message] = set()
+        self.activity = Activity()
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, User):
@@ -36,8 +108,14 @@ class User:
     def deserialize(cls, json: dict[str, Any]) -> User:
         user = User(json.get("name"), json.get("id"))  # type: ignore
         user.muted = json.get("muted", False)
+        user.activity = Activity.deserialize(json.get("activity"))
 
         return user
 
     def serialize(self) -> dict[str, Any]:
-        return {"name": self.name, "muted": self.muted, "id": self.id}
+        return {
+            "name": self.name,
+            "muted": self.muted,
+            "id": self.id,
+            "activity": self.activity.serialize(),
+        }
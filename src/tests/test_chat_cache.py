@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+from typing import Any
+
+from telegram_bot import snapshot
+from telegram_bot.chat import Chat, User
+from telegram_bot.chat_cache import ChatCache
+
+# `ChatCache.load` compares with the current time
+NOW = datetime.now()
+
+
+def _serialized(
+    chat_id: int, idle_days: int = 0, muted: bool = False
+) -> dict[str, Any]:
+    chat = Chat(chat_id, None)  # type: ignore[arg-type]
+    chat.title = f"chat {chat_id}"
+    chat.last_chat_event_time = NOW - timedelta(days=idle_days)
+    user = User("user", 1)
+    user.muted = muted
+    chat.add_user(user)
+
+    return chat.serialize()
+
+
+def _cache(**kwargs) -> ChatCache:
+    return ChatCache(None, **kwargs)  # type: ignore[arg-type]
+
+
+def test_load_keeps_idle_chats_encoded() -> None:
+    cache = _cache(idle_timeout=timedelta(days=7))
+    cache.load(
+        [_serialized(-1), _serialized(-2, idle_days=30), _serialized(-3, 30, True)]
+    )
+
+    assert len(cache) == 3
+    # muted users keep their chat in memory, materialized chats are iterated first
+    assert list(cache) == [-1, -3, -2]
+    assert cache.summary(-2).title == "chat -2"  # type: ignore[union-attr]
+    assert cache.resident_count == 2
+
+
+def test_access_materializes_evicted_chat() -> None:
+    cache = _cache(idle_timeout=timedelta(days=7))
+    cache.load([_serialized(-2, idle_days=30)])
+
+    chat = cache[-2]
+
+    assert chat.title == "chat -2"
+    assert [user.name for user in chat.users] == ["user"]
+    assert cache.resident_count == 1
+
+
+def test_least_recently_used_chats_are_evicted() -> None:
+    evicted: list[int] = []
+    cache = _cache(max_resident=2, on_evict=evicted.append)
+    cache.load([_serialized(-1), _serialized(-2)])
+
+    cache.get(-1)
+    cache[-3] = Chat.deserialize(_serialized(-3), None)  # type: ignore[arg-type,assignment]
+
+    assert evicted == [-2]
+    assert list(cache) == [-1, -3, -2]
+
+
+def test_pinned_chats_are_not_evicted() -> None:
+    cache = _cache(idle_timeout=timedelta(days=7))
+    cache.load([_serialized(-1, idle_days=1)])
+
+    with cache.pinned(-1):
+        assert cache.evict_idle(NOW + timedelta(days=30)) == 0
+    assert cache.evict_idle(NOW + timedelta(days=30)) == 1
+    assert cache.resident_count == 0
+
+
+def test_serialize_without_materializing() -> None:
+    cache = _cache(idle_timeout=timedelta(days=7))
+    cache.load([_serialized(-1), _serialized(-2, idle_days=30)])
+
+    encoded = cache.serialize_encoded()
+
+    assert isinstance(encoded[1], snapshot.EncodedChat)
+    assert cache.serialize()[1] == _serialized(-2, idle_days=30)
+    assert cache.resident_count == 1
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from telegram_bot.config import ConfigError, LiveConfig, Settings
+from telegram_bot.spam import SpamThresholds
+
+
+def _write(path, values: dict) -> str:
+    path.write_text(json.dumps(values))
+    return str(path)
+
+
+def test_file_takes_precedence_over_environment(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("MUTE_MINUTES", "20")
+    monkeypatch.setenv("USERS_PAGE_SIZE", "10")
+    monkeypatch.setenv("SPAM_THRESHOLDS", '{"rate": 5}')
+
+    settings = Settings.load(_write(tmp_path / "config.json", {"mute_minutes": 30}))
+
+    assert settings.mute_minutes == 30
+    assert settings.users_page_size == 10
+    assert settings.spam_thresholds == SpamThresholds(rate=5)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        {"mute_minutes": 1.5},
+        {"chat_cache_size": True},
+        {"spam_detection": 1},
+        {"state_fsync": "sometimes"},
+        {"spam_thresholds": {"rate": 2.5}},
+        {"message_length": 50},
+        {"unknown": 1},
+    ],
+)
+def test_invalid_values_are_rejected(tmp_path, values) -> None:
+    with pytest.raises(ConfigError):
+        Settings.load(_write(tmp_path / "config.json", values))
+
+
+def test_reload_notifies_listeners(tmp_path) -> None:
+    filepath = _write(tmp_path / "config.json", {"mute_minutes": 30})
+    config = LiveConfig(filepath)
+    received: list[Settings] = []
+    config.subscribe(received.append)
+
+    _write(tmp_path / "config.json", {"mute_minutes": 45, "spam_detection": True})
+    assert config.reload()
+    # unchanged settings don't notify
+    assert config.reload()
+
+    assert [settings.mute_minutes for settings in received] == [30, 45]
+    assert received[-1].spam_detection is True
+
+
+def test_invalid_reload_keeps_previous_settings(tmp_path) -> None:
+    filepath = _write(tmp_path / "config.json", {"mute_minutes": 30})
+    config = LiveConfig(filepath)
+
+    _write(tmp_path / "config.json", {"mute_minutes": 0})
+    assert not config.reload()
+    (tmp_path / "config.json").write_text("{")
+    assert not config.reload()
+
+    assert config.settings.mute_minutes == 30
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("[1, 2]", {1, 2}), ("[1, ", set()), ("1", set()), ('[1, "admin"]', {1})],
+)
+def test_malformed_main_admin_ids_are_ignored(monkeypatch, value, expected) -> None:
+    monkeypatch.setenv("MAIN_ADMIN_IDS", value)
+
+    assert Settings.load().main_admin_ids == expected
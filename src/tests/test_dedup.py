@@ -0,0 +1,28 @@
+from telegram_bot.dedup import RecentKeys
+
+
+def test_duplicates_are_detected() -> None:
+    keys = RecentKeys(3)
+
+    assert keys.add(1)
+    assert not keys.add(1)
+    assert 1 in keys
+
+
+def test_oldest_keys_are_forgotten() -> None:
+    keys = RecentKeys(3, [1, 2, 3, 4])
+
+    assert 1 not in keys
+    assert keys.serialize() == [2, 3, 4]
+
+    keys.max_size = 2
+    keys.add(5)
+    assert keys.serialize() == [4, 5]
+    assert len(keys) == 2
+
+
+def test_newest() -> None:
+    keys = RecentKeys(10, [3, 1, 2])
+
+    assert keys.newest(2) == [1, 2]
+    assert keys.newest(5) == [3, 1, 2]
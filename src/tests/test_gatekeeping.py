@@ -0,0 +1,112 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram import User as TUser
+from telegram.error import Forbidden
+
+from telegram_bot.chat import Chat, User
+from telegram_bot.chat_cache import ChatCache
+from telegram_bot.gatekeeping import Gatekeeper, TtlCache
+
+
+def test_ttl_cache_expires_entries(monkeypatch) -> None:
+    now = 100.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    cache = TtlCache(10)
+    cache.set("key", True)
+
+    assert cache.get("key") is True
+    now = 111.0
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_is_bounded() -> None:
+    cache = TtlCache(10, max_size=2)
+    for key in range(3):
+        cache.set(key, key)
+
+    assert cache.get(0) is None
+    assert [cache.get(1), cache.get(2)] == [1, 2]
+
+
+class FakeBot:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.kicked: list[tuple[int, int]] = []
+        self.chats = ChatCache(None)  # type: ignore[arg-type]
+        self.application = SimpleNamespace(bot=self)
+
+    async def kick_user(self, chat: Chat, user_id: int) -> None:
+        self.kicked.append((chat.id, user_id))
+        if self.fail:
+            raise Forbidden("not enough rights")
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        return SimpleNamespace(user=_tuser(user_id, premium=user_id % 2 == 0))
+
+    def record_change(self, *args, **kwargs) -> None:
+        pass
+
+    def save_state(self) -> None:
+        pass
+
+
+def _tuser(user_id: int, premium: bool = False) -> TUser:
+    return TUser(user_id, f"user {user_id}", is_bot=False, is_premium=premium)
+
+
+def _chat(fake_bot: FakeBot, *user_ids: int) -> Chat:
+    chat = Chat(-100, None)  # type: ignore[arg-type]
+    chat.premium_users_only = True
+    for user_id in user_ids:
+        chat.add_user(User(f"user {user_id}", user_id))
+    fake_bot.chats[chat.id] = chat
+
+    return chat
+
+
+def test_non_premium_users_are_kicked() -> None:
+    fake_bot = FakeBot()
+    gatekeeper = Gatekeeper(fake_bot)  # type: ignore[arg-type]
+    chat = _chat(fake_bot, 1, 2)
+
+    async def enforce() -> list[bool]:
+        return [
+            await gatekeeper.enforce(chat, _tuser(1)),
+            await gatekeeper.enforce(chat, _tuser(2, premium=True)),
+        ]
+
+    assert asyncio.run(enforce()) == [False, True]
+    assert fake_bot.kicked == [(-100, 1)]
+    assert [user.id for user in chat.users] == [2]
+
+
+def test_failed_kicks_are_not_repeated_within_ttl() -> None:
+    fake_bot = FakeBot(fail=True)
+    gatekeeper = Gatekeeper(fake_bot)  # type: ignore[arg-type]
+    chat = _chat(fake_bot, 1)
+
+    async def enforce() -> None:
+        for _ in range(3):
+            assert not await gatekeeper.enforce(chat, _tuser(1))
+
+    asyncio.run(enforce())
+
+    assert fake_bot.kicked == [(-100, 1)]
+    assert [user.id for user in chat.users] == [1]
+
+
+def test_sweep_checks_every_member_once() -> None:
+    fake_bot = FakeBot()
+    gatekeeper = Gatekeeper(fake_bot, sweep_concurrency=2)  # type: ignore[arg-type]
+    chat = _chat(fake_bot, 1, 2, 3, 4)
+    reports: list[str] = []
+
+    async def report(text: str) -> None:
+        reports.append(text)
+
+    assert asyncio.run(gatekeeper.sweep(chat, report)) == (4, 2)
+    assert sorted(fake_bot.kicked) == [(-100, 1), (-100, 3)]
+    assert reports[-1] == "Checked 4/4 users, kicked 2"
+    assert not gatekeeper.is_sweeping(chat)
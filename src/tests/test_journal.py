@@ -0,0 +1,111 @@
+from telegram_bot import journal
+from telegram_bot.journal import Journal
+
+
+def _state() -> dict:
+    return {
+        "chats": [{"id": -1, "title": "old", "users": [{"id": 7, "muted": False}]}],
+        journal.SEQUENCE_KEY: 0,
+    }
+
+
+def test_flush_and_read(tmp_path) -> None:
+    filepath = str(tmp_path / "state.json.journal")
+    writer = Journal(filepath)
+    writer.append(journal.CHAT_RENAMED, chat_id=-1, title="new")
+    writer.append(journal.CHAT_DELETED, chat_id=-1)
+
+    assert writer.flush() == 2
+    assert writer.flush() == 0
+    with open(filepath, "a") as f:
+        # partially written by a crash
+        f.write('{"seq": 3, "op": ')
+
+    reader = Journal(filepath)
+    records = reader.read()
+    assert [record["op"] for record in records] == [
+        journal.CHAT_RENAMED,
+        journal.CHAT_DELETED,
+    ]
+    assert reader.sequence == 2
+    assert [record["seq"] for record in reader.read(after=1)] == [2]
+
+
+def test_truncate_keeps_later_records(tmp_path) -> None:
+    writer = Journal(str(tmp_path / "state.json.journal"))
+    for title in ("a", "b", "c"):
+        writer.append(journal.CHAT_RENAMED, chat_id=-1, title=title)
+    writer.flush()
+
+    writer.truncate(2)
+
+    assert [record["title"] for record in writer.read()] == ["c"]
+    assert writer.size == 1
+
+
+def test_replay() -> None:
+    records = [
+        {"seq": 1, "op": journal.CHAT_RENAMED, "chat_id": -1, "title": "new"},
+        {
+            "seq": 2,
+            "op": journal.CHAT_ADDED,
+            "chat": {"id": -2, "title": "added", "users": []},
+        },
+        {
+            "seq": 3,
+            "op": journal.USER_MUTED,
+            "chat_id": -1,
+            "user_id": 7,
+            "muted": True,
+        },
+        {
+            "seq": 4,
+            "op": journal.UNMUTE_SCHEDULED,
+            "chat_id": -1,
+            "user_id": 7,
+            "timestamp": 100.0,
+        },
+        {"seq": 5, "op": journal.CHAT_MIGRATED, "from_id": -2, "to_id": -1002},
+        {"seq": 6, "op": journal.UPDATE_PROCESSED, "update_id": 42, "update_ids": [42]},
+    ]
+
+    state = journal.replay(_state(), records)
+
+    chats = {chat["id"]: chat for chat in state["chats"]}
+    assert chats[-1]["title"] == "new"
+    assert chats[-1]["users"][0]["muted"] is True
+    assert chats[-1002]["title"] == "added"
+    assert state["scheduled_unmutes"] == [
+        {"chat_id": -1, "user_id": 7, "timestamp": 100.0}
+    ]
+    assert state["last_update_id"] == 42
+    assert state["recent_update_ids"] == [42]
+    assert state[journal.SEQUENCE_KEY] == 6
+
+
+def test_replay_unmute_drops_scheduled_reset() -> None:
+    state = _state()
+    state["scheduled_unmutes"] = [{"chat_id": -1, "user_id": 7, "timestamp": 100.0}]
+    state = journal.replay(
+        state,
+        [
+            {
+                "seq": 1,
+                "op": journal.USER_MUTED,
+                "chat_id": -1,
+                "user_id": 7,
+                "muted": False,
+            }
+        ],
+    )
+
+    assert state["scheduled_unmutes"] == []
+
+
+def test_replay_skips_records_in_snapshot() -> None:
+    state = {**_state(), journal.SEQUENCE_KEY: 1}
+    state = journal.replay(
+        state, [{"seq": 1, "op": journal.CHAT_RENAMED, "chat_id": -1, "title": "new"}]
+    )
+
+    assert state["chats"][0]["title"] == "old"
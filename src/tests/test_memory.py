@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat as TChat
+from telegram import Message
+
+from telegram_bot.chat import Chat, User
+from telegram_bot.memory import MemoryProfiler, chat_report, object_counts
+from telegram_bot.search import SearchStore
+
+
+def _chat(chat_id: int, retained_messages: int) -> Chat:
+    chat = Chat(chat_id, None)  # type: ignore[arg-type]
+    chat.title = f"chat {chat_id}"
+    user = User("user", 1)
+    tchat = TChat(chat_id, TChat.SUPERGROUP)
+    user.messages = {
+        Message(message_id, datetime.now(), tchat)
+        for message_id in range(retained_messages)
+    }
+    chat.add_user(user)
+
+    return chat
+
+
+def test_chat_report_lists_most_messages_first() -> None:
+    search = SearchStore(max_messages=10)
+    search.add(-1, 1, 1, "hello")
+
+    lines = chat_report([_chat(-1, 1), _chat(-2, 3)], search)
+
+    assert lines[1:] == ["-2 | chat -2 | 1 | 3 | 0", "-1 | chat -1 | 1 | 1 | 1"]
+
+
+def test_object_counts() -> None:
+    counts = object_counts(3)
+
+    assert len(counts) == 3
+    assert counts[0][1] >= counts[-1][1]
+
+
+def test_profiler_reports_and_diffs() -> None:
+    profiler = MemoryProfiler(top=5)
+    search = SearchStore()
+
+    async def profile() -> list[str]:
+        assert profiler.start()
+        assert not profiler.start()
+        try:
+            return [
+                await profiler.report([_chat(-1, 1)], search),
+                await profiler.report([], search, diff=True),
+            ]
+        finally:
+            profiler.stop()
+
+    report, diff = asyncio.run(profile())
+
+    assert "Top 5 allocation sites\n" in report
+    assert "-1 | chat -1 | 1 | 1 | 0" in report
+    assert "Top 5 allocation sites since the last snapshot" in diff
+    assert not profiler.tracing
+    assert profiler.status() == "Not tracing"
+
+
+def test_report_requires_tracing() -> None:
+    with pytest.raises(RuntimeError):
+        asyncio.run(MemoryProfiler().report([], SearchStore()))
@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from telegram_bot.chat import Chat
+from telegram_bot.chat_cache import ChatCache
+from telegram_bot.metadata import ChatMetadataCache
+from telegram_bot.metrics import Metrics
+
+
+class FakeBot:
+    def __init__(self):
+        self.chats = ChatCache(None, idle_timeout=timedelta(days=7))  # type: ignore[arg-type]
+        self.application = SimpleNamespace(bot=self)
+        self.metrics = Metrics()
+        self.tenant = SimpleNamespace(name="test")
+        self.fetched: list[int] = []
+
+    async def get_chat(self, chat_id: int) -> SimpleNamespace:
+        self.fetched.append(chat_id)
+        return SimpleNamespace(
+            title=f"chat {chat_id}",
+            description=f"description {len(self.fetched)}",
+            invite_link=None,
+            permissions=None,
+        )
+
+    def record_change(self, *args, **kwargs) -> None:
+        pass
+
+    def save_state(self) -> None:
+        pass
+
+
+def _serialized(chat_id: int, idle_days: int) -> dict:
+    chat = Chat(chat_id, None)  # type: ignore[arg-type]
+    chat.title = f"chat {chat_id}"
+    chat.last_chat_event_time = datetime.now() - timedelta(days=idle_days)
+    return chat.serialize()
+
+
+def test_refresh_skips_evicted_chats() -> None:
+    fake_bot = FakeBot()
+    fake_bot.chats.load([_serialized(-1, 0), _serialized(-2, 30)])
+    cache = ChatMetadataCache(fake_bot, refresh_interval=0.01)  # type: ignore[arg-type]
+
+    async def refresh() -> None:
+        await cache.fetch(-1)
+        await cache.fetch(-2)
+        cache.invalidate(-1)
+        cache.invalidate(-2)
+
+        refresher = asyncio.create_task(cache.run())
+        await asyncio.sleep(0.05)
+        refresher.cancel()
+
+    asyncio.run(refresh())
+
+    assert fake_bot.fetched == [-1, -2, -1]
+    assert cache.stale() == []
+    # the metadata of evicted chats doesn't materialize them
+    assert fake_bot.chats.resident_count == 1
+    assert fake_bot.chats[-1].description == "description 3"
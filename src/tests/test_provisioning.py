@@ -0,0 +1,139 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram import ChatMember
+from telegram.error import NetworkError
+
+from telegram_bot.chat import Chat, ChatType
+from telegram_bot.chat_cache import ChatCache
+from telegram_bot.provisioning import InviteLinkProvisioner
+
+
+class FakeTelegramBot:
+    id = 1
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.attempts = 0
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        return SimpleNamespace(status=ChatMember.OWNER)
+
+    async def create_chat_invite_link(self, chat_id: int):
+        self.attempts += 1
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError("timed out")
+
+        return SimpleNamespace(invite_link=f"https://t.me/+{-chat_id}")
+
+
+def _provisioner(tbot: FakeTelegramBot, *chat_ids: int, **kwargs):
+    chats = ChatCache(None)  # type: ignore[arg-type]
+    for chat_id in chat_ids:
+        chat = Chat(chat_id, None)  # type: ignore[arg-type]
+        chat.title = f"chat {chat_id}"
+        chat.type = ChatType.SUPERGROUP
+        chats[chat_id] = chat
+
+    updated: list[int] = []
+
+    async def update_hhh_message(chat: Chat) -> None:
+        updated.append(chat.id)
+
+    hhh_bot = SimpleNamespace(
+        chats=chats,
+        application=SimpleNamespace(bot=tbot),
+        record_change=lambda *args, **kwargs: None,
+        save_state=lambda: None,
+        update_hhh_message=update_hhh_message,
+    )
+    provisioner = InviteLinkProvisioner(hhh_bot, **kwargs)  # type: ignore[arg-type]
+
+    return provisioner, chats, updated
+
+
+async def _run(provisioner: InviteLinkProvisioner, duration: float) -> None:
+    worker = asyncio.create_task(provisioner.run())
+    await asyncio.sleep(duration)
+    worker.cancel()
+
+
+def test_failures_are_retried_with_backoff() -> None:
+    tbot = FakeTelegramBot(failures=2)
+    provisioner, chats, _ = _provisioner(tbot, -100, backoff=0.01, batch_delay=0)
+
+    async def provision() -> None:
+        provisioner.enqueue(-100)
+        await _run(provisioner, 0.2)
+
+    asyncio.run(provision())
+
+    assert tbot.attempts == 3
+    assert chats[-100].invite_link == "https://t.me/+100"
+
+
+def test_gives_up_after_max_attempts() -> None:
+    tbot = FakeTelegramBot(failures=10)
+    provisioner, chats, _ = _provisioner(
+        tbot, -100, max_attempts=3, backoff=0.01, batch_delay=0
+    )
+
+    async def provision() -> None:
+        provisioner.enqueue(-100)
+        await _run(provisioner, 0.3)
+
+    asyncio.run(provision())
+
+    assert tbot.attempts == 3
+    assert chats[-100].invite_link is None
+
+
+def test_queued_chats_are_deduplicated() -> None:
+    tbot = FakeTelegramBot()
+    provisioner, _, _ = _provisioner(tbot, -100, batch_delay=0)
+
+    async def provision() -> None:
+        provisioner.enqueue(-100)
+        provisioner.enqueue(-100)
+        await _run(provisioner, 0.05)
+
+    asyncio.run(provision())
+
+    assert tbot.attempts == 1
+
+
+def test_changed_links_update_the_hhh_list_once() -> None:
+    tbot = FakeTelegramBot()
+    provisioner, _, updated = _provisioner(tbot, -100, -200, batch_delay=0.05)
+
+    async def provision() -> None:
+        provisioner.enqueue(-100)
+        provisioner.enqueue(-200)
+        await _run(provisioner, 0.2)
+
+    asyncio.run(provision())
+
+    assert tbot.attempts == 2
+    assert len(updated) == 1
+
+
+def test_unavailable_chats_are_queued_again_when_rights_change() -> None:
+    tbot = FakeTelegramBot(failures=1)
+    provisioner, chats, _ = _provisioner(tbot, -100, max_attempts=1, batch_delay=0)
+
+    async def provision() -> None:
+        provisioner.enqueue(-100)
+        await _run(provisioner, 0.05)
+        # gave up, not queued again until the refresh interval has passed
+        provisioner.enqueue(-100)
+        await _run(provisioner, 0.05)
+        assert tbot.attempts == 1
+
+        provisioner.rights_changed(-100, SimpleNamespace(status=ChatMember.OWNER))  # type: ignore[arg-type]
+        await _run(provisioner, 0.05)
+
+    asyncio.run(provision())
+
+    assert tbot.attempts == 2
+    assert chats[-100].invite_link == "https://t.me/+100"
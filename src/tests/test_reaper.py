@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Any
+
+from telegram.error import BadRequest, Forbidden, NetworkError, TelegramError
+
+from telegram_bot.chat import Chat, ChatType
+from telegram_bot.chat_cache import ChatCache
+from telegram_bot.metrics import Metrics
+from telegram_bot.reaper import UNREACHABLE_KEY, ChatReaper
+
+ERRORS: dict[int, TelegramError] = {
+    -1: Forbidden("Forbidden: bot was kicked from the supergroup chat"),
+    -2: BadRequest("Chat not found"),
+    -3: BadRequest("Some other problem"),
+    -4: NetworkError("timed out"),
+    7: Forbidden("Forbidden: bot was blocked by the user"),
+}
+
+
+class FakeBot:
+    def __init__(self, *chat_ids: int):
+        self.state: dict[str, Any] = {"hhh_id": -10}
+        self.chats = ChatCache(None)  # type: ignore[arg-type]
+        for chat_id in chat_ids:
+            chat = Chat(chat_id, None)  # type: ignore[arg-type]
+            chat.title = f"chat {chat_id}"
+            chat.type = ChatType.SUPERGROUP if chat_id < 0 else ChatType.PRIVATE
+            self.chats[chat_id] = chat
+        self.application = SimpleNamespace(bot=self)
+        self.metrics = Metrics()
+        self.tenant = SimpleNamespace(name="test")
+        self.shard_link = None
+        self.hhh_updates: list[int] = []
+
+    async def get_chat(self, chat_id: int) -> None:
+        if chat_id in ERRORS:
+            raise ERRORS[chat_id]
+
+    async def update_hhh_message(self, chat: Chat, delete: bool = False) -> None:
+        self.hhh_updates.append(chat.id)
+        if delete:
+            self.chats.pop(chat.id)
+
+    def create_latest_change_text(self, chat: Chat, text: str, delete: bool) -> str:
+        return f"deleted {chat.title}"
+
+    def update_recent_changes(self, text: str) -> None:
+        pass
+
+    def record_change(self, *args, **kwargs) -> None:
+        pass
+
+    def save_state(self) -> None:
+        pass
+
+
+def test_only_kicked_and_deleted_chats_are_unreachable() -> None:
+    fake_bot = FakeBot(-10, -1, -2, -3, -4, -5, 7)
+    reaper = ChatReaper(fake_bot)  # type: ignore[arg-type]
+
+    found = asyncio.run(reaper.find_unreachable())
+
+    # private chats are kept even if the user blocked the bot
+    assert sorted(found) == [-2, -1]
+
+
+def test_unreachable_chats_are_pruned_after_grace_period() -> None:
+    fake_bot = FakeBot(-1, -2, -5)
+    reaper = ChatReaper(fake_bot, grace_period=3600)  # type: ignore[arg-type]
+
+    results = asyncio.run(reaper.reap())
+
+    assert sorted(result.chat.id for result in results) == [-2, -1]
+    assert sorted(reaper.unreachable) == ["-1", "-2"]
+    assert len(fake_bot.chats) == 3
+
+    # unreachable since two hours
+    since = (datetime.now() - timedelta(hours=2)).isoformat()
+    fake_bot.state[UNREACHABLE_KEY] = {"-1": since, "-2": since}
+    asyncio.run(reaper.reap())
+
+    assert list(fake_bot.chats) == [-5]
+    # the HHH list is only updated once
+    assert len(fake_bot.hhh_updates) == 1
+    assert reaper.unreachable == {}
+    assert fake_bot.metrics.value("hhh_chats_pruned_total", tenant="test") == 2
+
+
+def test_reachable_chats_are_unmarked() -> None:
+    fake_bot = FakeBot(-1, -5)
+    fake_bot.state[UNREACHABLE_KEY] = {"-5": datetime.now().isoformat()}
+    reaper = ChatReaper(fake_bot)  # type: ignore[arg-type]
+
+    asyncio.run(reaper.reap())
+
+    assert list(reaper.unreachable) == ["-1"]
+
+
+def test_dry_run_changes_nothing() -> None:
+    fake_bot = FakeBot(-1)
+    reaper = ChatReaper(fake_bot, grace_period=0)  # type: ignore[arg-type]
+
+    results = asyncio.run(reaper.reap(dry_run=True))
+
+    assert [result.chat.id for result in results] == [-1]
+    assert reaper.unreachable == {}
+    assert list(fake_bot.chats) == [-1]
@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+from telegram_bot.metrics import Metrics
+from telegram_bot.scheduling import (
+    ADMIN_COMMAND,
+    MESSAGE,
+    STATUS,
+    PriorityUpdateProcessor,
+)
+
+
+def _update(update_id: int, text: str) -> Update:
+    chat = Chat(-100, Chat.SUPERGROUP)
+    message = Message(update_id, datetime.now(), chat, text=text)
+    return Update(update_id, message=message)
+
+
+def _processor(**kwargs) -> tuple[PriorityUpdateProcessor, Metrics]:
+    metrics = Metrics()
+    processor = PriorityUpdateProcessor(metrics, "test", **kwargs)
+    processor.admin_commands = {"mute"}
+
+    return processor, metrics
+
+
+def test_priority() -> None:
+    processor, _ = _processor()
+
+    assert processor.priority(_update(1, "/mute@hhh_bot 10")) == ADMIN_COMMAND
+    assert processor.priority(_update(2, "/help")) == STATUS
+    assert processor.priority(_update(3, "hello")) == MESSAGE
+    assert processor.priority(object()) == STATUS
+
+
+def test_admin_commands_are_handled_first() -> None:
+    processor, _ = _processor()
+    handled: list[int] = []
+    release = asyncio.Event()
+
+    async def handle(update_id: int) -> None:
+        if not handled:
+            await release.wait()
+        handled.append(update_id)
+
+    async def process() -> None:
+        tasks = [
+            asyncio.create_task(processor.process_update(update, handle(update_id)))
+            for update_id, update in enumerate(
+                [_update(1, "first"), _update(2, "hello"), _update(3, "/mute 10")]
+            )
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(process())
+
+    assert handled == [0, 2, 1]
+
+
+def test_updates_are_handled_one_at_a_time() -> None:
+    processor, _ = _processor()
+    running = 0
+    max_running = 0
+
+    async def handle() -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+
+    async def process() -> None:
+        await asyncio.gather(
+            *(
+                processor.process_update(_update(update_id, "hello"), handle())
+                for update_id in range(10)
+            )
+        )
+
+    asyncio.run(process())
+
+    assert max_running == 1
+
+
+def test_max_pending_bounds_accepted_updates() -> None:
+    processor, metrics = _processor(max_pending=2)
+    release = asyncio.Event()
+
+    async def process() -> float | None:
+        tasks = [
+            asyncio.create_task(
+                processor.process_update(_update(update_id, "hello"), release.wait())
+            )
+            for update_id in range(4)
+        ]
+        await asyncio.sleep(0.01)
+        # one is handled, one waits for its turn and the rest waits for the semaphore
+        waiting = metrics.value(
+            "hhh_update_queue_depth", tenant="test", priority="message"
+        )
+        assert processor.current_concurrent_updates == 2
+        release.set()
+        await asyncio.gather(*tasks)
+
+        return waiting
+
+    assert asyncio.run(process()) == 1
+    assert processor.current_concurrent_updates == 0
+
+
+def test_messages_are_shed_under_load() -> None:
+    processor, metrics = _processor(shed_threshold=1, sample_rate=0)
+    release = asyncio.Event()
+    handled: list[int] = []
+
+    async def handle(update_id: int) -> None:
+        await release.wait()
+        handled.append(update_id)
+
+    async def process() -> None:
+        tasks = [
+            asyncio.create_task(
+                processor.process_update(_update(update_id, text), handle(update_id))
+            )
+            for update_id, text in enumerate(["first", "second", "third", "/mute"])
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(process())
+
+    # the second message is waiting, so the third one is dropped but not the command
+    assert handled == [0, 3, 1]
+    assert metrics.value("hhh_updates_shed_total", tenant="test") == 1
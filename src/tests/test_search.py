@@ -0,0 +1,78 @@
+from telegram_bot.search import SearchIndex, SearchStore
+
+
+def test_search_matches_all_terms_newest_first() -> None:
+    index = SearchIndex()
+    index.add(1, 10, "Hello world")
+    index.add(2, 11, "hello there")
+    index.add(3, 12, "HELLO big World")
+
+    assert [result[0] for result in index.search("hello")] == [3, 2, 1]
+    assert index.search("world hello") == [
+        (3, 12, "HELLO big World"),
+        (1, 10, "Hello world"),
+    ]
+    assert index.search("missing") == []
+    assert index.search("a") == []
+
+
+def test_oldest_messages_are_evicted() -> None:
+    index = SearchIndex(max_messages=2)
+    for message_id in range(3):
+        index.add(message_id, 1, f"text {message_id}")
+
+    assert len(index) == 2
+    assert [result[0] for result in index.search("text")] == [2, 1]
+
+    index.resize(1)
+    assert [result[0] for result in index.search("text")] == [2]
+
+
+def test_store_is_disabled_by_default() -> None:
+    store = SearchStore()
+    store.add(-1, 1, 1, "hello")
+
+    assert store.get(-1) is None
+    assert not store.dirty
+
+
+def test_store_round_trip_rebuilds_postings() -> None:
+    store = SearchStore(max_messages=10)
+    store.add(-1, 1, 7, "hello world")
+    store.add(-2, 2, 8, "other chat")
+
+    loaded = SearchStore(max_messages=10)
+    loaded.load(store.serialize())
+
+    assert loaded.get(-1).search("world") == [(1, 7, "hello world")]  # type: ignore[union-attr]
+    assert loaded.get(-2).search("chat") == [(2, 8, "other chat")]  # type: ignore[union-attr]
+
+
+def test_disabling_drops_indexes() -> None:
+    store = SearchStore(max_messages=10)
+    store.add(-1, 1, 7, "hello")
+    serialized = store.serialize()
+    store.dirty = False
+
+    store.max_messages = 0
+    assert store.get(-1) is None
+    assert store.dirty
+
+    disabled = SearchStore()
+    disabled.load(serialized)
+    assert len(disabled) == 0
+    # written again, so the texts are removed from the disk
+    assert disabled.dirty
+
+
+def test_migrate_and_retain() -> None:
+    store = SearchStore(max_messages=10)
+    store.add(-1, 1, 7, "hello")
+    store.add(-2, 1, 7, "deleted")
+
+    store.migrate(-1, -1001)
+    store.retain({-1001})
+
+    assert store.get(-1) is None
+    assert store.get(-2) is None
+    assert store.get(-1001).search("hello") == [(1, 7, "hello")]  # type: ignore[union-attr]
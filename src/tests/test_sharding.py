@@ -0,0 +1,66 @@
+import asyncio
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, Message, Update
+
+from telegram_bot.metrics import Metrics
+from telegram_bot.sharding import ShardCoordinator, shard_of
+
+
+class FakeWriter:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.update_ids: list[int] = []
+
+    def write(self, data: bytes) -> None:
+        self.update_ids.append(json.loads(data)["update_id"])
+
+    async def drain(self) -> None:
+        if self.fail:
+            raise ConnectionResetError()
+
+
+def _update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(chat_id, Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat))
+
+
+def test_shard_of() -> None:
+    assert shard_of(-1001, 2) == 1
+    assert shard_of(-1002, 2) == 0
+
+
+def test_failed_updates_are_sent_again() -> None:
+    completed: list[int] = []
+
+    async def complete_update(update: Update) -> None:
+        completed.append(update.update_id)
+
+    hhh_bot = SimpleNamespace(
+        state={}, metrics=Metrics(), complete_update=complete_update
+    )
+    coordinator = ShardCoordinator(hhh_bot, 1)  # type: ignore[arg-type]
+    failing = FakeWriter(fail=True)
+    writer = FakeWriter()
+
+    async def send() -> None:
+        for update_id in (1, 2):
+            await coordinator.route(_update(update_id, -100), None)  # type: ignore[arg-type]
+
+        with pytest.raises(ConnectionResetError):
+            await coordinator._send_updates(0, failing)  # type: ignore[arg-type]
+        # the updates are only completed once they have been sent
+        assert completed == []
+
+        sender = asyncio.create_task(coordinator._send_updates(0, writer))  # type: ignore[arg-type]
+        await asyncio.wait_for(coordinator.drain(), 1)
+        sender.cancel()
+
+    asyncio.run(send())
+
+    assert failing.update_ids == [1]
+    assert writer.update_ids == [1, 2]
+    assert completed == [1, 2]
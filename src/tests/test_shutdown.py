@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram_bot.main import shutdown_applications
+
+
+class FakeApplication:
+    def __init__(self, name: str, calls: list[str], hang: bool = False):
+        self.name = name
+        self.calls = calls
+        self.hang = hang
+        self.running = True
+        self.updater = None
+        self.bot = SimpleNamespace(username=name)
+
+    async def stop(self) -> None:
+        self.running = False
+        if self.hang:
+            await asyncio.Event().wait()
+        self.calls.append(f"{self.name} stopped")
+
+    async def post_stop(self, application) -> None:
+        self.calls.append(f"{self.name} post_stop")
+
+    async def shutdown(self) -> None:
+        self.calls.append(f"{self.name} shut down")
+
+    async def post_shutdown(self, application) -> None:
+        self.calls.append(f"{self.name} written")
+        if self.name == "first":
+            raise OSError("disk full")
+
+
+def test_every_application_is_shut_down(monkeypatch) -> None:
+    monkeypatch.setenv("SHUTDOWN_TIMEOUT", "0.05")
+    calls: list[str] = []
+    applications = [
+        FakeApplication("first", calls, hang=True),
+        FakeApplication("second", calls),
+    ]
+
+    asyncio.run(shutdown_applications(applications))  # type: ignore[arg-type]
+
+    assert calls == [
+        "second stopped",
+        # post_stop runs even though the first one didn't stop in time
+        "first post_stop",
+        "first shut down",
+        "first written",
+        "second post_stop",
+        "second shut down",
+        "second written",
+    ]
@@ -0,0 +1,53 @@
+from typing import Any
+
+import pytest
+
+from telegram_bot import snapshot
+
+STATE: dict[str, Any] = {
+    "hhh_id": -1001473841450,
+    "group_message_id": [1, 2, 3],
+    "pinned_message_id": None,
+    "ratio": 0.25,
+    "chats": [
+        {
+            "id": -100123,
+            "title": "Ünïcode ✓",
+            "users": [
+                {"id": 1, "name": "a", "muted": False},
+                {"id": 2, "name": "b", "muted": True},
+            ],
+        },
+        {"id": -5, "title": "small", "users": []},
+    ],
+}
+
+
+def test_round_trip() -> None:
+    data = snapshot.dumps(STATE)
+
+    assert snapshot.is_snapshot(data)
+    assert snapshot.loads(data) == STATE
+
+
+def test_embedded_encoded_chat() -> None:
+    encoded = snapshot.EncodedChat.encode(STATE["chats"][0])
+    state = {**STATE, "chats": [encoded, STATE["chats"][1]]}
+
+    assert encoded.decode() == STATE["chats"][0]
+    assert snapshot.loads(snapshot.dumps(state)) == STATE
+
+
+def test_load_single_chat() -> None:
+    data = snapshot.dumps(STATE)
+
+    assert snapshot.load_chat(data, -5) == STATE["chats"][1]
+    assert snapshot.load_chat(data, 42) is None
+
+
+def test_corrupt_snapshot() -> None:
+    data = bytearray(snapshot.dumps(STATE))
+    data[-1] ^= 0xFF
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.loads(bytes(data))
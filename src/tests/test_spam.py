@@ -0,0 +1,87 @@
+import pytest
+
+from telegram_bot.spam import SpamDetector, SpamThresholds, SpamType
+
+THRESHOLDS = SpamThresholds(rate=5, window=10, same=3, consecutive=4)
+
+
+def _feed(detector: SpamDetector, user_id: int, content: str, now: float) -> SpamType:
+    return detector.feed(-1, user_id, content, THRESHOLDS, now=now)
+
+
+def test_same_message() -> None:
+    detector = SpamDetector()
+    assert _feed(detector, 1, "buy", 0) == SpamType.NONE
+    assert _feed(detector, 2, "hi", 1) == SpamType.NONE
+    assert _feed(detector, 1, "buy", 2) == SpamType.NONE
+    assert _feed(detector, 2, "hi", 3) == SpamType.NONE
+    assert _feed(detector, 1, "buy", 4) == SpamType.SAME
+
+
+def test_rate_within_window() -> None:
+    detector = SpamDetector()
+    for index in range(4):
+        assert _feed(detector, 1, f"m{index}", index * 3) == SpamType.NONE
+        _feed(detector, 2, f"other {index}", index * 3 + 1)
+    # the first message is outside of the window
+    assert _feed(detector, 1, "m4", 12) == SpamType.NONE
+    assert _feed(detector, 1, "m5", 12.5) == SpamType.DIFFERENT
+
+
+def test_consecutive_only_within_window() -> None:
+    detector = SpamDetector()
+    thresholds = SpamThresholds(rate=0, window=10, same=0, consecutive=3)
+    # a slow monologue isn't spam
+    for index in range(5):
+        assert detector.feed(-1, 1, None, thresholds, now=index * 6) == SpamType.NONE
+
+    detector = SpamDetector()
+    assert detector.feed(-1, 1, None, thresholds, now=0) == SpamType.NONE
+    assert detector.feed(-1, 1, None, thresholds, now=1) == SpamType.NONE
+    assert detector.feed(-1, 1, None, thresholds, now=2) == SpamType.CONSECUTIVE
+
+
+def test_other_user_interrupts_consecutive_messages() -> None:
+    detector = SpamDetector()
+    thresholds = SpamThresholds(rate=0, window=10, same=0, consecutive=3)
+    for now, user_id in enumerate([1, 1, 2, 1, 1]):
+        assert detector.feed(-1, user_id, None, thresholds, now=now) == SpamType.NONE
+
+
+def test_reset_forgets_user() -> None:
+    detector = SpamDetector()
+    for now in range(2):
+        _feed(detector, 1, "buy", now)
+    detector.reset(-1, 1)
+
+    assert _feed(detector, 1, "buy", 2) == SpamType.NONE
+
+
+def test_users_per_chat_are_bounded() -> None:
+    detector = SpamDetector(max_users=2)
+    for now in range(2):
+        _feed(detector, 1, "buy", now)
+    _feed(detector, 2, "a", 2)
+    _feed(detector, 3, "b", 3)
+
+    # user 1 has been forgotten
+    assert _feed(detector, 1, "buy", 4) == SpamType.NONE
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        {"rate": -1},
+        {"window": 0},
+        {"mute_minutes": 0},
+        {"mute_minutes": SpamThresholds.MAX_MUTE_MINUTES + 1},
+        {"same": "many"},
+    ],
+)
+def test_invalid_thresholds(values) -> None:
+    with pytest.raises(ValueError):
+        SpamThresholds.deserialize(values)
+
+
+def test_thresholds_round_trip() -> None:
+    assert SpamThresholds.deserialize(THRESHOLDS.serialize()) == THRESHOLDS
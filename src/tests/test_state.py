@@ -0,0 +1,85 @@
+import threading
+from functools import partial
+
+import pytest
+
+from telegram_bot.state import (
+    FsyncPolicy,
+    StateWriter,
+    atomic_write,
+    backup_filepath,
+    dump_state,
+    load_state,
+)
+
+
+def test_atomic_write_rotates_backups(tmp_path) -> None:
+    filepath = str(tmp_path / "state.json")
+    for content in (b"1", b"2", b"3", b"4"):
+        atomic_write(filepath, content, backups=2)
+
+    with open(filepath, "rb") as f:
+        assert f.read() == b"4"
+    with open(backup_filepath(filepath, 1), "rb") as f:
+        assert f.read() == b"3"
+    with open(backup_filepath(filepath, 2), "rb") as f:
+        assert f.read() == b"2"
+    assert not (tmp_path / "state.json.3").exists()
+    assert not (tmp_path / "state.json.tmp").exists()
+
+
+def test_load_state_falls_back_to_backup(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("STATE_BACKUPS", "2")
+    filepath = str(tmp_path / "state.json")
+    dump_state(filepath, {"chats": [], "version": 1})
+    dump_state(filepath, {"chats": [], "version": 2})
+    # e.g. truncated by a crash while writing without an atomic rename
+    with open(filepath, "wb") as f:
+        f.write(b'{"chats": [')
+
+    assert load_state(filepath)["version"] == 1
+
+
+def test_load_state_without_valid_state(tmp_path) -> None:
+    filepath = str(tmp_path / "state.json")
+    with pytest.raises(FileNotFoundError):
+        load_state(filepath, backups=1)
+
+    with open(filepath, "wb") as f:
+        f.write(b"[]")
+    with pytest.raises(ValueError):
+        load_state(filepath, backups=1)
+
+
+def test_interval_fsync_policy(monkeypatch) -> None:
+    now = 100.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    policy = FsyncPolicy(FsyncPolicy.INTERVAL, interval=10)
+
+    assert policy.should_sync()
+    now = 105.0
+    assert not policy.should_sync()
+    now = 111.0
+    assert policy.should_sync()
+    assert FsyncPolicy(FsyncPolicy.ALWAYS).should_sync()
+    assert not FsyncPolicy(FsyncPolicy.NEVER).should_sync()
+
+
+def test_writer_calls_callbacks_of_coalesced_states(tmp_path) -> None:
+    filepath = str(tmp_path / "state.json")
+    writer = StateWriter(filepath, FsyncPolicy(FsyncPolicy.NEVER), backups=0)
+    called: list[int] = []
+    # blocks the writer thread, so the following states are coalesced
+    release = threading.Event()
+    writer.call(release.wait)
+
+    for version in range(3):
+        writer.submit(
+            {"chats": [], "version": version}, after=partial(called.append, version)
+        )
+    release.set()
+    writer.flush()
+    writer.close()
+
+    assert called == [0, 1, 2]
+    assert load_state(filepath, backups=0)["version"] == 2